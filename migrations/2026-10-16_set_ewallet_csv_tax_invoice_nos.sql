@@ -0,0 +1,46 @@
+-- 2026-10-16: bulk tax_invoice_no back-population for EWALLET_CSV rows.
+-- Called via PostgREST rpc by db_loader.bulk_update_ewallet_csv_tax_invoice_nos
+-- (E-TAX PDF loop in main.py and scripts/backfill_ewallet_invoice_numbers.py),
+-- replacing one UPDATE request per PDF.
+--
+-- Same NULL-only semantics as update_ewallet_csv_tax_invoice_no: a row that
+-- already has a tax_invoice_no is never overwritten.
+--
+-- Input:  [{"merchant_id": "...", "process_date": "YYYY-MM-DD", "tax_invoice_no": "..."}, ...]
+-- Output: one row per distinct (merchant_id, process_date) with outcome
+--         'updated' | 'already_set' | 'not_found'.
+
+CREATE OR REPLACE FUNCTION finance.set_ewallet_csv_tax_invoice_nos(updates JSONB)
+RETURNS TABLE (merchant_id TEXT, process_date DATE, tax_invoice_no TEXT, outcome TEXT)
+LANGUAGE sql
+AS $$
+  WITH input AS (
+    SELECT DISTINCT ON (u.merchant_id, u.process_date) u.merchant_id, u.process_date, u.tax_invoice_no
+    FROM jsonb_to_recordset(updates) AS u(merchant_id TEXT, process_date DATE, tax_invoice_no TEXT)
+  ),
+  updated AS (
+    UPDATE finance.merchant_transaction_summaries m
+       SET tax_invoice_no = i.tax_invoice_no
+      FROM input i
+     WHERE m.merchant_id = i.merchant_id
+       AND m.process_date = i.process_date
+       AND m.report_source_type = 'EWALLET_CSV'
+       AND m.tax_invoice_no IS NULL
+    RETURNING m.merchant_id, m.process_date
+  )
+  SELECT i.merchant_id, i.process_date, i.tax_invoice_no,
+         CASE
+           WHEN EXISTS (SELECT 1 FROM updated u
+                         WHERE u.merchant_id = i.merchant_id AND u.process_date = i.process_date)
+             THEN 'updated'
+           WHEN EXISTS (SELECT 1 FROM finance.merchant_transaction_summaries m
+                         WHERE m.merchant_id = i.merchant_id AND m.process_date = i.process_date
+                           AND m.report_source_type = 'EWALLET_CSV')
+             THEN 'already_set'
+           ELSE 'not_found'
+         END
+    FROM input i;
+$$;
+
+COMMENT ON FUNCTION finance.set_ewallet_csv_tax_invoice_nos(JSONB) IS
+  'Bulk, NULL-only tax_invoice_no update for EWALLET_CSV summary rows; returns per-row outcome (updated/already_set/not_found).';
@@ -0,0 +1,58 @@
+-- 2026-10-16: single-statement ShopeePay settlement upsert.
+-- Called via PostgREST rpc by db_loader.upsert_shopeepay_settlements. Replaces
+-- the read-gdrive_file_id / upsert pair in main.process_shopeepay_email with
+-- one atomic statement per batch of emails.
+--
+-- An existing gdrive_file_id is kept (COALESCE), so a resend never clears the
+-- archive reference written by an earlier run. Returns the row's
+-- gdrive_file_id after the upsert; NULL means the body still needs archiving
+-- to Drive (the caller then patches the new ID in with a plain UPDATE).
+--
+-- Input: JSON array of shopeepay_daily_settlements rows (gdrive_file_id optional).
+-- Callers deduplicate on settlement_date — ON CONFLICT cannot touch a row twice.
+
+CREATE OR REPLACE FUNCTION finance.upsert_shopeepay_settlements(settlements JSONB)
+RETURNS TABLE (settlement_date DATE, gdrive_file_id TEXT)
+LANGUAGE sql
+AS $$
+  INSERT INTO finance.shopeepay_daily_settlements AS s (
+    settlement_date, gross_amount, refund_amount, merchant_support_amount,
+    commission_amount, vat_on_commission, wht_amount, rollover_amount,
+    net_amount, bank_account_tail, source_message_id, gdrive_file_id, raw_body
+  )
+  SELECT r.settlement_date, r.gross_amount, r.refund_amount, r.merchant_support_amount,
+         r.commission_amount, r.vat_on_commission, r.wht_amount, r.rollover_amount,
+         r.net_amount, r.bank_account_tail, r.source_message_id, r.gdrive_file_id, r.raw_body
+    FROM jsonb_to_recordset(settlements) AS r(
+      settlement_date          DATE,
+      gross_amount             NUMERIC(12,2),
+      refund_amount            NUMERIC(12,2),
+      merchant_support_amount  NUMERIC(12,2),
+      commission_amount        NUMERIC(12,2),
+      vat_on_commission        NUMERIC(12,2),
+      wht_amount               NUMERIC(12,2),
+      rollover_amount          NUMERIC(12,2),
+      net_amount               NUMERIC(12,2),
+      bank_account_tail        TEXT,
+      source_message_id        TEXT,
+      gdrive_file_id           TEXT,
+      raw_body                 TEXT
+    )
+  ON CONFLICT (settlement_date) DO UPDATE SET
+    gross_amount            = EXCLUDED.gross_amount,
+    refund_amount           = EXCLUDED.refund_amount,
+    merchant_support_amount = EXCLUDED.merchant_support_amount,
+    commission_amount       = EXCLUDED.commission_amount,
+    vat_on_commission       = EXCLUDED.vat_on_commission,
+    wht_amount              = EXCLUDED.wht_amount,
+    rollover_amount         = EXCLUDED.rollover_amount,
+    net_amount              = EXCLUDED.net_amount,
+    bank_account_tail       = EXCLUDED.bank_account_tail,
+    source_message_id       = EXCLUDED.source_message_id,
+    gdrive_file_id          = COALESCE(s.gdrive_file_id, EXCLUDED.gdrive_file_id),
+    raw_body                = EXCLUDED.raw_body
+  RETURNING s.settlement_date, s.gdrive_file_id;
+$$;
+
+COMMENT ON FUNCTION finance.upsert_shopeepay_settlements(JSONB) IS
+  'Bulk upsert of ShopeePay settlement rows keeping any existing gdrive_file_id; returns (settlement_date, gdrive_file_id), NULL gdrive_file_id = archive still needed.';
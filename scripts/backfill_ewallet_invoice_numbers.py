@@ -2,10 +2,12 @@
 Backfill tax_invoice_no on EWALLET_CSV summary rows by re-parsing every
 EWALLET_ETAX PDF already archived in Google Drive.
 
-GDrive layout walked: <root>/YYYY/YYYYMM/YYYY-MM-DD/E-TAX_INVOICE_EWALLET_<merchant>_DDMMYYYY.pdf
+GDrive layout: <root>/YYYY/YYYYMM/YYYY-MM-DD/E-TAX_INVOICE_EWALLET_<merchant>_DDMMYYYY.pdf
+Candidates are read from the local archive index (src/archive_index.py), which
+is refreshed incrementally from Drive at the start of each run.
 
 Usage:
-    python -m scripts.backfill_ewallet_invoice_numbers [--dry-run] [--from YYYY-MM-DD] [--to YYYY-MM-DD]
+    python -m scripts.backfill_ewallet_invoice_numbers [--dry-run] [--from YYYY-MM-DD] [--to YYYY-MM-DD] [--rebuild-index]
 
 Idempotent: skips PDFs whose corresponding EWALLET_CSV row already has a
 non-NULL tax_invoice_no, and skips PDFs with no matching CSV row at all.
@@ -13,31 +15,38 @@ non-NULL tax_invoice_no, and skips PDFs with no matching CSV row at all.
 
 import argparse
 import logging
+import multiprocessing
 import os
 import re
 import shutil
 import sys
 import tempfile
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, ThreadPoolExecutor, wait
 from datetime import datetime, date
 
 # Allow running as `python scripts/backfill_ewallet_invoice_numbers.py` from project root
 sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
 
+from src import archive_index
 from src import config
 from src import gdrive_handler
+from src import google_services
 from src.data_extractor import extract_ewallet_etax_pdf_data
 from src.db_loader import (
     get_supabase_client,
     get_ewallet_csv_summary,
-    update_ewallet_csv_tax_invoice_no,
+    prefetch_ewallet_csv_summaries,
+    bulk_update_ewallet_csv_tax_invoice_nos,
+    BULK_TAX_INVOICE_CHUNK_SIZE,
 )
 
 
 logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
 logger = logging.getLogger(__name__)
 
-FOLDER_MIME = 'application/vnd.google-apps.folder'
 PDF_FILENAME_PATTERN = re.compile(r"^E-TAX_INVOICE_EWALLET_(\d+)_(\d{8})\.pdf$", re.IGNORECASE)
+ETAX_NAME_PREFIX = "E-TAX_INVOICE_EWALLET_"
+PDF_MIME_TYPE = "application/pdf"
 
 
 def _parse_iso_date(s):
@@ -46,39 +55,198 @@ def _parse_iso_date(s):
     return datetime.strptime(s, "%Y-%m-%d").date()
 
 
-def _iter_etax_pdfs(gdrive_service, root_folder_id, date_from=None, date_to=None):
-    """Yields (day_str, file) for every ETAX PDF under root, filtered by date range."""
-    year_entries = gdrive_handler.list_files_in_folder(gdrive_service, root_folder_id)
-    for year_entry in year_entries:
-        if year_entry.get('mimeType') != FOLDER_MIME:
+def _iter_etax_pdfs(gdrive_service, root_folder_id, date_from=None, date_to=None, rebuild_index=False):
+    """
+    Yields (day_str, file) for every ETAX PDF under root, filtered by date range.
+    Candidates come from the local Drive archive index, refreshed first with one
+    incremental files().list query (a full one on first use, when the periodic
+    full listing is due, or with --rebuild-index).
+    """
+    conn = archive_index.open_index()
+    try:
+        archive_index.refresh(gdrive_service, conn, root_folder_id, ETAX_NAME_PREFIX, PDF_MIME_TYPE,
+                              full=rebuild_index)
+        candidates = archive_index.find_files(conn, ETAX_NAME_PREFIX)
+    finally:
+        conn.close()
+
+    for row in candidates:
+        # folder_path is "YYYY/YYYYMM/YYYY-MM-DD" for archived day folders.
+        parts = row['folder_path'].split('/')
+        if len(parts) != 3 or not re.fullmatch(r"\d{4}", parts[0]) or not re.fullmatch(r"\d{6}", parts[1]):
+            continue
+        day_name = parts[2]
+        try:
+            day_date = datetime.strptime(day_name, "%Y-%m-%d").date()
+        except ValueError:
+            continue
+        if date_from and day_date < date_from:
+            continue
+        if date_to and day_date > date_to:
+            continue
+        if PDF_FILENAME_PATTERN.match(row['name']):
+            yield day_name, {'id': row['file_id'], 'name': row['name']}
+
+
+def _prefetch_csv_summaries(candidates):
+    """
+    Fetches the EWALLET_CSV rows for every candidate PDF in one paginated query.
+    Returns the (merchant_id, process_date) index, or None for per-PDF lookups.
+    """
+    keys = set()
+    for _, gdrive_file in candidates:
+        match = PDF_FILENAME_PATTERN.match(gdrive_file['name'])
+        if not match:
             continue
-        if not re.fullmatch(r"\d{4}", year_entry['name']):
+        try:
+            keys.add((match.group(1), datetime.strptime(match.group(2), "%d%m%Y").strftime("%Y-%m-%d")))
+        except ValueError:
             continue
-        month_entries = gdrive_handler.list_files_in_folder(gdrive_service, year_entry['id'])
-        for month_entry in month_entries:
-            if month_entry.get('mimeType') != FOLDER_MIME:
-                continue
-            if not re.fullmatch(r"\d{6}", month_entry['name']):
-                continue
-            day_entries = gdrive_handler.list_files_in_folder(gdrive_service, month_entry['id'])
-            for day_entry in day_entries:
-                if day_entry.get('mimeType') != FOLDER_MIME:
-                    continue
-                day_name = day_entry['name']
+    if not keys:
+        return None
+    dates = sorted(process_date for _, process_date in keys)
+    return prefetch_ewallet_csv_summaries({merchant_id for merchant_id, _ in keys}, dates[0], dates[-1])
+
+
+def _prepare(gdrive_service, gdrive_file, tmp_dir, csv_summaries=None):
+    """
+    I/O stage: CSV lookup and PDF download for one candidate.
+    Returns (counter_key, None) when the item stops here, else (None, job) with
+    job = {filename, merchant_id, process_date_str, local_path}.
+    """
+    filename = gdrive_file['name']
+    match = PDF_FILENAME_PATTERN.match(filename)
+    if not match:
+        return None, None
+    merchant_id = match.group(1)
+    ddmmyyyy = match.group(2)
+    try:
+        process_date_obj = datetime.strptime(ddmmyyyy, "%d%m%Y").date()
+    except ValueError:
+        logger.warning(f"Skipping {filename}: cannot parse date '{ddmmyyyy}'.")
+        return None, None
+    process_date_str = process_date_obj.strftime("%Y-%m-%d")
+
+    csv_row = get_ewallet_csv_summary(merchant_id, process_date_str, prefetched=csv_summaries)
+    if not csv_row:
+        logger.info(
+            f"[skip:no_csv] {filename} (merchant_id={merchant_id} process_date={process_date_str})"
+        )
+        return "skipped_no_csv", None
+    if csv_row.get("tax_invoice_no"):
+        return "skipped_already_set", None
+
+    # Distinct per-file name: the same PDF name can exist in several day folders.
+    local_path = os.path.join(tmp_dir, f"{gdrive_file['id']}_{filename}")
+    drive = google_services.worker_service(gdrive_service, 'drive', 'v3') or gdrive_service
+    if not gdrive_handler.download_file_to_local(drive, gdrive_file['id'], local_path):
+        logger.error(f"[download_failed] {filename}")
+        _remove_quietly(local_path)
+        return "download_failed", None
+    return None, {
+        "filename": filename,
+        "merchant_id": merchant_id,
+        "process_date_str": process_date_str,
+        "local_path": local_path,
+    }
+
+
+# Counter bumped for each bulk-update outcome. already_set covers the race where
+# a row got a value between the lookup and the update.
+UPDATE_OUTCOME_COUNTERS = {
+    "updated": "updated",
+    "already_set": "skipped_already_set",
+    "not_found": "skipped_no_csv",
+    "error": "update_failed",
+}
+
+
+def _apply_updates(updates):
+    """I/O stage: write a batch of (merchant_id, process_date, tax_invoice_no). Returns the counters to bump."""
+    outcomes = bulk_update_ewallet_csv_tax_invoice_nos(updates)
+    return [UPDATE_OUTCOME_COUNTERS[outcomes.get((m, d), "error")] for m, d, _ in updates]
+
+
+def _remove_quietly(path):
+    try:
+        if os.path.exists(path):
+            os.remove(path)
+    except OSError as e:
+        logger.warning(f"Could not remove temp file {path}: {e}")
+
+
+def _run_pipeline(candidates, gdrive_service, tmp_dir, counters, args, csv_summaries=None):
+    """
+    Staged pipeline: Supabase lookups, Drive downloads and updates run on a
+    thread pool, PDF parsing (CPU-bound pdfplumber) on a process pool. At most
+    `args.max_in_flight` items are between stages at once, which bounds both
+    memory and the PDFs sitting in tmp_dir. Parsed invoice numbers are written
+    in bulk, BULK_TAX_INVOICE_CHUNK_SIZE rows per Supabase call.
+
+    Parse workers are spawned, not forked: they start while backfill-io threads
+    are mid-download, and a forked child could inherit a lock (logging,
+    httplib2/ssl) held by one of them and deadlock.
+    """
+    candidates = iter(candidates)
+    in_flight = {}  # future -> (stage, job)
+    pending_updates = []
+
+    with ThreadPoolExecutor(max_workers=args.io_workers, thread_name_prefix="backfill-io") as io_pool, \
+            ProcessPoolExecutor(max_workers=args.parse_workers,
+                                mp_context=multiprocessing.get_context("spawn")) as cpu_pool:
+
+        def refill():
+            while len(in_flight) < args.max_in_flight:
                 try:
-                    day_date = datetime.strptime(day_name, "%Y-%m-%d").date()
-                except ValueError:
-                    continue
-                if date_from and day_date < date_from:
-                    continue
-                if date_to and day_date > date_to:
-                    continue
-                files = gdrive_handler.list_files_in_folder(gdrive_service, day_entry['id'])
-                for f in files:
-                    if f.get('mimeType') == FOLDER_MIME:
-                        continue
-                    if PDF_FILENAME_PATTERN.match(f['name']):
-                        yield day_name, f
+                    _, gdrive_file = next(candidates)
+                except StopIteration:
+                    return
+                counters["scanned"] += 1
+                in_flight[io_pool.submit(_prepare, gdrive_service, gdrive_file, tmp_dir, csv_summaries)] = ("prepare", None)
+
+        def flush_updates():
+            if pending_updates:
+                in_flight[io_pool.submit(_apply_updates, list(pending_updates))] = ("update", None)
+                pending_updates.clear()
+
+        refill()
+        while in_flight:
+            done, _ = wait(in_flight, return_when=FIRST_COMPLETED)
+            for future in done:
+                stage, job = in_flight.pop(future)
+                if stage == "prepare":
+                    counter, job = future.result()
+                    if counter:
+                        counters[counter] += 1
+                    if job:
+                        in_flight[cpu_pool.submit(extract_ewallet_etax_pdf_data, job["local_path"])] = ("parse", job)
+                elif stage == "parse":
+                    try:
+                        parsed = future.result()
+                    except Exception as e:
+                        logger.warning(f"Parser raised for {job['filename']}: {e}")
+                        parsed = None
+                    finally:
+                        _remove_quietly(job["local_path"])
+                    if not parsed:
+                        logger.error(f"[parse_failed] {job['filename']}")
+                        counters["parse_failed"] += 1
+                    elif args.dry_run:
+                        logger.info(
+                            f"[dry-run] would update merchant_id={job['merchant_id']} process_date={job['process_date_str']} "
+                            f"tax_invoice_no={parsed['tax_invoice_no']}"
+                        )
+                        counters["updated"] += 1
+                    else:
+                        pending_updates.append((job["merchant_id"], job["process_date_str"], parsed['tax_invoice_no']))
+                        if len(pending_updates) >= BULK_TAX_INVOICE_CHUNK_SIZE:
+                            flush_updates()
+                else:
+                    for counter in future.result():
+                        counters[counter] += 1
+            refill()
+            if not in_flight:
+                flush_updates()
 
 
 def main():
@@ -86,8 +254,18 @@ def main():
     parser.add_argument("--dry-run", action="store_true", help="Parse and report only; do not update Supabase.")
     parser.add_argument("--from", dest="date_from", help="Inclusive lower bound (YYYY-MM-DD) on day folder.")
     parser.add_argument("--to", dest="date_to", help="Inclusive upper bound (YYYY-MM-DD) on day folder.")
+    parser.add_argument("--rebuild-index", action="store_true",
+                        help="Re-list all ETAX PDFs instead of refreshing the local archive index incrementally.")
+    parser.add_argument("--io-workers", type=int, default=8,
+                        help="Threads for Supabase lookups/updates and Drive downloads (default: 8).")
+    parser.add_argument("--parse-workers", type=int, default=os.cpu_count() or 1,
+                        help="Processes parsing PDFs (default: number of CPUs).")
+    parser.add_argument("--max-in-flight", type=int, default=None,
+                        help="Max PDFs between stages at once (default: 2 x (io + parse workers)).")
     args = parser.parse_args()
 
+    if args.max_in_flight is None:
+        args.max_in_flight = 2 * (args.io_workers + args.parse_workers)
     date_from = _parse_iso_date(args.date_from)
     date_to = _parse_iso_date(args.date_to)
 
@@ -110,75 +288,17 @@ def main():
         "updated": 0,
         "parse_failed": 0,
         "download_failed": 0,
+        "update_failed": 0,
     }
 
     tmp_dir = tempfile.mkdtemp(prefix="ewallet_etax_backfill_")
     logger.info(f"Using temp dir: {tmp_dir}")
 
+    candidates = list(_iter_etax_pdfs(gdrive_service, config.GDRIVE_ROOT_FOLDER_ID, date_from, date_to,
+                                      rebuild_index=args.rebuild_index))
+    csv_summaries = _prefetch_csv_summaries(candidates)
     try:
-        for day_str, gdrive_file in _iter_etax_pdfs(gdrive_service, config.GDRIVE_ROOT_FOLDER_ID, date_from, date_to):
-            counters["scanned"] += 1
-            filename = gdrive_file['name']
-            match = PDF_FILENAME_PATTERN.match(filename)
-            if not match:
-                continue
-            merchant_id = match.group(1)
-            ddmmyyyy = match.group(2)
-            try:
-                process_date_obj = datetime.strptime(ddmmyyyy, "%d%m%Y").date()
-            except ValueError:
-                logger.warning(f"Skipping {filename}: cannot parse date '{ddmmyyyy}'.")
-                continue
-            process_date_str = process_date_obj.strftime("%Y-%m-%d")
-
-            csv_row = get_ewallet_csv_summary(merchant_id, process_date_str)
-            if not csv_row:
-                logger.info(
-                    f"[skip:no_csv] {filename} (merchant_id={merchant_id} process_date={process_date_str})"
-                )
-                counters["skipped_no_csv"] += 1
-                continue
-            if csv_row.get("tax_invoice_no"):
-                counters["skipped_already_set"] += 1
-                continue
-
-            local_path = os.path.join(tmp_dir, filename)
-            if not gdrive_handler.download_file_to_local(gdrive_service, gdrive_file['id'], local_path):
-                logger.error(f"[download_failed] {filename}")
-                counters["download_failed"] += 1
-                continue
-
-            try:
-                parsed = extract_ewallet_etax_pdf_data(local_path)
-                if not parsed:
-                    logger.error(f"[parse_failed] {filename}")
-                    counters["parse_failed"] += 1
-                    continue
-
-                if args.dry_run:
-                    logger.info(
-                        f"[dry-run] would update merchant_id={merchant_id} process_date={process_date_str} "
-                        f"tax_invoice_no={parsed['tax_invoice_no']}"
-                    )
-                    counters["updated"] += 1
-                    continue
-
-                rows_updated = update_ewallet_csv_tax_invoice_no(
-                    merchant_id=merchant_id,
-                    process_date=process_date_str,
-                    tax_invoice_no=parsed['tax_invoice_no'],
-                )
-                if rows_updated >= 1:
-                    counters["updated"] += 1
-                else:
-                    # Race: row got a value between the SELECT and UPDATE — treat as already_set.
-                    counters["skipped_already_set"] += 1
-            finally:
-                try:
-                    if os.path.exists(local_path):
-                        os.remove(local_path)
-                except OSError as e:
-                    logger.warning(f"Could not remove temp file {local_path}: {e}")
+        _run_pipeline(candidates, gdrive_service, tmp_dir, counters, args, csv_summaries)
     finally:
         # rmtree handles the case where a partial download left bytes behind.
         shutil.rmtree(tmp_dir, ignore_errors=True)
@@ -28,12 +28,13 @@ def main():
     query = f"from:support_th@shopeepay.com label:{email_handler.LABEL_SHOPEEPAY_EMAIL_PROCESSED}"
     messages = email_handler.search_emails(svc, query)
     print(f"Found {len(messages)} messages carrying {email_handler.LABEL_SHOPEEPAY_EMAIL_PROCESSED}")
+    label_batch = email_handler.LabelMutationBatch(svc)
     for m in messages:
-        ok = email_handler.remove_label_from_email(
-            svc, m["id"], email_handler.LABEL_SHOPEEPAY_EMAIL_PROCESSED
-        )
-        print(f"  {m['id']}: removed_label={ok}")
-
+        label_batch.remove_labels(m["id"], email_handler.LABEL_SHOPEEPAY_EMAIL_PROCESSED)
+    applied, failed = label_batch.flush()
+    print(f"Removed label from {applied} message(s) via batchModify; failed: {len(failed)}")
+    for message_id in failed:
+        print(f"  {message_id}: removed_label=False")
 
 if __name__ == "__main__":
     main()
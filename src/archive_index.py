@@ -0,0 +1,198 @@
+import os.path
+import logging
+import sqlite3
+from datetime import datetime, timedelta, timezone
+
+from . import config
+from . import gdrive_handler
+from . import rate_limiter
+
+logger = logging.getLogger(__name__)
+
+# Local SQLite index of archived Drive files, so scripts can enumerate
+# candidates with a query instead of walking Year/Month/Day folders.
+INDEX_FILENAME = 'drive_archive_index.sqlite3'
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS files (
+    file_id       TEXT PRIMARY KEY,
+    name          TEXT NOT NULL,
+    parent_id     TEXT,
+    folder_path   TEXT,
+    md5           TEXT,
+    modified_time TEXT
+);
+CREATE INDEX IF NOT EXISTS files_name ON files (name);
+CREATE TABLE IF NOT EXISTS watermarks (
+    scope         TEXT PRIMARY KEY,
+    modified_time TEXT NOT NULL
+);
+"""
+
+
+def open_index(path=None):
+    """Opens (creating if needed) the archive index, by default under LOCAL_STATE_DIR."""
+    path = path or os.path.join(config.LOCAL_STATE_DIR, INDEX_FILENAME)
+    os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+    conn = sqlite3.connect(path)
+    conn.row_factory = sqlite3.Row
+    conn.executescript(SCHEMA)
+    return conn
+
+
+def _scope(root_folder_id, name_contains, mime_type):
+    return f"{root_folder_id}|{name_contains}|{mime_type or ''}"
+
+
+def _full_scope(scope):
+    return f"{scope}|full"
+
+
+def reset_watermark(conn, root_folder_id, name_contains, mime_type=None):
+    """Forces the next refresh() for this scope to re-list everything."""
+    scope = _scope(root_folder_id, name_contains, mime_type)
+    with conn:
+        conn.execute("DELETE FROM watermarks WHERE scope IN (?, ?)", (scope, _full_scope(scope)))
+
+
+def _full_listing_due(conn, scope):
+    days = config.ARCHIVE_INDEX_FULL_REFRESH_DAYS
+    if days <= 0:
+        return False
+    row = conn.execute("SELECT modified_time FROM watermarks WHERE scope = ?", (_full_scope(scope),)).fetchone()
+    if not row:
+        return True
+    return datetime.now(timezone.utc) - datetime.fromisoformat(row['modified_time']) >= timedelta(days=days)
+
+
+def refresh(service, conn, root_folder_id, name_contains, mime_type=None, full=False):
+    """
+    Brings the index up to date for files whose name contains `name_contains`
+    (and of `mime_type`, if given) anywhere under root_folder_id.
+
+    A full listing pages one wide files().list query and replaces every row
+    whose name starts with `name_contains`. It runs on the first call, when
+    `full` is set, or once ARCHIVE_INDEX_FULL_REFRESH_DAYS have passed since
+    the last one. Other calls are incremental: they only ask for files with
+    modifiedTime after the stored watermark, so they see edits (including
+    trashing, which bumps modifiedTime) but not moves or permanent deletes;
+    those are caught by the next full listing.
+
+    Folder paths come from the gdrive_handler folder cache, whose tree under
+    root_folder_id is walked again once if a listed file's parent is unknown;
+    files still not placed after that walk are outside the archive. If the
+    walk fails, such files keep their existing row, and the watermark stays
+    below them so the next refresh looks at them again. Returns the number of
+    rows added or updated.
+    """
+    scope = _scope(root_folder_id, name_contains, mime_type)
+    row = conn.execute("SELECT modified_time FROM watermarks WHERE scope = ?", (scope,)).fetchone()
+    watermark = row['modified_time'] if row else None
+    incremental = bool(watermark) and not full and not _full_listing_due(conn, scope)
+    started = datetime.now(timezone.utc).isoformat()
+
+    escaped = name_contains.replace("'", "\\'")
+    query = f"name contains '{escaped}'"
+    if mime_type:
+        query += f" and mimeType = '{mime_type}'"
+    if incremental:
+        # Trashed files are included so they can be removed.
+        query += f" and modifiedTime > '{watermark}'"
+    else:
+        query += " and trashed = false"
+
+    listed = []
+    page_token = None
+    while True:
+        response = rate_limiter.drive(service.files().list(
+            q=query,
+            spaces='drive',
+            fields=gdrive_handler.DRIVE_FIELDS['index.files'],
+            pageSize=1000,
+            pageToken=page_token,
+        ))
+        listed.extend(response.get('files', []))
+        page_token = response.get('nextPageToken')
+        if not page_token:
+            break
+
+    folder_paths = gdrive_handler.cached_folder_paths(service, root_folder_id)
+    known_folders = gdrive_handler.known_folder_ids()
+    rewalked = False
+    if any(not f.get('trashed') and not known_folders.intersection(f.get('parents') or []) for f in listed):
+        # Most likely a Day folder created since the cache was warmed.
+        rewalked = gdrive_handler.warm_folder_cache(service, root_folder_id, force=True)
+        folder_paths = gdrive_handler.cached_folder_paths(service, root_folder_id)
+        known_folders = gdrive_handler.known_folder_ids()
+
+    upserts, removals, unresolved = [], [], []
+    for f in listed:
+        modified = f.get('modifiedTime')
+        parents = f.get('parents') or []
+        parent_id = next((p for p in parents if p in folder_paths), None)
+        if f.get('trashed'):
+            removals.append((f['id'],))
+        elif parent_id is not None:
+            upserts.append((f['id'], f['name'], parent_id, folder_paths[parent_id], f.get('md5Checksum'), modified))
+        elif rewalked or any(p in known_folders for p in parents):
+            # Outside the archive (or moved out of it): the fresh walk of root did not find its folder.
+            removals.append((f['id'],))
+        else:
+            unresolved.append(f)
+
+    # Never move the watermark past a file that could not be placed.
+    ceiling = min((f.get('modifiedTime') or '' for f in unresolved), default=None)
+    newest = watermark if incremental else None
+    for f in listed:
+        modified = f.get('modifiedTime')
+        if modified and (newest is None or modified > newest) and (ceiling is None or modified < ceiling):
+            newest = modified
+    if unresolved:
+        logger.warning(f"Archive index: {len(unresolved)} file(s) in unknown folders "
+                       f"(e.g. {unresolved[0]['name']}); holding the watermark at {newest}.")
+
+    with conn:
+        if not incremental:
+            # A full listing replaces this scope, dropping permanently deleted and moved files too.
+            keep = [(f['id'],) for f in unresolved]
+            conn.execute("CREATE TEMP TABLE IF NOT EXISTS keep_ids (file_id TEXT PRIMARY KEY)")
+            conn.execute("DELETE FROM keep_ids")
+            conn.executemany("INSERT OR IGNORE INTO keep_ids (file_id) VALUES (?)", keep)
+            conn.execute("DELETE FROM files WHERE name LIKE ? ESCAPE '\\' AND file_id NOT IN (SELECT file_id FROM keep_ids)",
+                         (_like_prefix(name_contains),))
+            _set_watermark(conn, _full_scope(scope), started)
+        conn.executemany("DELETE FROM files WHERE file_id = ?", removals)
+        conn.executemany(
+            "INSERT INTO files (file_id, name, parent_id, folder_path, md5, modified_time) VALUES (?, ?, ?, ?, ?, ?) "
+            "ON CONFLICT(file_id) DO UPDATE SET name = excluded.name, parent_id = excluded.parent_id, "
+            "folder_path = excluded.folder_path, md5 = excluded.md5, modified_time = excluded.modified_time",
+            upserts,
+        )
+        if newest:
+            _set_watermark(conn, scope, newest)
+        elif not incremental:
+            conn.execute("DELETE FROM watermarks WHERE scope = ?", (scope,))
+    logger.info(f"Archive index refreshed ({'incremental' if incremental else 'full'}): "
+                f"{len(upserts)} file(s) indexed, {len(removals)} removed, {len(unresolved)} unresolved.")
+    return len(upserts)
+
+
+def _set_watermark(conn, scope, modified_time):
+    conn.execute(
+        "INSERT INTO watermarks (scope, modified_time) VALUES (?, ?) "
+        "ON CONFLICT(scope) DO UPDATE SET modified_time = excluded.modified_time",
+        (scope, modified_time),
+    )
+
+
+def find_files(conn, name_prefix, folder_path_prefix=''):
+    """Indexed files whose name starts with name_prefix, ordered by folder path and name."""
+    return [dict(row) for row in conn.execute(
+        "SELECT file_id, name, parent_id, folder_path, md5, modified_time FROM files "
+        "WHERE name LIKE ? ESCAPE '\\' AND folder_path LIKE ? ESCAPE '\\' ORDER BY folder_path, name",
+        (_like_prefix(name_prefix), _like_prefix(folder_path_prefix)),
+    )]
+
+
+def _like_prefix(prefix):
+    return prefix.replace('\\', '\\\\').replace('%', '\\%').replace('_', '\\_') + '%'
@@ -11,6 +11,15 @@ load_dotenv(os.path.join(PROJECT_ROOT, '.env'))
 SUPABASE_URL = os.getenv("SUPABASE_URL")
 SUPABASE_KEY = os.getenv("SUPABASE_KEY")
 SUPABASE_SCHEMA = os.getenv("SUPABASE_SCHEMA", "finance")
+# Rows per upsert request when db_loader.WriteBuffer flushes; a table's buffer
+# is also flushed as soon as it holds this many rows.
+SUPABASE_WRITE_BATCH_ROWS = int(os.getenv("SUPABASE_WRITE_BATCH_ROWS", "500"))
+# Chunks of one bulk load sent to Supabase concurrently; 1 sends them in order.
+SUPABASE_LOAD_WORKERS = int(os.getenv("SUPABASE_LOAD_WORKERS", "4"))
+# HTTP/2 connection pool shared by all Supabase calls in a process.
+SUPABASE_MAX_CONNECTIONS = int(os.getenv("SUPABASE_MAX_CONNECTIONS", "8"))
+SUPABASE_KEEPALIVE_EXPIRY_SECONDS = float(os.getenv("SUPABASE_KEEPALIVE_EXPIRY_SECONDS", "60"))
+SUPABASE_TIMEOUT_SECONDS = float(os.getenv("SUPABASE_TIMEOUT_SECONDS", "120"))
 
 # ZIP File Configuration
 ZIP_PASSWORD = os.getenv("ZIP_PASSWORD")
@@ -30,12 +39,57 @@ DOWNLOAD_REPORTS_DIR = os.path.join(PROJECT_ROOT, DOWNLOAD_REPORTS_DIR_REL)
 if not os.path.exists(DOWNLOAD_REPORTS_DIR):
     os.makedirs(DOWNLOAD_REPORTS_DIR)
 
+# Local run state (Gmail label IDs, sync watermarks, Drive folder IDs). Safe to
+# delete at any time; every cache in here is rebuilt from the APIs on a miss.
+LOCAL_STATE_DIR_REL = os.getenv("LOCAL_STATE_DIR", ".state/")
+LOCAL_STATE_DIR = os.path.join(PROJECT_ROOT, LOCAL_STATE_DIR_REL)
+# The Drive archive index (src/archive_index.py) re-lists its scope in full
+# after this many days; incremental refreshes only see edited files.
+ARCHIVE_INDEX_FULL_REFRESH_DAYS = float(os.getenv("ARCHIVE_INDEX_FULL_REFRESH_DAYS", "7"))
+
+# How long the persisted Gmail label name -> ID map stays valid between runs.
+# 0 disables persistence (labels are still resolved only once per process).
+GMAIL_LABEL_CACHE_TTL_SECONDS = int(os.getenv("GMAIL_LABEL_CACHE_TTL_SECONDS", "86400"))
+
+# Incremental Gmail sync: remember the mailbox historyId per search and only
+# re-search when users().history().list reports new or relabelled mail.
+GMAIL_INCREMENTAL_SYNC = os.getenv("GMAIL_INCREMENTAL_SYNC", "true").lower() in ("1", "true", "yes")
+
+# Parallel attachment downloads in fetch_new_reports. Each worker thread gets
+# its own authorized HTTP client; 1 restores the old serial behaviour.
+GMAIL_DOWNLOAD_WORKERS = int(os.getenv("GMAIL_DOWNLOAD_WORKERS", "4"))
+
+# messages().get calls grouped per Gmail HTTP batch request (Gmail caps a
+# batch at 100; larger batches are more likely to be rate limited).
+GMAIL_BATCH_SIZE = int(os.getenv("GMAIL_BATCH_SIZE", "50"))
+
+# Shared Google API limiter (src/rate_limiter.py). Gmail allows 250 quota
+# units/s per user and Drive ~200 requests/s; the defaults stay a bit under.
+GMAIL_QUOTA_UNITS_PER_SECOND = float(os.getenv("GMAIL_QUOTA_UNITS_PER_SECOND", "200"))
+DRIVE_REQUESTS_PER_SECOND = float(os.getenv("DRIVE_REQUESTS_PER_SECOND", "150"))
+# Upper bound on concurrent calls per API; halved whenever the API throttles.
+GOOGLE_API_MAX_CONCURRENCY = int(os.getenv("GOOGLE_API_MAX_CONCURRENCY", "8"))
+# Attempts per call (first try included) on 429/5xx/connection errors.
+GOOGLE_API_MAX_ATTEMPTS = int(os.getenv("GOOGLE_API_MAX_ATTEMPTS", "5"))
+
 # Google Drive Configuration
 GDRIVE_ROOT_FOLDER_ID = os.getenv("GDRIVE_ROOT_FOLDER_ID", "1FQVq8tF-Wm4PHTzo8Ah5TRU7b69dsM7B") # Updated to the new folder ID
 # Optional: override the ShopeePay archive root. If unset, a "ShopeePay" folder is
 # auto-created under GDRIVE_ROOT_FOLDER_ID on first run.
 GDRIVE_SHOPEEPAY_ROOT_FOLDER_ID = os.getenv("GDRIVE_SHOPEEPAY_ROOT_FOLDER_ID")
 
+# Drive uploads: files smaller than this go as one multipart request; larger
+# ones use a resumable session sent in GDRIVE_UPLOAD_CHUNK_BYTES chunks (a
+# multiple of 256 KiB).
+GDRIVE_RESUMABLE_THRESHOLD_BYTES = int(os.getenv("GDRIVE_RESUMABLE_THRESHOLD_BYTES", str(5 * 1024 * 1024)))
+GDRIVE_UPLOAD_CHUNK_BYTES = int(os.getenv("GDRIVE_UPLOAD_CHUNK_BYTES", str(8 * 1024 * 1024)))
+if GDRIVE_UPLOAD_CHUNK_BYTES <= 0 or GDRIVE_UPLOAD_CHUNK_BYTES % (256 * 1024):
+    raise ValueError(f"GDRIVE_UPLOAD_CHUNK_BYTES must be a positive multiple of 262144, got {GDRIVE_UPLOAD_CHUNK_BYTES}.")
+
+# Files of one report archived to Drive concurrently, each worker on its own
+# Drive client; 1 uploads them one after another.
+GDRIVE_UPLOAD_WORKERS = int(os.getenv("GDRIVE_UPLOAD_WORKERS", "4"))
+
 # Google Service Account Configuration
 GOOGLE_SERVICE_ACCOUNT_KEY_PATH_REL = os.getenv("GOOGLE_SERVICE_ACCOUNT_KEY_PATH", "service_account.json") # Relative to project root by default
 GOOGLE_SERVICE_ACCOUNT_KEY_PATH = os.path.join(PROJECT_ROOT, GOOGLE_SERVICE_ACCOUNT_KEY_PATH_REL)
@@ -64,5 +118,6 @@ if __name__ == '__main__':
     print(f"Gmail Token Path: {GMAIL_TOKEN_PATH}")
     print(f"Download Reports Dir: {DOWNLOAD_REPORTS_DIR}")
     print(f"Download directory exists: {os.path.exists(DOWNLOAD_REPORTS_DIR)}")
+    print(f"Local State Dir: {LOCAL_STATE_DIR}")
     print(f"Google Drive Root Folder ID: {GDRIVE_ROOT_FOLDER_ID}")
     print(f"Google Service Account Key Path: {GOOGLE_SERVICE_ACCOUNT_KEY_PATH}")
\ No newline at end of file
@@ -10,7 +10,7 @@ import io # Added import
 # Configure basic logging
 logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
 
-def extract_csv_data(csv_path, merchant_id="N/A", report_date="N/A", process_date_arg="N/A", report_source_type="UNKNOWN"):
+def extract_csv_data(csv_path, merchant_id="N/A", report_date="N/A", process_date_arg="N/A", report_source_type="UNKNOWN", csv_content=None):
     """
     Extracts data from the K-Merchant TAX_SUMMARY_BY_TAX_ID_CSV file.
 
@@ -22,12 +22,14 @@ def extract_csv_data(csv_path, merchant_id="N/A", report_date="N/A", process_dat
                                 For K-Merchant ZIPs, this is typically same as report_date.
                                 This is distinct from the 'PROCESS DATE' column within the CSV.
         report_source_type (str): Identifier for the source of the report (e.g., KMERCHANT_ZIP).
+        csv_content (bytes): The CSV already in memory (e.g. read from a ZIP). When given,
+                             csv_path only names the file and is not opened.
 
     Returns:
         list: A list of dictionaries, where each dictionary represents a row of extracted data
               ready for Supabase insertion. Returns an empty list if processing fails.
     """
-    if not os.path.exists(csv_path):
+    if csv_content is None and not os.path.exists(csv_path):
         logging.error(f"CSV file not found: {csv_path}")
         return []
 
@@ -39,7 +41,7 @@ def extract_csv_data(csv_path, merchant_id="N/A", report_date="N/A", process_dat
         
         # A more robust way might be to skip rows until a known header is found, 
         # but pandas read_csv is often smart enough if the header is reasonably clean.
-        df = pd.read_csv(csv_path, encoding='utf-8') # Or try 'latin1' or 'cp874' for Thai characters if UTF-8 fails
+        df = pd.read_csv(io.BytesIO(csv_content) if csv_content is not None else csv_path, encoding='utf-8') # Or try 'latin1' or 'cp874' for Thai characters if UTF-8 fails
 
         # Normalize column names: lowercase and replace spaces with underscores
         df.columns = df.columns.str.lower().str.replace(' ', '_').str.replace('/', '_')
@@ -2,31 +2,168 @@
 
 import logging
 import os
-from supabase import create_client, Client
-from src.config import SUPABASE_URL, SUPABASE_KEY, SUPABASE_SCHEMA
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+import httpx
+from postgrest import SyncPostgrestClient
+from postgrest.exceptions import APIError
+from postgrest.types import CountMethod, ReturnMethod
+from postgrest.utils import SyncClient
+
+from src.config import (
+    SUPABASE_URL,
+    SUPABASE_KEY,
+    SUPABASE_SCHEMA,
+    SUPABASE_WRITE_BATCH_ROWS,
+    SUPABASE_LOAD_WORKERS,
+    SUPABASE_MAX_CONNECTIONS,
+    SUPABASE_KEEPALIVE_EXPIRY_SECONDS,
+    SUPABASE_TIMEOUT_SECONDS,
+)
 
 # Configure basic logging
 logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
 
-# Initialize Supabase client
-supabase_client: Client = None
-try:
-    if SUPABASE_URL and SUPABASE_KEY:
-        supabase_client = create_client(SUPABASE_URL, SUPABASE_KEY)
-        logging.info("Supabase client initialized successfully.")
-    else:
-        logging.warning("SupABASE_URL or SUPABASE_KEY is not set. Supabase client not initialized.")
-except Exception as e:
-    logging.error(f"Failed to initialize Supabase client: {e}", exc_info=True)
-    supabase_client = None # Ensure it's None if initialization fails
+
+class PooledPostgrestClient(SyncPostgrestClient):
+    """
+    PostgREST client whose HTTP/2 session uses explicit keep-alive limits, and
+    whose schema() hands back one cached client per schema. The stock schema()
+    builds a new client — and a new connection pool — on every call, which is
+    what `client.schema(SUPABASE_SCHEMA).table(...)` did for each request.
+    """
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self._schemas = {}
+        self._schemas_lock = threading.Lock()
+
+    def create_session(self, base_url, headers, timeout, verify=True, proxy=None):
+        return SyncClient(
+            base_url=base_url,
+            headers=headers,
+            timeout=timeout,
+            verify=verify,
+            proxy=proxy,
+            follow_redirects=True,
+            http2=True,
+            limits=httpx.Limits(
+                max_connections=SUPABASE_MAX_CONNECTIONS,
+                max_keepalive_connections=SUPABASE_MAX_CONNECTIONS,
+                keepalive_expiry=SUPABASE_KEEPALIVE_EXPIRY_SECONDS,
+            ),
+        )
+
+    def schema(self, schema: str):
+        if schema == self.headers.get("Accept-Profile"):
+            return self
+        with self._schemas_lock:
+            client = self._schemas.get(schema)
+            if client is None:
+                client = self._schemas[schema] = PooledPostgrestClient(
+                    self.base_url, schema=schema, headers=self.headers, timeout=self.timeout,
+                    verify=self.verify, proxy=self.proxy,
+                )
+            return client
+
+
+# Process-wide client, built on first use by get_supabase_client() (tests may
+# assign a stand-in directly).
+supabase_client: PooledPostgrestClient = None
+_client_lock = threading.Lock()
+_client_init_attempted = False
+
 
 def get_supabase_client():
-    """Returns the initialized Supabase client."""
-    if not supabase_client:
-        logging.error("Supabase client is not initialized. Cannot perform database operations.")
-    return supabase_client
+    """
+    Returns the process-wide Supabase (PostgREST) client, creating it on first
+    call. No network work happens at import time; connections are opened
+    lazily and reused by every loader function. Returns None if SUPABASE_URL /
+    SUPABASE_KEY are not set.
+    """
+    global supabase_client, _client_init_attempted
+    if supabase_client or _client_init_attempted:
+        return supabase_client
+    with _client_lock:
+        if supabase_client or _client_init_attempted:
+            return supabase_client
+        _client_init_attempted = True
+        if not (SUPABASE_URL and SUPABASE_KEY):
+            logging.warning("SUPABASE_URL or SUPABASE_KEY is not set. Supabase client not initialized.")
+            return None
+        try:
+            supabase_client = PooledPostgrestClient(
+                f"{SUPABASE_URL.rstrip('/')}/rest/v1",
+                schema=SUPABASE_SCHEMA or "public",
+                headers={
+                    "Accept": "application/json",
+                    "Content-Type": "application/json",
+                    "apiKey": SUPABASE_KEY,
+                    "Authorization": f"Bearer {SUPABASE_KEY}",
+                },
+                timeout=SUPABASE_TIMEOUT_SECONDS,
+            )
+            logging.info("Supabase client initialized successfully.")
+        except Exception as e:
+            logging.error(f"Failed to initialize Supabase client: {e}", exc_info=True)
+            supabase_client = None
+        return supabase_client
 
-def load_data_to_supabase(table_name: str, data_list: list, conflict_columns: list = None):
+def _write_rows(client, table_name: str, data_list: list, conflict_columns: list, minimal_response: bool):
+    """
+    One insert/upsert request for load_data_to_supabase; exceptions propagate.
+    Returns (success_count, failure_count).
+    """
+    success_count = 0
+    failure_count = 0
+    # Supabase client's insert method can handle a list of dicts directly.
+    # For upsert, ensure your Supabase table has the appropriate unique constraints defined on conflict_columns.
+    # Use the configured schema (defaults to 'finance' for lengolf Supabase)
+    table_query = client.schema(SUPABASE_SCHEMA).table(table_name) if SUPABASE_SCHEMA else client.table(table_name)
+
+    write_options = {"count": CountMethod.exact, "returning": ReturnMethod.minimal} if minimal_response else {}
+    if conflict_columns:
+        response = table_query.upsert(data_list, on_conflict=",".join(conflict_columns) if isinstance(conflict_columns, list) else conflict_columns, **write_options).execute()
+    else:
+        response = table_query.insert(data_list, **write_options).execute()
+
+    # `execute()` returns an APIResponse object. We need to check its data.
+    # For bulk operations, the response might not directly give individual success/failure for each item
+    # in the same way as some other ORMs. It usually indicates overall success or failure of the batch.
+    # If there's an error in the batch, `response.data` might be empty or `response.error` will be set.
+
+    if minimal_response or (hasattr(response, 'data') and response.data): # Check if data exists and is not empty
+        # For insert/upsert, response.data is usually a list of the inserted/updated records.
+        # With return=minimal the body is empty: the statement is one transaction, so reaching
+        # here means it committed, and count=exact gives the rows written.
+        if minimal_response:
+            success_count = response.count if response.count is not None else len(data_list)
+        else:
+            success_count = len(response.data)
+        if success_count == len(data_list):
+            logging.info(f"Successfully loaded {success_count} records into '{table_name}'.")
+        else:
+            # This part is tricky as Supabase bulk insert might not return partial success info easily.
+            # It often succeeds or fails as a whole batch for typical RLS pass/fail.
+            # If PostgREST error occurs (e.g. constraint violation not covered by upsert), response.error is set.
+            logging.warning(f"Loaded {success_count} records into '{table_name}', but expected {len(data_list)}. Check for potential issues or partial batch processing.")
+            # We assume if response.data is present, those were successful.
+            failure_count = len(data_list) - success_count
+    elif hasattr(response, 'error') and response.error:
+        logging.error(f"Error loading data into '{table_name}': {response.error}")
+        failure_count = len(data_list)
+    else:
+        # This case might occur if the operation was acknowledged but returned no data (e.g. an update that affected 0 rows but didn't error)
+        # or if the response structure is unexpected.
+        logging.warning(f"Data loading into '{table_name}' completed, but response data is empty or error status is unclear. Response: {response}")
+        # Assuming failure if no clear success data
+        failure_count = len(data_list)
+
+    return success_count, failure_count
+
+
+def load_data_to_supabase(table_name: str, data_list: list, conflict_columns: list = None, minimal_response: bool = False):
     """
     Loads a list of dictionaries into the specified Supabase table.
 
@@ -35,6 +172,9 @@ def load_data_to_supabase(table_name: str, data_list: list, conflict_columns: li
         data_list (list): A list of dictionaries, where each dictionary represents a row.
         conflict_columns (list, optional): A list of column names to use for ON CONFLICT 
                                          clause in an upsert operation. If None, a simple insert is performed.
+        minimal_response (bool, optional): Ask PostgREST for `return=minimal` plus `count=exact`, so
+                                         written rows are counted from the Content-Range header instead
+                                         of being echoed back in full (e.g. ShopeePay `raw_body`).
 
     Returns:
         tuple: (success_count, failure_count)
@@ -47,53 +187,100 @@ def load_data_to_supabase(table_name: str, data_list: list, conflict_columns: li
         logging.info(f"No data provided to load into table '{table_name}'.")
         return 0, 0
 
-    success_count = 0
-    failure_count = 0
-
     try:
-        # Supabase client's insert method can handle a list of dicts directly.
-        # For upsert, ensure your Supabase table has the appropriate unique constraints defined on conflict_columns.
-        # Use the configured schema (defaults to 'finance' for lengolf Supabase)
-        table_query = client.schema(SUPABASE_SCHEMA).table(table_name) if SUPABASE_SCHEMA else client.table(table_name)
-
-        if conflict_columns:
-            response = table_query.upsert(data_list, on_conflict=",".join(conflict_columns) if isinstance(conflict_columns, list) else conflict_columns).execute()
-        else:
-            response = table_query.insert(data_list).execute()
-        
-        # `execute()` returns an APIResponse object. We need to check its data.
-        # For bulk operations, the response might not directly give individual success/failure for each item
-        # in the same way as some other ORMs. It usually indicates overall success or failure of the batch.
-        # If there's an error in the batch, `response.data` might be empty or `response.error` will be set.
-        
-        if hasattr(response, 'data') and response.data: # Check if data exists and is not empty
-            # For insert/upsert, response.data is usually a list of the inserted/updated records
-            success_count = len(response.data)
-            if success_count == len(data_list):
-                logging.info(f"Successfully loaded {success_count} records into '{table_name}'.")
-            else:
-                # This part is tricky as Supabase bulk insert might not return partial success info easily.
-                # It often succeeds or fails as a whole batch for typical RLS pass/fail.
-                # If PostgREST error occurs (e.g. constraint violation not covered by upsert), response.error is set.
-                logging.warning(f"Loaded {success_count} records into '{table_name}', but expected {len(data_list)}. Check for potential issues or partial batch processing.")
-                # We assume if response.data is present, those were successful.
-                failure_count = len(data_list) - success_count
-        elif hasattr(response, 'error') and response.error:
-            logging.error(f"Error loading data into '{table_name}': {response.error}")
-            failure_count = len(data_list)
-        else:
-            # This case might occur if the operation was acknowledged but returned no data (e.g. an update that affected 0 rows but didn't error)
-            # or if the response structure is unexpected.
-            logging.warning(f"Data loading into '{table_name}' completed, but response data is empty or error status is unclear. Response: {response}")
-            # Assuming failure if no clear success data
-            failure_count = len(data_list) 
-            
+        return _write_rows(client, table_name, data_list, conflict_columns, minimal_response)
     except Exception as e:
         logging.error(f"Exception during data load to '{table_name}': {e}", exc_info=True)
-        failure_count = len(data_list)
-        success_count = 0 # Ensure success_count is 0 on exception
+        return 0, len(data_list)
 
-    return success_count, failure_count
+
+# SQLSTATE classes a single bad row can cause (22 data exception, 23 integrity
+# constraint violation). Only these are worth bisecting; transport errors, 5xx,
+# auth and PostgREST request errors fail the whole chunk.
+ROW_REJECTION_SQLSTATE_CLASSES = ("22", "23")
+
+
+def _is_row_rejection(error):
+    """True if `error` is PostgREST rejecting the data, i.e. some row in the request is bad."""
+    return isinstance(error, APIError) and str(error.code or "")[:2] in ROW_REJECTION_SQLSTATE_CLASSES
+
+
+def _row_label(record, conflict_columns):
+    """Short identification of a row for logs; never the full record (raw_body can be KBs)."""
+    if conflict_columns:
+        return ", ".join(f"{column}={record.get(column)}" for column in conflict_columns)
+    return f"{len(record)} column(s)"
+
+
+def _load_bisecting(table_name: str, rows: list, conflict_columns: list, minimal_response: bool):
+    """
+    Sends `rows` in one request; if PostgREST rejects the data (SQLSTATE class
+    22/23), splits it in half and retries each half until the failing rows are
+    isolated. Any other error fails the whole chunk without further requests.
+    Returns (success_count, failure_count, failed_records).
+    """
+    try:
+        s_count, f_count = _write_rows(get_supabase_client(), table_name, rows, conflict_columns, minimal_response)
+    except Exception as e:
+        if not _is_row_rejection(e):
+            logging.error(f"Load of {len(rows)} row(s) into '{table_name}' failed: {e!r}")
+            return 0, len(rows), list(rows)
+        if len(rows) == 1:
+            logging.error(f"Row rejected by '{table_name}' ({_row_label(rows[0], conflict_columns)}): {e.code} {e.message}")
+            return 0, 1, list(rows)
+        mid = len(rows) // 2
+        left = _load_bisecting(table_name, rows[:mid], conflict_columns, minimal_response)
+        right = _load_bisecting(table_name, rows[mid:], conflict_columns, minimal_response)
+        return left[0] + right[0], left[1] + right[1], left[2] + right[2]
+    if f_count and not s_count:
+        return 0, len(rows), list(rows)
+    if f_count:
+        # Partially applied; the rows that did not land can't be identified.
+        logging.error(f"{f_count} row(s) of a partially applied write into '{table_name}' could not be identified.")
+        return s_count, f_count, []
+    return s_count, 0, []
+
+
+def load_data_in_chunks(table_name: str, data_list: list, conflict_columns: list = None,
+                        chunk_size: int = None, workers: int = None, minimal_response: bool = False):
+    """
+    Loads `data_list` in chunks of `chunk_size` rows (default SUPABASE_WRITE_BATCH_ROWS),
+    with up to `workers` chunks in flight (default SUPABASE_LOAD_WORKERS). A chunk
+    whose data PostgREST rejects is bisected until the offending rows are
+    isolated, so the good rows still land and only the bad ones are reported;
+    any other failure (network, 5xx, auth) fails the chunk as a whole.
+
+    Returns:
+        tuple: (success_count, failure_count, failed_records)
+    """
+    if not data_list:
+        logging.info(f"No data provided to load into table '{table_name}'.")
+        return 0, 0, []
+    if not get_supabase_client():
+        return 0, len(data_list), list(data_list)
+
+    chunk_size = max(1, chunk_size or SUPABASE_WRITE_BATCH_ROWS)
+    chunks = [data_list[start:start + chunk_size] for start in range(0, len(data_list), chunk_size)]
+    workers = max(1, min(workers or SUPABASE_LOAD_WORKERS, len(chunks)))
+    if workers == 1:
+        results = [_load_bisecting(table_name, chunk, conflict_columns, minimal_response) for chunk in chunks]
+    else:
+        with ThreadPoolExecutor(max_workers=workers, thread_name_prefix="supabase-load") as pool:
+            results = list(pool.map(
+                lambda chunk: _load_bisecting(table_name, chunk, conflict_columns, minimal_response), chunks
+            ))
+
+    success_count = sum(result[0] for result in results)
+    failure_count = sum(result[1] for result in results)
+    failed_records = [record for result in results for record in result[2]]
+    if failure_count:
+        logging.warning(
+            f"Loaded {success_count} of {len(data_list)} records into '{table_name}' in {len(chunks)} chunk(s); "
+            f"{failure_count} failed."
+        )
+    elif len(chunks) > 1:
+        logging.info(f"Loaded {success_count} records into '{table_name}' in {len(chunks)} chunk(s).")
+    return success_count, failure_count, failed_records
 
 
 def _deduplicate_records(data_list: list, unique_keys: list):
@@ -127,23 +314,107 @@ def _deduplicate_records(data_list: list, unique_keys: list):
     return deduplicated_list
 
 
+# Updated Unique Constraint: (`merchant_id`, `report_date`, `process_date`, `tax_invoice_no`)
+# This ensures records with different tax invoice numbers are treated as separate records
+MERCHANT_SUMMARY_CONFLICT_COLUMNS = ['merchant_id', 'report_date', 'process_date', 'tax_invoice_no']
+SHOPEEPAY_SETTLEMENT_CONFLICT_COLUMNS = ['settlement_date']
+
+
+class WriteBuffer:
+    """
+    Run-scoped buffer that coalesces upserts from many reports into a few bulk
+    requests. Rows are collected per (table, conflict columns), deduplicated with
+    _deduplicate_records and sent via load_data_in_chunks, either when a table's
+    buffer holds SUPABASE_WRITE_BATCH_ROWS rows or when the caller flushes at a
+    stage boundary.
+
+    Every `add` names the source item (e.g. one email attachment) its rows came
+    from; `succeeded(source)` then tells whether all of that item's rows landed,
+    so Gmail labeling can be decided per item after the flush.
+    """
+
+    def __init__(self, batch_rows: int = None):
+        self.batch_rows = max(1, batch_rows or SUPABASE_WRITE_BATCH_ROWS)
+        self._pending = {}   # (table_name, conflict_columns) -> [(source, record)]
+        self._outcomes = {}  # source -> True once flushed, False if any of its rows failed
+
+    def add(self, source, table_name: str, records: list, conflict_columns: list):
+        if not records:
+            return
+        key = (table_name, tuple(conflict_columns))
+        pending = self._pending.setdefault(key, [])
+        pending.extend((source, record) for record in records)
+        self._outcomes.setdefault(source, None)
+        if len(pending) >= self.batch_rows:
+            self._flush_table(key)
+
+    def add_merchant_transaction_summaries(self, source, records: list):
+        self.add(source, "merchant_transaction_summaries", records, MERCHANT_SUMMARY_CONFLICT_COLUMNS)
+
+    def flush(self):
+        """Sends every buffered row. Returns (success_count, failure_count) over this flush."""
+        totals = [0, 0]
+        for key in list(self._pending):
+            s_count, f_count = self._flush_table(key)
+            totals[0] += s_count
+            totals[1] += f_count
+        return tuple(totals)
+
+    def is_buffered(self, source):
+        """True if `source` added rows to this buffer."""
+        return source in self._outcomes
+
+    def succeeded(self, source):
+        """After flush(): True if every row `source` added was written, False if any failed."""
+        return self._outcomes.get(source)
+
+    def _flush_table(self, key):
+        table_name, conflict_columns = key
+        entries = self._pending.pop(key, [])
+        if not entries:
+            return 0, 0
+        # Last occurrence wins, as in _deduplicate_records; every source that
+        # contributed a key shares the outcome of the row that is sent.
+        sources_by_key = {}
+        for source, record in entries:
+            sources_by_key.setdefault(tuple(record.get(c) for c in conflict_columns), set()).add(source)
+        records = _deduplicate_records([record for _, record in entries], list(conflict_columns))
+        if len(records) < len(entries):
+            logging.info(f"WriteBuffer: deduplicated {len(entries) - len(records)} buffered row(s) for '{table_name}'.")
+
+        s_total, f_total, failed_records = load_data_in_chunks(
+            table_name, records, list(conflict_columns), chunk_size=self.batch_rows, minimal_response=True
+        )
+        failed_keys = {tuple(record.get(c) for c in conflict_columns) for record in failed_records}
+        # A partially applied chunk that could not be bisected leaves its rows unidentified.
+        unidentified = f_total > len(failed_records)
+        for row_key, sources in sources_by_key.items():
+            row_ok = row_key not in failed_keys and not unidentified
+            for source in sources:
+                self._outcomes[source] = row_ok and self._outcomes.get(source) is not False
+        logging.info(
+            f"WriteBuffer: flushed {len(records)} row(s) to '{table_name}' "
+            f"(success: {s_total}, failed: {f_total})."
+        )
+        return s_total, f_total
+
+
 # Specific functions for each table (optional, but can be convenient)
 def load_merchant_transaction_summaries(data_list: list):
     """Loads data into the merchant_transaction_summaries table."""
-    # Updated Unique Constraint: (`merchant_id`, `report_date`, `process_date`, `tax_invoice_no`)
-    # This ensures records with different tax invoice numbers are treated as separate records
-    conflict_cols = ['merchant_id', 'report_date', 'process_date', 'tax_invoice_no'] 
+    conflict_cols = MERCHANT_SUMMARY_CONFLICT_COLUMNS
     
     # Deduplicate records to prevent "ON CONFLICT DO UPDATE command cannot affect row a second time" error
     deduplicated_data = _deduplicate_records(data_list, conflict_cols)
     if len(deduplicated_data) < len(data_list):
         logging.warning(f"Deduplicated {len(data_list) - len(deduplicated_data)} duplicate records before loading to merchant_transaction_summaries. Original: {len(data_list)}, Deduplicated: {len(deduplicated_data)}")
     
-    return load_data_to_supabase(
+    success_count, failure_count, _ = load_data_in_chunks(
         table_name="merchant_transaction_summaries", 
         data_list=deduplicated_data,
         conflict_columns=conflict_cols
     )
+    return success_count, failure_count
 
 # def load_merchant_payment_type_details(data_list: list):
 #     """Loads data into the merchant_payment_type_details table."""
@@ -155,11 +426,74 @@ def load_merchant_transaction_summaries(data_list: list):
 #         conflict_columns=conflict_cols
 #     )
 
-def get_ewallet_csv_summary(merchant_id: str, process_date: str):
+# Columns of an EWALLET_CSV summary row that the e-Tax PDF paths read.
+EWALLET_CSV_SUMMARY_COLUMNS = "merchant_id,process_date,tax_invoice_no,total_fee_commission_amount,vat_on_fee_amount,net_credit_amount"
+PREFETCH_PAGE_SIZE = 1000
+
+
+def prefetch_ewallet_csv_summaries(merchant_ids, date_from: str, date_to: str):
+    """
+    Loads every EWALLET_CSV summary row for `merchant_ids` with process_date in
+    [date_from, date_to] using one paginated query (EWALLET_CSV_SUMMARY_COLUMNS only).
+
+    Returns a dict (merchant_id, process_date) -> row to pass as `prefetched` to
+    get_ewallet_csv_summary, or None if the DB is unavailable or the query fails
+    (callers then fall back to per-row lookups).
+    """
+    client = get_supabase_client()
+    if not client:
+        return None
+    merchant_ids = sorted(set(merchant_ids))
+    index = {}
+    if not merchant_ids:
+        return index
+    try:
+        table_query = client.schema(SUPABASE_SCHEMA).table("merchant_transaction_summaries") if SUPABASE_SCHEMA else client.table("merchant_transaction_summaries")
+        start = 0
+        while True:
+            response = (
+                table_query
+                .select(EWALLET_CSV_SUMMARY_COLUMNS)
+                .eq("report_source_type", "EWALLET_CSV")
+                .in_("merchant_id", merchant_ids)
+                .gte("process_date", date_from)
+                .lte("process_date", date_to)
+                .order("merchant_id")
+                .order("process_date")
+                .range(start, start + PREFETCH_PAGE_SIZE - 1)
+                .execute()
+            )
+            rows = response.data or []
+            for row in rows:
+                key = (row["merchant_id"], row["process_date"])
+                if key in index:
+                    logging.warning(
+                        f"Multiple EWALLET_CSV rows found for merchant_id={key[0]} process_date={key[1]}; using first."
+                    )
+                    continue
+                index[key] = row
+            if len(rows) < PREFETCH_PAGE_SIZE:
+                break
+            start += PREFETCH_PAGE_SIZE
+        logging.info(
+            f"Prefetched {len(index)} EWALLET_CSV summary row(s) for {len(merchant_ids)} merchant(s), "
+            f"{date_from}..{date_to}."
+        )
+        return index
+    except Exception as e:
+        logging.error(f"Exception prefetching ewallet_csv summaries: {e}", exc_info=True)
+        return None
+
+
+def get_ewallet_csv_summary(merchant_id: str, process_date: str, prefetched: dict = None):
     """
     Reads the EWALLET_CSV summary row for a given merchant + process_date.
+    With `prefetched` (from prefetch_ewallet_csv_summaries, covering this
+    merchant and date) the row comes from that index and no query is made.
     Returns the row dict, or None if not found / DB unavailable.
     """
+    if prefetched is not None:
+        return prefetched.get((merchant_id, process_date))
     client = get_supabase_client()
     if not client:
         return None
@@ -223,6 +557,100 @@ def update_ewallet_csv_tax_invoice_no(merchant_id: str, process_date: str, tax_i
         return 0
 
 
+BULK_TAX_INVOICE_RPC = "set_ewallet_csv_tax_invoice_nos"  # migrations/2026-10-16_set_ewallet_csv_tax_invoice_nos.sql
+BULK_TAX_INVOICE_CHUNK_SIZE = 500
+
+
+def _is_missing_function(error):
+    """True if PostgREST answered that the RPC does not exist (not deployed yet)."""
+    return isinstance(error, APIError) and str(error.code or "") in ("PGRST202", "404")
+
+
+def bulk_update_ewallet_csv_tax_invoice_nos(updates: list) -> dict:
+    """
+    Bulk form of update_ewallet_csv_tax_invoice_no, keeping its NULL-only semantics.
+    `updates` is a list of (merchant_id, process_date, tax_invoice_no).
+    Applies them through the set_ewallet_csv_tax_invoice_nos RPC, one call per
+    BULK_TAX_INVOICE_CHUNK_SIZE rows. If the RPC is not deployed (PGRST202/404)
+    the remaining chunks fall back to per-row updates; any other error marks
+    the chunk "error" so its PDFs are retried on the next run.
+
+    Returns (merchant_id, process_date) -> "updated" | "already_set" | "not_found" | "error".
+    """
+    outcomes = {}
+    if not updates:
+        return outcomes
+    client = get_supabase_client()
+    if not client:
+        return {(merchant_id, process_date): "error" for merchant_id, process_date, _ in updates}
+
+    rpc_deployed = True
+    for start in range(0, len(updates), BULK_TAX_INVOICE_CHUNK_SIZE):
+        chunk = updates[start:start + BULK_TAX_INVOICE_CHUNK_SIZE]
+        if rpc_deployed:
+            payload = [
+                {"merchant_id": merchant_id, "process_date": process_date, "tax_invoice_no": tax_invoice_no}
+                for merchant_id, process_date, tax_invoice_no in chunk
+            ]
+            try:
+                rpc_client = client.schema(SUPABASE_SCHEMA) if SUPABASE_SCHEMA else client
+                response = rpc_client.rpc(BULK_TAX_INVOICE_RPC, {"updates": payload}).execute()
+            except Exception as e:
+                if not _is_missing_function(e):
+                    logging.error(f"{BULK_TAX_INVOICE_RPC} RPC failed for {len(chunk)} row(s): {e}")
+                    for merchant_id, process_date, _ in chunk:
+                        outcomes[(merchant_id, process_date)] = "error"
+                    continue
+                logging.warning(f"{BULK_TAX_INVOICE_RPC} RPC is not deployed ({e}); falling back to "
+                                f"per-row updates.")
+                rpc_deployed = False
+            else:
+                for row in response.data or []:
+                    outcomes[(row["merchant_id"], row["process_date"])] = row["outcome"]
+                for merchant_id, process_date, _ in chunk:
+                    outcomes.setdefault((merchant_id, process_date), "error")
+                continue
+        for merchant_id, process_date, tax_invoice_no in chunk:
+            if update_ewallet_csv_tax_invoice_no(merchant_id, process_date, tax_invoice_no) >= 1:
+                outcomes[(merchant_id, process_date)] = "updated"
+            elif get_ewallet_csv_summary(merchant_id, process_date):
+                outcomes[(merchant_id, process_date)] = "already_set"
+            else:
+                outcomes[(merchant_id, process_date)] = "not_found"
+
+    counts = {}
+    for outcome in outcomes.values():
+        counts[outcome] = counts.get(outcome, 0) + 1
+    logging.info(f"bulk_update_ewallet_csv_tax_invoice_nos: {len(updates)} update(s) -> {counts}")
+    return outcomes
+
+
+def get_shopeepay_gdrive_file_ids(settlement_dates: list):
+    """
+    Reads gdrive_file_id for the given settlement dates in one query.
+    Returns {settlement_date: gdrive_file_id} for rows that have one, or None
+    if the DB is unavailable or the query fails.
+    """
+    client = get_supabase_client()
+    if not client:
+        return None
+    settlement_dates = sorted(set(settlement_dates))
+    if not settlement_dates:
+        return {}
+    try:
+        table_query = client.schema(SUPABASE_SCHEMA).table("shopeepay_daily_settlements") if SUPABASE_SCHEMA else client.table("shopeepay_daily_settlements")
+        response = (
+            table_query
+            .select("settlement_date,gdrive_file_id")
+            .in_("settlement_date", settlement_dates)
+            .execute()
+        )
+        return {row["settlement_date"]: row["gdrive_file_id"] for row in response.data or [] if row.get("gdrive_file_id")}
+    except Exception as e:
+        logging.error(f"Exception reading shopeepay gdrive_file_ids: {e}", exc_info=True)
+        return None
+
+
 def load_shopeepay_settlements(data_list: list):
     """
     Idempotent upsert into finance.shopeepay_daily_settlements.
@@ -232,24 +660,96 @@ def load_shopeepay_settlements(data_list: list):
     would overwrite. The Gmail-label flow prevents reprocessing already-seen
     message IDs, so this is invoked at most once per (settlement_date, message_id).
     """
-    conflict_cols = ['settlement_date']
+    conflict_cols = SHOPEEPAY_SETTLEMENT_CONFLICT_COLUMNS
     deduplicated = _deduplicate_records(data_list, conflict_cols)
     if len(deduplicated) < len(data_list):
         logging.warning(
             f"Deduplicated {len(data_list) - len(deduplicated)} same-day records "
             f"before loading shopeepay_daily_settlements."
         )
-    return load_data_to_supabase(
+    # raw_body is several KB of HTML per row — don't have PostgREST echo it back.
+    success_count, failure_count, _ = load_data_in_chunks(
         table_name="shopeepay_daily_settlements",
         data_list=deduplicated,
         conflict_columns=conflict_cols,
+        minimal_response=True,
+    )
+    return success_count, failure_count
+
+
+SHOPEEPAY_UPSERT_RPC = "upsert_shopeepay_settlements"  # migrations/2026-10-16_upsert_shopeepay_settlements.sql
+
+
+def _upsert_shopeepay_chunk_fallback(chunk):
+    """upsert + gdrive_file_id read for one chunk when the RPC is not deployed."""
+    _, _, failed_records = load_data_in_chunks(
+        table_name="shopeepay_daily_settlements",
+        data_list=chunk,
+        conflict_columns=SHOPEEPAY_SETTLEMENT_CONFLICT_COLUMNS,
+        minimal_response=True,
+    )
+    failed_dates = {record["settlement_date"] for record in failed_records}
+    written = [record["settlement_date"] for record in chunk if record["settlement_date"] not in failed_dates]
+    existing = get_shopeepay_gdrive_file_ids(written)
+    if existing is None:
+        return {}
+    return {settlement_date: existing.get(settlement_date) for settlement_date in written}
+
+
+def upsert_shopeepay_settlements(data_list: list):
+    """
+    Upserts ShopeePay settlement rows through the upsert_shopeepay_settlements
+    RPC, which keeps an existing gdrive_file_id (COALESCE) in the same
+    statement, SUPABASE_WRITE_BATCH_ROWS rows per call. If the RPC is not
+    deployed (PGRST202/404) the remaining chunks fall back to an upsert
+    followed by get_shopeepay_gdrive_file_ids; any other error fails the chunk.
+
+    Returns {settlement_date: gdrive_file_id or None} for every row written
+    (None = still needs archiving); dates missing from it were not written.
+    Returns None if the DB is unavailable.
+    """
+    client = get_supabase_client()
+    if not client:
+        return None
+    records = _deduplicate_records(data_list, SHOPEEPAY_SETTLEMENT_CONFLICT_COLUMNS)
+    archived = {}
+    rpc_deployed = True
+    for start in range(0, len(records), SUPABASE_WRITE_BATCH_ROWS):
+        chunk = records[start:start + SUPABASE_WRITE_BATCH_ROWS]
+        dates = [record["settlement_date"] for record in chunk]
+        if rpc_deployed:
+            try:
+                rpc_client = client.schema(SUPABASE_SCHEMA) if SUPABASE_SCHEMA else client
+                response = rpc_client.rpc(SHOPEEPAY_UPSERT_RPC, {"settlements": chunk}).execute()
+            except Exception as e:
+                if not _is_missing_function(e):
+                    logging.error(f"{SHOPEEPAY_UPSERT_RPC} RPC failed for {len(chunk)} settlement(s) "
+                                  f"({dates[0]}..{dates[-1]}): {e}")
+                    continue
+                logging.warning(f"{SHOPEEPAY_UPSERT_RPC} RPC is not deployed ({e}); falling back to "
+                                f"upsert + gdrive_file_id read.")
+                rpc_deployed = False
+            else:
+                returned = {row["settlement_date"]: row.get("gdrive_file_id") for row in response.data or []
+                            if row.get("settlement_date") in dates}
+                missing = [settlement_date for settlement_date in dates if settlement_date not in returned]
+                if missing:
+                    logging.error(f"{SHOPEEPAY_UPSERT_RPC} returned no row for {len(missing)} settlement(s): "
+                                  f"{', '.join(missing)}.")
+                archived.update(returned)
+                continue
+        archived.update(_upsert_shopeepay_chunk_fallback(chunk))
+    logging.info(
+        f"Upserted {len(archived)} of {len(records)} ShopeePay settlement row(s); "
+        f"{sum(1 for file_id in archived.values() if not file_id)} still to archive."
     )
+    return archived
 
 
 if __name__ == '__main__':
     # Example Usage (Requires Supabase to be set up and .env file configured)
     logging.info("db_loader.py executed directly for testing.")
-    if not supabase_client:
+    if not get_supabase_client():
         logging.error("Supabase client not available. Aborting test.")
     else:
         # Test data for merchant_transaction_summaries
@@ -1,5 +1,13 @@
 import os.path
+import atexit
 import base64
+import hashlib
+import json
+import re
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
 from google.auth.transport.requests import Request
 from google.oauth2.service_account import Credentials
 from google_auth_oauthlib.flow import InstalledAppFlow
@@ -7,6 +15,8 @@ from googleapiclient.discovery import build
 from googleapiclient.errors import HttpError
 import logging
 from . import config
+from . import google_services
+from . import rate_limiter
 
 # Scopes for Gmail API - adjusted for service account usage
 SCOPES = ['https://www.googleapis.com/auth/gmail.modify']
@@ -22,6 +32,54 @@ LABEL_SHOPEEPAY_EMAIL_PROCESSED = "SHOPEEPAY_EMAIL_PROCESSED"
 LABEL_SHOPEEPAY_EMAIL_FAILED = "SHOPEEPAY_EMAIL_FAILED"
 LABEL_SHOPEEPAY_EMAIL_NEEDS_REVIEW = "SHOPEEPAY_EMAIL_NEEDS_REVIEW"
 
+# Every label the pipeline reads or writes; resolved in one go at startup.
+ALL_LABELS = (
+    LABEL_PROCESSED,
+    LABEL_FAILED,
+    LABEL_EWALLET_CSV_PROCESSED,
+    LABEL_EWALLET_ETAX_PDF_PROCESSED,
+    LABEL_SHOPEEPAY_EMAIL_PROCESSED,
+    LABEL_SHOPEEPAY_EMAIL_FAILED,
+    LABEL_SHOPEEPAY_EMAIL_NEEDS_REVIEW,
+)
+
+LABEL_CACHE_FILENAME = "gmail_label_ids.json"
+
+# Built-in labels whose ID is their name; never listed or created.
+SYSTEM_LABEL_IDS = frozenset({"UNREAD", "INBOX", "STARRED", "IMPORTANT", "SPAM", "TRASH"})
+
+GMAIL_SYNC_STATE_FILENAME = "gmail_sync_state.json"
+# Incremental searches look back this far before the previous sync so clock
+# skew and Gmail's coarse `after:` indexing can't drop a message.
+SYNC_OVERLAP_SECONDS = 3600
+
+# Partial-response projections (`fields=`) per call site: every request asks
+# only for what its caller reads.
+GMAIL_FIELDS = {
+    'messages.list':            'messages(id),nextPageToken',
+    'messages.get.attachments': 'payload(parts(filename,body(attachmentId,data)))',
+    'messages.get.body':        'id,payload(mimeType,headers(name,value),body/data,parts)',
+    'messages.get.routing':     'id,labelIds,payload(mimeType,headers(name,value),body/data,parts)',
+    'messages.get.labels':      'labelIds',
+    'messages.modify':          'id',
+    'attachments.get':          'data',
+    'labels.list':              'labels(id,name)',
+    'labels.create':            'id',
+    'history.list':             'history(messagesAdded/message/id,labelsRemoved/labelIds),nextPageToken',
+    'profile':                  'historyId',
+}
+
+# Attachment data is decoded this many base64 characters at a time (must be a
+# multiple of 4), so only ~768 KiB of decoded bytes is held at once.
+BASE64_DECODE_CHUNK_CHARS = 1 << 20
+
+# Rounds of re-batching for sub-requests of a Gmail HTTP batch that fail with
+# a retryable status (see rate_limiter.is_retryable).
+BATCH_MAX_ATTEMPTS = 4
+
+# users().messages().batchModify accepts at most this many message IDs per call.
+BATCH_MODIFY_MAX_IDS = 1000
+
 # Default paths - these will be overridden by arguments in functions
 DEFAULT_CREDENTIALS_FILE = 'credentials.json'
 DEFAULT_TOKEN_FILE = 'token.json'
@@ -60,33 +118,223 @@ def get_gmail_service():
         logger.error(f"Failed to build Gmail service: {e}")
         return None
 
+def _search_all_pages(service, query):
+    """Pages users().messages().list for `query`. HttpError propagates."""
+    response = rate_limiter.gmail(
+        service.users().messages().list(userId='me', q=query, fields=GMAIL_FIELDS['messages.list']), 'messages.list')
+    messages = []
+    if 'messages' in response:
+        messages.extend(response['messages'])
+    while 'nextPageToken' in response:
+        page_token = response['nextPageToken']
+        response = rate_limiter.gmail(service.users().messages().list(
+            userId='me', q=query, pageToken=page_token, fields=GMAIL_FIELDS['messages.list']), 'messages.list')
+        if 'messages' in response:
+            messages.extend(response['messages'])
+    logger.info(f"Found {len(messages)} messages matching query: '{query}'")
+    return messages
+
 def search_emails(service, query):
     """Search for emails matching the query."""
     try:
-        response = service.users().messages().list(userId='me', q=query).execute()
-        messages = []
-        if 'messages' in response:
-            messages.extend(response['messages'])
-        while 'nextPageToken' in response:
-            page_token = response['nextPageToken']
-            response = service.users().messages().list(userId='me', q=query, pageToken=page_token).execute()
-            if 'messages' in response:
-                messages.extend(response['messages'])
-        logger.info(f"Found {len(messages)} messages matching query: '{query}'")
-        return messages
+        return _search_all_pages(service, query)
     except HttpError as error:
         logger.error(f'An error occurred searching emails with query "{query}": {error}')
         return []
 
-def download_specific_attachments(service, message_id, download_to_dir, desired_filename_extension=".zip"):
-    """Download specific attachments (e.g., only .zip files) from a message."""
+# --- Incremental sync ---
+# Per final query we persist {history_id, synced_at, last_seen}. A later run asks
+# users().history().list what changed since history_id: nothing -> no search at
+# all; new mail -> a search bounded by `after:synced_at`; our processed label
+# removed from something (e.g. scripts/reprocess_shopeepay_history.py) or an
+# expired watermark (404) -> the original full search. Messages returned last
+# time that still lack the processed label (RETRY / FAILED items) are carried
+# forward so they keep being retried exactly as the full search would.
+_sync_state_lock = threading.Lock()
+
+
+def _sync_state_path():
+    return os.path.join(config.LOCAL_STATE_DIR, GMAIL_SYNC_STATE_FILENAME)
+
+
+def _load_sync_state():
+    path = _sync_state_path()
+    try:
+        with open(path, encoding="utf-8") as f:
+            state = json.load(f)
+    except FileNotFoundError:
+        return {}
+    except (OSError, ValueError) as e:
+        logger.warning(f"Ignoring unreadable Gmail sync state {path}: {e}")
+        return {}
+    if state.get("user") != config.GMAIL_USER_EMAIL:
+        return {}
+    return state.get("queries") or {}
+
+
+def _save_sync_entry(final_query, history_id, pending_ids):
+    entry = {'history_id': history_id, 'synced_at': int(time.time()), 'last_seen': list(pending_ids)}
+    with _sync_state_lock:
+        queries = _load_sync_state()
+        queries[final_query] = entry
+        path = _sync_state_path()
+        try:
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            tmp_path = f"{path}.tmp"
+            with open(tmp_path, "w", encoding="utf-8") as f:
+                json.dump({"user": config.GMAIL_USER_EMAIL, "queries": queries}, f)
+            os.replace(tmp_path, path)
+        except OSError as e:
+            logger.warning(f"Could not persist Gmail sync state to {path}: {e}")
+
+
+def _history_changes(service, start_history_id, watched_label_ids):
+    """
+    Pages users().history().list from start_history_id.
+    Returns (messages_added: bool, watched_label_removed: bool).
+    Raises HttpError (404) when the watermark is too old.
+    """
+    watched_label_ids = set(watched_label_ids)
+    messages_added = False
+    watched_label_removed = False
+    page_token = None
+    while True:
+        response = rate_limiter.gmail(service.users().history().list(
+            userId='me',
+            startHistoryId=start_history_id,
+            historyTypes=['messageAdded', 'labelRemoved'],
+            pageToken=page_token,
+            fields=GMAIL_FIELDS['history.list'],
+        ), 'history.list')
+        for record in response.get('history', []):
+            if record.get('messagesAdded'):
+                messages_added = True
+            for removed in record.get('labelsRemoved', []):
+                if watched_label_ids.intersection(removed.get('labelIds', [])):
+                    watched_label_removed = True
+        page_token = response.get('nextPageToken')
+        if not page_token:
+            return messages_added, watched_label_removed
+
+
+def _still_unprocessed(service, message_ids, processed_label_id):
+    """Filters message_ids down to those that still exist and lack processed_label_id."""
+    pending = []
+    for message_id in message_ids:
+        try:
+            message = rate_limiter.gmail(service.users().messages().get(
+                userId='me', id=message_id, format='minimal', fields=GMAIL_FIELDS['messages.get.labels']
+            ), 'messages.get')
+        except HttpError as error:
+            if error.resp.status == 404:
+                continue
+            raise
+        if processed_label_id not in message.get('labelIds', []):
+            pending.append({'id': message_id})
+    return pending
+
+
+def _incremental_search(service, final_query, processed_labels, entry):
+    """Returns the messages new since `entry`, or None when a full search is needed."""
+    watched_label_ids = resolve_label_ids(service, processed_labels).values()
+    try:
+        messages_added, label_removed = _history_changes(service, entry['history_id'], watched_label_ids)
+    except HttpError as error:
+        if error.resp.status != 404:
+            raise
+        logger.info(f"Gmail history watermark {entry['history_id']} expired; using full search.")
+        return None
+    if label_removed:
+        logger.info(f"One of {list(processed_labels)} was removed from some message since last sync; using full search.")
+        return None
+    if messages_added:
+        after = int(entry['synced_at']) - SYNC_OVERLAP_SECONDS
+        return _search_all_pages(service, f"{final_query} after:{after}")
+    logger.info(f"No mailbox changes since historyId {entry['history_id']} for query: '{final_query}'")
+    return []
+
+
+def _sync_candidates(service, final_query, processed_labels):
+    """
+    Candidate messages for `final_query` (which already excludes the processed
+    labels). Returns (messages, carried_ids, history_id):
+        messages    — new since the stored watermark, or the full search result
+        carried_ids — returned last run, not re-found now and not yet known to be
+                      processed; the caller decides whether they are still pending
+        history_id  — snapshot to store with _save_sync_entry once the caller
+                      knows which IDs are still pending
+    HttpError propagates.
+    """
+    # Snapshot before searching so mail arriving mid-search is seen next run.
+    history_id = rate_limiter.gmail(
+        service.users().getProfile(userId='me', fields=GMAIL_FIELDS['profile']), 'getProfile')['historyId']
+    entry = _load_sync_state().get(final_query)
+    messages = _incremental_search(service, final_query, processed_labels, entry) if entry else None
+    if messages is None:
+        return _search_all_pages(service, final_query), [], history_id
+    seen = {m['id'] for m in messages}
+    carried = [mid for mid in entry.get('last_seen', []) if mid not in seen]
+    return messages, carried, history_id
+
+
+def search_new_messages(service, search_query, processed_label):
+    """
+    Returns [{'id': ...}] for messages matching `search_query` that don't carry
+    `processed_label` — the same result as search_emails(service,
+    f"{search_query} -label:{processed_label}"), but using a persisted historyId
+    watermark so a run with no new mail costs a couple of calls regardless of
+    mailbox size. Falls back to the full search on the first run, when the
+    watermark has expired, or when GMAIL_INCREMENTAL_SYNC is off.
+    """
+    final_query = f"{search_query} -label:{processed_label}"
+    if not config.GMAIL_INCREMENTAL_SYNC:
+        return search_emails(service, final_query)
+
+    try:
+        messages, carried, history_id = _sync_candidates(service, final_query, (processed_label,))
+        messages.extend(_still_unprocessed(service, carried, get_label_id(service, processed_label)))
+    except HttpError as error:
+        # Leave the watermark untouched so the next run covers this window again.
+        logger.error(f'An error occurred searching emails with query "{final_query}": {error}')
+        return []
+
+    _save_sync_entry(final_query, history_id, [m['id'] for m in messages])
+    return messages
+
+def _write_base64url_to_file(data, fileobj, chunk_chars=BASE64_DECODE_CHUNK_CHARS):
+    """
+    Decodes Gmail's URL-safe base64 `data` into `fileobj` chunk by chunk,
+    hashing as it goes. Returns (bytes_written, sha256_hexdigest).
+    """
+    if chunk_chars % 4:
+        raise ValueError("chunk_chars must be a multiple of 4")
+    digest = hashlib.sha256()
+    bytes_written = 0
+    for start in range(0, len(data), chunk_chars):
+        chunk = data[start:start + chunk_chars]
+        if start + chunk_chars >= len(data):
+            chunk += '=' * (-len(chunk) % 4)  # tolerate stripped padding on the tail
+        decoded = base64.urlsafe_b64decode(chunk)
+        digest.update(decoded)
+        fileobj.write(decoded)
+        bytes_written += len(decoded)
+    return bytes_written, digest.hexdigest()
+
+def download_specific_attachments(service, message_id, download_to_dir, desired_filename_extension=".zip", message=None):
+    """
+    Download specific attachments (e.g., only .zip files) from a message.
+    Pass `message` when its payload has already been fetched to skip the messages().get.
+    """
     try:
-        message = service.users().messages().get(userId='me', id=message_id).execute()
+        if message is None:
+            message = rate_limiter.gmail(service.users().messages().get(
+                userId='me', id=message_id, fields=GMAIL_FIELDS['messages.get.attachments']
+            ), 'messages.get')
         parts = message['payload'].get('parts', [])
         downloaded_files_info = []
 
         if not os.path.exists(download_to_dir):
-            os.makedirs(download_to_dir)
+            os.makedirs(download_to_dir, exist_ok=True)
             logger.info(f"Created download directory: {download_to_dir}")
 
         for part in parts:
@@ -96,16 +344,34 @@ def download_specific_attachments(service, message_id, download_to_dir, desired_
                     data = part['body']['data']
                 else:
                     att_id = part['body']['attachmentId']
-                    att = service.users().messages().attachments().get(userId='me', messageId=message_id, id=att_id).execute()
-                    data = att['data']
+                    att = rate_limiter.gmail(service.users().messages().attachments().get(
+                        userId='me', messageId=message_id, id=att_id, fields=GMAIL_FIELDS['attachments.get']
+                    ), 'attachments.get')
+                    data = att.pop('data')
+                    del att
                 
-                file_data = base64.urlsafe_b64decode(data.encode('UTF-8'))
                 path = os.path.join(download_to_dir, filename)
                 
-                with open(path, 'wb') as f:
-                    f.write(file_data)
-                downloaded_files_info.append({'message_id': message_id, 'filename': filename, 'path': path})
-                logger.info(f"Downloaded attachment: {filename} to {path} for message ID: {message_id}")
+                # Decode straight into the file (no full decoded copy in memory),
+                # via write-then-rename: concurrent downloads of a duplicate resend
+                # with the same attachment name must not interleave bytes.
+                fd, tmp_path = tempfile.mkstemp(dir=download_to_dir, prefix=f".{filename}.", suffix=".part")
+                try:
+                    with os.fdopen(fd, 'wb') as f:
+                        size, sha256 = _write_base64url_to_file(data, f)
+                    os.replace(tmp_path, path)
+                finally:
+                    del data
+                    if os.path.exists(tmp_path):
+                        os.remove(tmp_path)
+                downloaded_files_info.append({
+                    'message_id': message_id,
+                    'filename': filename,
+                    'path': path,
+                    'size': size,
+                    'sha256': sha256,
+                })
+                logger.info(f"Downloaded attachment: {filename} ({size} bytes, sha256 {sha256[:12]}) to {path} for message ID: {message_id}")
         
         return downloaded_files_info
     except HttpError as error:
@@ -115,38 +381,170 @@ def download_specific_attachments(service, message_id, download_to_dir, desired_
 def mark_email_as_read(service, message_id):
     """Marks an email as read by removing the UNREAD label."""
     try:
-        service.users().messages().modify(
+        rate_limiter.gmail(service.users().messages().modify(
             userId='me',
             id=message_id,
-            body={'removeLabelIds': ['UNREAD']}
-        ).execute()
+            body={'removeLabelIds': ['UNREAD']},
+            fields=GMAIL_FIELDS['messages.modify'],
+        ), 'messages.modify')
         logger.info(f"Marked message {message_id} as read.")
         return True
     except HttpError as error:
         logger.error(f'An error occurred trying to mark message {message_id} as read: {error}')
         return False
 
+# --- Label registry ---
+# Label name -> ID for the whole process. Populated by a single labels().list
+# call (or from the persisted copy under LOCAL_STATE_DIR while it is younger
+# than GMAIL_LABEL_CACHE_TTL_SECONDS) instead of one list call per add/remove.
+_label_ids = {}
+_label_ids_listed = False  # True once this process has done a live labels().list
+_label_lock = threading.Lock()
+
+
+def _label_cache_path():
+    return os.path.join(config.LOCAL_STATE_DIR, LABEL_CACHE_FILENAME)
+
+
+def _load_persisted_label_ids():
+    """Returns the persisted name -> ID map, or {} if missing, expired or for another mailbox."""
+    ttl = config.GMAIL_LABEL_CACHE_TTL_SECONDS
+    path = _label_cache_path()
+    if ttl <= 0 or not os.path.exists(path):
+        return {}
+    try:
+        with open(path, encoding="utf-8") as f:
+            cached = json.load(f)
+    except (OSError, ValueError) as e:
+        logger.warning(f"Ignoring unreadable label cache {path}: {e}")
+        return {}
+    if cached.get("user") != config.GMAIL_USER_EMAIL:
+        return {}
+    if time.time() - cached.get("saved_at", 0) > ttl:
+        logger.info("Persisted Gmail label cache expired; will re-list labels.")
+        return {}
+    return cached.get("labels") or {}
+
+
+def _persist_label_ids():
+    if config.GMAIL_LABEL_CACHE_TTL_SECONDS <= 0:
+        return
+    path = _label_cache_path()
+    try:
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        tmp_path = f"{path}.tmp"
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            json.dump({"user": config.GMAIL_USER_EMAIL, "saved_at": time.time(), "labels": _label_ids}, f)
+        os.replace(tmp_path, path)
+    except OSError as e:
+        logger.warning(f"Could not persist Gmail label cache to {path}: {e}")
+
+
+def _list_label_ids(service):
+    """One labels().list round-trip; replaces the in-memory registry."""
+    global _label_ids_listed
+    labels_response = rate_limiter.gmail(
+        service.users().labels().list(userId='me', fields=GMAIL_FIELDS['labels.list']), 'labels.list')
+    _label_ids.clear()
+    _label_ids.update({label['name']: label['id'] for label in labels_response.get('labels', [])})
+    _label_ids_listed = True
+    logger.info(f"Resolved {len(_label_ids)} Gmail label IDs with one labels().list call.")
+
+
+def _create_label(service, label_name):
+    logger.info(f"Label '{label_name}' not found. Creating it.")
+    new_label = {
+        'name': label_name,
+        'labelListVisibility': 'labelShow',
+        'messageListVisibility': 'show'
+    }
+    try:
+        created_label = rate_limiter.gmail(service.users().labels().create(
+            userId='me', body=new_label, fields=GMAIL_FIELDS['labels.create']), 'labels.create')
+    except HttpError as error:
+        if error.resp.status != 409:
+            raise
+        # Someone else created it since our listing — the registry is stale.
+        logger.info(f"Label '{label_name}' already exists (409); re-listing labels.")
+        _list_label_ids(service)
+        return _label_ids.get(label_name)
+    logger.info(f"Label '{label_name}' created with ID: {created_label['id']}")
+    return created_label['id']
+
+
+def resolve_label_ids(service, label_names=ALL_LABELS):
+    """
+    Resolves label names to IDs, creating any that don't exist yet.
+    Costs at most one labels().list per process (zero while the persisted cache
+    is fresh), plus one labels().create per missing label.
+    Returns a dict of name -> ID; names that could not be resolved are omitted.
+    """
+    with _label_lock:
+        if not _label_ids and not _label_ids_listed:
+            _label_ids.update(_load_persisted_label_ids())
+        try:
+            missing = [name for name in label_names if name not in _label_ids]
+            if missing and not _label_ids_listed:
+                _list_label_ids(service)
+                _persist_label_ids()
+                missing = [name for name in label_names if name not in _label_ids]
+            for name in missing:
+                label_id = _create_label(service, name)
+                if label_id:
+                    _label_ids[name] = label_id
+            if missing:
+                _persist_label_ids()
+        except HttpError as error:
+            logger.error(f'An error occurred while resolving labels {list(label_names)}: {error}')
+        return {name: _label_ids[name] for name in label_names if name in _label_ids}
+
+
+def invalidate_label_cache():
+    """Drops the in-memory and persisted label registry; the next lookup re-lists."""
+    global _label_ids_listed
+    with _label_lock:
+        _label_ids.clear()
+        _label_ids_listed = False
+        try:
+            os.remove(_label_cache_path())
+        except FileNotFoundError:
+            pass
+        except OSError as e:
+            logger.warning(f"Could not remove Gmail label cache: {e}")
+
+
 def get_label_id(service, label_name):
     """Gets the ID of a label by its name. Creates the label if it doesn't exist."""
+    return resolve_label_ids(service, (label_name,)).get(label_name)
+
+
+def _is_stale_label_error(error):
+    # A cached ID for a label that was deleted in the Gmail UI comes back as
+    # 400 "Invalid label: <id>". Other 400s and message-level 404s (e.g. a
+    # message deleted meanwhile) would fail again, so they don't invalidate.
+    if error.resp.status != 400 or not _label_ids:
+        return False
+    content = error.content.decode('utf-8', 'replace') if isinstance(error.content, bytes) else str(error.content)
+    return 'label' in f"{error.error_details} {content}".lower()
+
+def _modify_labels(service, message_id, body):
     try:
-        labels_response = service.users().labels().list(userId='me').execute()
-        labels = labels_response.get('labels', [])
-        for label in labels:
-            if label['name'] == label_name:
-                return label['id']
-        
-        logger.info(f"Label '{label_name}' not found. Creating it.")
-        new_label = {
-            'name': label_name,
-            'labelListVisibility': 'labelShow',
-            'messageListVisibility': 'show'
-        }
-        created_label = service.users().labels().create(userId='me', body=new_label).execute()
-        logger.info(f"Label '{label_name}' created with ID: {created_label['id']}")
-        return created_label['id']
+        rate_limiter.gmail(service.users().messages().modify(
+            userId='me', id=message_id, body=body, fields=GMAIL_FIELDS['messages.modify']), 'messages.modify')
     except HttpError as error:
-        logger.error(f'An error occurred while getting/creating label {label_name}: {error}')
-        return None
+        if not _is_stale_label_error(error):
+            raise
+        logger.warning(f"Label ID rejected for message {message_id}; refreshing label cache and retrying once.")
+        label_names = {v: k for k, v in _label_ids.items()}
+        invalidate_label_cache()
+        retry_body = {}
+        for key, ids in body.items():
+            names = [label_names.get(label_id, label_id) for label_id in ids]
+            resolved = resolve_label_ids(service, names)
+            retry_body[key] = [resolved.get(name, name) for name in names]
+        rate_limiter.gmail(service.users().messages().modify(
+            userId='me', id=message_id, body=retry_body, fields=GMAIL_FIELDS['messages.modify']
+        ), 'messages.modify')
 
 def add_label_to_email(service, message_id, label_name):
     """Adds a label to the specified email message."""
@@ -155,11 +553,7 @@ def add_label_to_email(service, message_id, label_name):
         logger.error(f"Could not get or create label ID for '{label_name}'. Cannot add label to message {message_id}.")
         return False
     try:
-        service.users().messages().modify(
-            userId='me',
-            id=message_id,
-            body={'addLabelIds': [label_id]}
-        ).execute()
+        _modify_labels(service, message_id, {'addLabelIds': [label_id]})
         logger.info(f"Added label '{label_name}' to message {message_id}.")
         return True
     except HttpError as error:
@@ -173,17 +567,114 @@ def remove_label_from_email(service, message_id, label_name):
         logger.warning(f"Label '{label_name}' does not exist or couldn't be fetched. Cannot remove from message {message_id}.")
         return False 
     try:
-        service.users().messages().modify(
-            userId='me',
-            id=message_id,
-            body={'removeLabelIds': [label_id]}
-        ).execute()
+        _modify_labels(service, message_id, {'removeLabelIds': [label_id]})
         logger.info(f"Removed label '{label_name}' from message {message_id}.")
         return True
     except HttpError as error:
         logger.error(f"An error occurred trying to remove label '{label_name}' from message {message_id}: {error}")
         return False
 
+class LabelMutationBatch:
+    """
+    Collects label changes per message during a run and applies them at the end
+    with users().messages().batchModify, one call per distinct (add, remove)
+    label set and per BATCH_MODIFY_MAX_IDS messages.
+
+    Later changes for the same message win (adding a label cancels a queued
+    removal of it and vice versa). flush() is idempotent and is also registered
+    with atexit, so changes queued before an unhandled exception still land.
+    """
+
+    def __init__(self, service):
+        self.service = service
+        self._pending = {}  # message_id -> (set of labels to add, set of labels to remove)
+        self._lock = threading.Lock()
+        atexit.register(self.flush)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.flush()
+        return False
+
+    def _entry(self, message_id):
+        return self._pending.setdefault(message_id, (set(), set()))
+
+    def add_labels(self, message_id, *label_names):
+        with self._lock:
+            add, remove = self._entry(message_id)
+            add.update(label_names)
+            remove.difference_update(label_names)
+
+    def remove_labels(self, message_id, *label_names):
+        with self._lock:
+            add, remove = self._entry(message_id)
+            remove.update(label_names)
+            add.difference_update(label_names)
+
+    def mark_as_read(self, message_id):
+        self.remove_labels(message_id, "UNREAD")
+
+    def __len__(self):
+        return len(self._pending)
+
+    def _resolve(self, label_names):
+        user_labels = [name for name in label_names if name not in SYSTEM_LABEL_IDS]
+        resolved = resolve_label_ids(self.service, user_labels) if user_labels else {}
+        missing = [name for name in user_labels if name not in resolved]
+        if missing:
+            raise ValueError(f"Could not resolve label IDs for {missing}")
+        return sorted(resolved.get(name, name) for name in label_names)
+
+    def _batch_modify(self, message_ids, add_names, remove_names):
+        body = {
+            'ids': message_ids,
+            'addLabelIds': self._resolve(add_names),
+            'removeLabelIds': self._resolve(remove_names),
+        }
+        try:
+            rate_limiter.gmail(self.service.users().messages().batchModify(userId='me', body=body), 'messages.batchModify')
+        except HttpError as error:
+            if not _is_stale_label_error(error):
+                raise
+            logger.warning("Label ID rejected by batchModify; refreshing label cache and retrying once.")
+            invalidate_label_cache()
+            body['addLabelIds'] = self._resolve(add_names)
+            body['removeLabelIds'] = self._resolve(remove_names)
+            rate_limiter.gmail(self.service.users().messages().batchModify(userId='me', body=body), 'messages.batchModify')
+
+    def flush(self):
+        """
+        Applies every queued change. Returns (applied_count, failed_message_ids).
+        Messages in a failed chunk are logged and dropped from the queue; the
+        pipeline is idempotent, so they are simply picked up again next run.
+        """
+        with self._lock:
+            pending, self._pending = self._pending, {}
+        groups = {}
+        for message_id, (add, remove) in pending.items():
+            if add or remove:
+                groups.setdefault((frozenset(add), frozenset(remove)), []).append(message_id)
+
+        applied = 0
+        failed = []
+        for (add, remove), message_ids in groups.items():
+            for start in range(0, len(message_ids), BATCH_MODIFY_MAX_IDS):
+                chunk = message_ids[start:start + BATCH_MODIFY_MAX_IDS]
+                try:
+                    self._batch_modify(chunk, add, remove)
+                    applied += len(chunk)
+                    logger.info(
+                        f"batchModify: {len(chunk)} message(s) +{sorted(add)} -{sorted(remove)}"
+                    )
+                except (HttpError, ValueError) as error:
+                    failed.extend(chunk)
+                    logger.error(
+                        f"batchModify failed for {len(chunk)} message(s) +{sorted(add)} -{sorted(remove)}: {error}"
+                    )
+        return applied, failed
+
 def fetch_new_reports(service, search_query, download_to_dir, attachment_config):
     """
     Fetches new emails based on query, downloads specific attachments based on attachment_config,
@@ -204,27 +695,49 @@ def fetch_new_reports(service, search_query, download_to_dir, attachment_config)
     processed_label_name = attachment_config['processed_label']
     final_query = f"{search_query} -label:{processed_label_name}"
     
-    messages = search_emails(service, final_query)
-    all_downloaded_files = []
+    messages = search_new_messages(service, search_query, processed_label_name)
     if not messages:
         logger.info(f"No new messages found matching the query: {final_query} for report type: {attachment_config['report_type']}")
-        return all_downloaded_files
+        return []
+
+    return _download_attachment_reports(
+        service, [message_summary['id'] for message_summary in messages], download_to_dir, attachment_config
+    )
 
+
+def _download_attachment_reports(service, message_ids, download_to_dir, attachment_config, prefetched=None):
+    """
+    Downloads the desired attachment of each message (in parallel, see
+    GMAIL_DOWNLOAD_WORKERS) and returns the fetch_new_reports result dicts.
+    `prefetched` maps message_id -> message resource already holding the payload.
+    """
+    prefetched = prefetched or {}
+    processed_label_name = attachment_config['processed_label']
     desired_extension = attachment_config['desired_filename_extension']
     report_type = attachment_config['report_type']
     file_path_key = attachment_config['file_path_key']
+    all_downloaded_files = []
 
-    for message_summary in messages:
-        message_id = message_summary['id']
+    def download(message_id):
         logger.info(f"Processing message ID: {message_id} for report type: {report_type}")
-        
-        downloaded_attachments_info = download_specific_attachments(
-            service, 
+        return download_specific_attachments(
+            google_services.worker_service(service, 'gmail', 'v1') if parallel else service,
             message_id, 
             download_to_dir, 
-            desired_filename_extension=desired_extension
+            desired_filename_extension=desired_extension,
+            message=prefetched.get(message_id),
         )
-        
+
+    workers = min(config.GMAIL_DOWNLOAD_WORKERS, len(message_ids))
+    parallel = workers > 1 and google_services.service_credentials(service) is not None
+    if parallel:
+        logger.info(f"Downloading {len(message_ids)} {report_type} message(s) with {workers} workers.")
+        with ThreadPoolExecutor(max_workers=workers, thread_name_prefix="gmail-download") as pool:
+            downloads = list(pool.map(download, message_ids))
+    else:
+        downloads = [download(message_id) for message_id in message_ids]
+
+    for message_id, downloaded_attachments_info in zip(message_ids, downloads):
         for attachment_info in downloaded_attachments_info:
             # Ensure only one attachment of the desired type is processed per email,
             # or adjust if multiple attachments of the same type per email are expected.
@@ -234,6 +747,7 @@ def fetch_new_reports(service, search_query, download_to_dir, attachment_config)
                     'message_id': message_id,
                     file_path_key: attachment_info['path'],
                     'original_filename': attachment_info['filename'],
+                    'content_sha256': attachment_info['sha256'],
                     'report_type': report_type,
                     'processed_label': processed_label_name # Pass along for potential use in main
                 })
@@ -323,6 +837,83 @@ def _extract_plaintext_from_payload(payload):
     return _extract_message_bodies(payload)["stripped"]
 
 
+def batch_get_messages(service, message_ids, batch_size=None, **get_kwargs):
+    """
+    Fetches messages with users().messages().get grouped into Gmail HTTP batch
+    requests of `batch_size` (default GMAIL_BATCH_SIZE). Each batch is charged
+    to the Gmail rate limiter per sub-request; sub-requests that fail with a
+    retryable status (429/5xx) are re-batched with exponential backoff and
+    jitter, up to BATCH_MAX_ATTEMPTS rounds.
+
+    Returns a dict of message_id -> message resource. IDs that could not be
+    fetched are logged and left out.
+    """
+    batch_size = max(1, min(batch_size or config.GMAIL_BATCH_SIZE, 100))
+    results = {}
+    pending = list(dict.fromkeys(message_ids))
+    limiter = rate_limiter.get_limiter('gmail')
+
+    for attempt in range(BATCH_MAX_ATTEMPTS):
+        if not pending:
+            break
+        if attempt:
+            time.sleep(rate_limiter.backoff_delay(attempt))
+            logger.info(f"Retrying {len(pending)} message get(s) (attempt {attempt + 1}/{BATCH_MAX_ATTEMPTS}).")
+        retry = []
+        throttled = []
+
+        def on_response(request_id, response, exception):
+            if exception is None:
+                results[request_id] = response
+            elif isinstance(exception, HttpError) and rate_limiter.is_retryable(exception):
+                retry.append(request_id)
+                if rate_limiter.is_throttled(exception):
+                    throttled.append(request_id)
+            else:
+                logger.error(f"Failed to fetch message {request_id}: {exception}")
+
+        for start in range(0, len(pending), batch_size):
+            chunk = pending[start:start + batch_size]
+            batch = service.new_batch_http_request(callback=on_response)
+            for message_id in chunk:
+                batch.add(service.users().messages().get(userId='me', id=message_id, **get_kwargs), request_id=message_id)
+            limiter.acquire(rate_limiter.GMAIL_QUOTA_UNITS['messages.get'] * len(chunk))
+            try:
+                batch.execute()
+            except HttpError as error:
+                if rate_limiter.is_throttled(error):
+                    throttled.append(None)
+                if not rate_limiter.is_retryable(error):
+                    logger.error(f"Gmail batch of {len(chunk)} message get(s) failed: {error}")
+                    continue
+                retry.extend(mid for mid in chunk if mid not in results and mid not in retry)
+            finally:
+                limiter.release()
+        if throttled:
+            limiter.on_throttle()
+        pending = retry
+
+    for message_id in pending:
+        logger.error(f"Giving up on message {message_id} after {BATCH_MAX_ATTEMPTS} attempts.")
+    return results
+
+
+def _body_only_report(full, processed_label):
+    """Builds the fetch_new_body_only_reports result dict from a format=full message."""
+    headers = {h["name"]: h["value"] for h in full["payload"].get("headers", [])}
+    bodies = _extract_message_bodies(full["payload"])
+    return {
+        "message_id": full["id"],
+        "subject": headers.get("Subject", ""),
+        "date_header": headers.get("Date", ""),
+        "body_text": bodies["stripped"],   # parser-friendly
+        "body_raw": bodies["raw"],          # original HTML/plain — persisted for audit
+        "body_kind": bodies["kind"],        # 'plain' | 'html' | 'empty'
+        "processed_label": processed_label,
+        "report_type": "BODY_ONLY",
+    }
+
+
 def fetch_new_body_only_reports(service, search_query, processed_label):
     """
     Fetch Gmail messages matching `search_query` that don't yet carry `processed_label`.
@@ -332,36 +923,135 @@ def fetch_new_body_only_reports(service, search_query, processed_label):
     Used by body-only ingestion paths (e.g. ShopeePay daily settlement emails).
     """
     final_query = f"{search_query} -label:{processed_label}"
-    messages = search_emails(service, final_query)
+    messages = search_new_messages(service, search_query, processed_label)
     results = []
     if not messages:
         logger.info(f"No new body-only messages matching: {final_query}")
         return results
 
+    full_messages = batch_get_messages(
+        service, [m["id"] for m in messages], format="full", fields=GMAIL_FIELDS['messages.get.body']
+    )
     for m in messages:
-        message_id = m["id"]
-        try:
-            full = service.users().messages().get(userId="me", id=message_id, format="full").execute()
-        except HttpError as error:
-            logger.error(f"Failed to fetch full message {message_id}: {error}")
-            continue
-        headers = {h["name"]: h["value"] for h in full["payload"].get("headers", [])}
-        bodies = _extract_message_bodies(full["payload"])
-        results.append({
-            "message_id": message_id,
-            "subject": headers.get("Subject", ""),
-            "date_header": headers.get("Date", ""),
-            "body_text": bodies["stripped"],   # parser-friendly
-            "body_raw": bodies["raw"],          # original HTML/plain — persisted for audit
-            "body_kind": bodies["kind"],        # 'plain' | 'html' | 'empty'
-            "processed_label": processed_label,
-            "report_type": "BODY_ONLY",
-        })
+        full = full_messages.get(m["id"])
+        if full is not None:
+            results.append(_body_only_report(full, processed_label))
 
     logger.info(f"Fetched {len(results)} body-only messages for query: {search_query}")
     return results
 
 
+
+# --- Unified fetch ---
+# One OR-combined search for every report type, one batched format=full fetch,
+# then local routing with precompiled matchers. Query round-trips no longer
+# grow with the number of report types.
+
+def _phrase_matcher(phrase):
+    """
+    Case-insensitive matcher requiring every word of `phrase` to appear, which
+    mirrors Gmail's word-based `subject:(...)` / `from:` matching. None if no phrase.
+    """
+    if not phrase:
+        return None
+    lookaheads = "".join(f"(?=.*{re.escape(word)})" for word in phrase.split())
+    return re.compile(lookaheads, re.IGNORECASE | re.DOTALL)
+
+
+def _compile_route(report_config):
+    extension = report_config.get('desired_filename_extension')
+    return {
+        'config': report_config,
+        'subject': _phrase_matcher(report_config.get('subject_phrase')),
+        'sender': _phrase_matcher(report_config.get('from_phrase')),
+        'extension': extension.lower() if extension else None,
+    }
+
+
+def _route_matches(route, message, headers, processed_label_id):
+    if processed_label_id and processed_label_id in message.get('labelIds', []):
+        return False
+    if route['subject'] and not route['subject'].match(headers.get('subject', '')):
+        return False
+    if route['sender'] and not route['sender'].match(headers.get('from', '')):
+        return False
+    if route['extension']:
+        filenames = (part.get('filename') or '' for part in message['payload'].get('parts', []))
+        if not any(name.lower().endswith(route['extension']) for name in filenames):
+            return False
+    return True
+
+
+def fetch_all_new_reports(service, download_to_dir, attachment_configs, body_only_configs):
+    """
+    Fetches every report type with a single Gmail search and routes messages locally.
+
+    Each config carries its usual keys ('search_query', 'processed_label', and
+    for attachment configs the fetch_new_reports keys) plus the local matchers
+    'subject_phrase' and/or 'from_phrase'; attachment configs also require a
+    part whose filename ends with 'desired_filename_extension'.
+
+    Returns (attachment_reports, body_only_reports) in exactly the shapes of
+    fetch_new_reports and fetch_new_body_only_reports, grouped in config order.
+    """
+    all_configs = list(attachment_configs) + list(body_only_configs)
+    final_query = " OR ".join(f"({c['search_query']} -label:{c['processed_label']})" for c in all_configs)
+    processed_labels = [c['processed_label'] for c in all_configs]
+    try:
+        if config.GMAIL_INCREMENTAL_SYNC:
+            messages, carried, history_id = _sync_candidates(service, final_query, processed_labels)
+        else:
+            messages, carried, history_id = _search_all_pages(service, final_query), [], None
+    except HttpError as error:
+        logger.error(f'An error occurred searching emails with query "{final_query}": {error}')
+        return [], []
+
+    message_ids = list(dict.fromkeys([m['id'] for m in messages] + carried))
+    full_messages = batch_get_messages(
+        service, message_ids, format="full", fields=GMAIL_FIELDS['messages.get.routing']
+    ) if message_ids else {}
+    label_ids = resolve_label_ids(service, processed_labels)
+
+    routes = [_compile_route(c) for c in all_configs]
+    routed = [[] for _ in routes]
+    pending_ids = []
+    for message_id in message_ids:
+        message = full_messages.get(message_id)
+        if message is None:
+            pending_ids.append(message_id)  # fetch failed; try again next run
+            continue
+        headers = {h['name'].lower(): h['value'] for h in message['payload'].get('headers', [])}
+        matched = False
+        for route, bucket in zip(routes, routed):
+            if _route_matches(route, message, headers, label_ids.get(route['config']['processed_label'])):
+                bucket.append(message_id)
+                matched = True
+        if matched:
+            pending_ids.append(message_id)
+        elif message_id not in carried:
+            logger.info(f"Message {message_id} matched the combined query but no local route; skipping.")
+
+    attachment_reports = []
+    for report_config, bucket in zip(attachment_configs, routed):
+        if bucket:
+            attachment_reports.extend(_download_attachment_reports(
+                service, bucket, download_to_dir, report_config,
+                prefetched={mid: full_messages[mid] for mid in bucket},
+            ))
+        else:
+            logger.info(f"No new messages routed to report type: {report_config['report_type']}")
+    body_only_reports = []
+    for report_config, bucket in zip(body_only_configs, routed[len(attachment_configs):]):
+        body_only_reports.extend(_body_only_report(full_messages[mid], report_config['processed_label']) for mid in bucket)
+
+    if history_id is not None:
+        _save_sync_entry(final_query, history_id, pending_ids)
+    logger.info(
+        f"Unified fetch: {len(message_ids)} candidate message(s) -> "
+        f"{len(attachment_reports)} attachment report(s), {len(body_only_reports)} body-only report(s)."
+    )
+    return attachment_reports, body_only_reports
+
 if __name__ == '__main__':
     # --- Configuration for standalone testing ---
     # Import configuration from config.py
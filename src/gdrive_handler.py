@@ -1,10 +1,19 @@
 import os.path
+import hashlib
+import io
+import json
 import logging
+import mimetypes
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
 from googleapiclient.discovery import build
 from google.oauth2.service_account import Credentials
-from googleapiclient.http import MediaFileUpload, MediaIoBaseDownload
+from googleapiclient.http import MediaFileUpload, MediaIoBaseDownload, MediaIoBaseUpload
 from googleapiclient.errors import HttpError
 from . import config
+from . import google_services
+from . import rate_limiter
 
 # Scopes for Google Drive API
 SCOPES = ['https://www.googleapis.com/auth/drive']
@@ -20,6 +29,32 @@ from src.email_handler import get_gmail_service # We can reuse this if scopes ar
 
 logger = logging.getLogger(__name__)
 
+FOLDER_MIME_TYPE = 'application/vnd.google-apps.folder'
+
+# Partial-response projections (`fields=`) per call site: every request asks
+# only for what its caller reads.
+DRIVE_FIELDS = {
+    'folder.find':   'files(id)',
+    'folder.create': 'id',
+    'folder.check':  'id,trashed',
+    'file.find':     'files(id)',
+    'file.upload':   'id',
+    'folder.list':   'nextPageToken,files(id,name,mimeType,md5Checksum)',
+    'folder.all':    'nextPageToken,files(id,name,parents)',
+    'index.files':   'nextPageToken,files(id,name,parents,md5Checksum,modifiedTime,trashed)',
+}
+
+FOLDER_CACHE_FILENAME = 'gdrive_folders.json'
+# Parent folders whose children one warm-up query lists ("'a' in parents or ...").
+FOLDER_WARM_PARENTS_PER_QUERY = 50
+
+# Files are hashed this many bytes at a time when comparing with md5Checksum.
+MD5_READ_CHUNK_BYTES = 1 << 20
+
+# Archive traffic for the run summary; see get_upload_stats().
+_upload_stats = {'uploaded_files': 0, 'uploaded_bytes': 0, 'skipped_files': 0, 'skipped_bytes': 0}
+_upload_stats_lock = threading.Lock()
+
 def get_gdrive_service():
     """Authenticates with Google Drive API using a service account and returns the service object."""
     creds = None
@@ -47,14 +82,265 @@ def get_gdrive_service():
         logger.error(f"Failed to build Google Drive service: {e}")
         return None
 
+# --- Folder-ID cache ---
+# "<parent_id>/<name>" -> folder ID, persisted under LOCAL_STATE_DIR. Filled by
+# targeted lookups on a miss, or a whole archive tree at once by
+# warm_folder_cache() for callers that walk it, so steady-state archiving only
+# queries Drive for folders it has not seen before (typically the new Day folder).
+# Entries are dropped when Drive answers 404 for a cached ID, or when a warm-up
+# no longer finds them under its root.
+_folder_ids = {}
+_folder_cache_loaded = False
+_folder_warmed_roots = set()  # roots whose tree this process has listed
+_folder_lock = threading.RLock()  # guards the dict only; never held across Drive calls
+_folder_warm_lock = threading.Lock()
+_folder_miss_locks = {}  # folder key -> Lock, held while a miss is looked up/created
+# IDs confirmed live (not trashed) by this process. Persisted IDs are checked
+# once per run before use, as the baseline's trashed=false lookups did.
+_verified_folder_ids = set()
+
+
+def _folder_key(parent_folder_id, folder_name):
+    return f"{parent_folder_id}/{folder_name}"
+
+
+def _folder_cache_path():
+    return os.path.join(config.LOCAL_STATE_DIR, FOLDER_CACHE_FILENAME)
+
+
+def _load_folder_cache():
+    global _folder_cache_loaded
+    if _folder_cache_loaded:
+        return
+    _folder_cache_loaded = True
+    path = _folder_cache_path()
+    if not os.path.exists(path):
+        return
+    try:
+        with open(path, encoding="utf-8") as f:
+            _folder_ids.update(json.load(f).get("folders") or {})
+    except (OSError, ValueError) as e:
+        logger.warning(f"Ignoring unreadable Drive folder cache {path}: {e}")
+
+
+def _persist_folder_cache():
+    path = _folder_cache_path()
+    try:
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        tmp_path = f"{path}.tmp"
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            json.dump({"folders": _folder_ids}, f)
+        os.replace(tmp_path, path)
+    except OSError as e:
+        logger.warning(f"Could not persist Drive folder cache to {path}: {e}")
+
+
+def warm_folder_cache(service, root_folder_id, force=False):
+    """
+    Walks the non-trashed folders below root_folder_id one level at a time
+    (children of up to FOLDER_WARM_PARENTS_PER_QUERY parents per paged query,
+    so an archive of Y years costs a handful of queries per level) and makes
+    the cached entries under root match the listing: moved, trashed and
+    deleted folders are dropped along with their subtrees. Runs at most once
+    per root per process unless `force` is set. Lookups keep answering from
+    the cache while it walks. Returns False if the listing failed.
+    """
+    with _folder_warm_lock:
+        with _folder_lock:
+            _load_folder_cache()
+            if root_folder_id in _folder_warmed_roots and not force:
+                return True
+        listed = {}
+        walked = set()
+        level = [root_folder_id]
+        try:
+            while level:
+                walked.update(level)
+                next_level = []
+                for i in range(0, len(level), FOLDER_WARM_PARENTS_PER_QUERY):
+                    chunk = level[i:i + FOLDER_WARM_PARENTS_PER_QUERY]
+                    for folder in _list_child_folders(service, chunk):
+                        for parent_id in folder.get('parents') or []:
+                            if parent_id in chunk:
+                                listed.setdefault(_folder_key(parent_id, folder['name']), folder['id'])
+                        if folder['id'] not in walked:
+                            walked.add(folder['id'])
+                            next_level.append(folder['id'])
+                level = next_level
+        except HttpError as error:
+            logger.error(f"HttpError warming Drive folder cache under {root_folder_id}: {error}")
+            return False
+        with _folder_lock:
+            _folder_warmed_roots.add(root_folder_id)
+            listed_ids = set(listed.values())
+            gone = {folder_id for key, folder_id in _folder_ids.items()
+                    if key.partition('/')[0] in walked and folder_id not in listed_ids}
+            _drop_folder_subtrees(gone)
+            for key in [key for key in _folder_ids if key.partition('/')[0] in walked]:
+                del _folder_ids[key]
+            _folder_ids.update(listed)
+            _verified_folder_ids.update(listed_ids)
+            _persist_folder_cache()
+            logger.info(f"Cached {len(listed)} Drive folder IDs under {root_folder_id} "
+                        f"({len(gone)} stale ID(s) dropped).")
+        return True
+
+
+def _list_child_folders(service, parent_ids):
+    parents = " or ".join(f"'{parent_id}' in parents" for parent_id in parent_ids)
+    page_token = None
+    while True:
+        response = rate_limiter.drive(service.files().list(
+            q=f"mimeType='{FOLDER_MIME_TYPE}' and trashed=false and ({parents})",
+            spaces='drive',
+            fields=DRIVE_FIELDS['folder.all'],
+            pageSize=1000,
+            pageToken=page_token,
+        ))
+        yield from response.get('files', [])
+        page_token = response.get('nextPageToken')
+        if not page_token:
+            return
+
+
+def cached_subfolders(service, parent_folder_id):
+    """Returns {name: folder_id} for the cached child folders of parent_folder_id, warming the cache first."""
+    warm_folder_cache(service, parent_folder_id)
+    prefix = f"{parent_folder_id}/"
+    with _folder_lock:
+        return {key[len(prefix):]: folder_id for key, folder_id in _folder_ids.items() if key.startswith(prefix)}
+
+
+def cached_folder_paths(service, root_folder_id):
+    """
+    Returns {folder_id: "Year/Month/Day"-style path relative to root_folder_id}
+    for every cached folder below it (root itself maps to ""), warming the cache first.
+    """
+    warm_folder_cache(service, root_folder_id)
+    with _folder_lock:
+        children = {}
+        for key, folder_id in _folder_ids.items():
+            parent_id, _, name = key.partition('/')
+            children.setdefault(parent_id, []).append((name, folder_id))
+    paths = {root_folder_id: ''}
+    pending = [root_folder_id]
+    while pending:
+        parent_id = pending.pop()
+        for name, folder_id in children.get(parent_id, []):
+            if folder_id not in paths:
+                paths[folder_id] = f"{paths[parent_id]}/{name}" if paths[parent_id] else name
+                pending.append(folder_id)
+    return paths
+
+
+def known_folder_ids():
+    """IDs of every folder currently in the cache (no Drive calls)."""
+    with _folder_lock:
+        _load_folder_cache()
+        return set(_folder_ids.values())
+
+
+def forget_folder(folder_id):
+    """Evicts a folder (and every cached folder below it) after Drive reported it missing."""
+    with _folder_lock:
+        _load_folder_cache()
+        evicted = _drop_folder_subtrees({folder_id})
+        # An ancestor may be gone too; re-check each folder on its next use.
+        _verified_folder_ids.clear()
+        if evicted:
+            logger.warning(f"Drive folder {folder_id} not found; evicted {evicted} cached folder ID(s).")
+            _persist_folder_cache()
+
+
+def _drop_folder_subtrees(folder_ids):
+    """Drops folder_ids and every cached folder below them (caller holds _folder_lock); returns the entry count."""
+    doomed = set(folder_ids)
+    pending = list(doomed)
+    while pending:
+        prefix = f"{pending.pop()}/"
+        for key, cached_id in _folder_ids.items():
+            if key.startswith(prefix) and cached_id not in doomed:
+                doomed.add(cached_id)
+                pending.append(cached_id)
+    stale = [key for key, cached_id in _folder_ids.items()
+             if cached_id in doomed or key.partition('/')[0] in doomed]
+    for key in stale:
+        del _folder_ids[key]
+    return len(stale)
+
+
+def invalidate_folder_cache():
+    """Drops the in-memory and persisted folder cache; the next lookup re-lists."""
+    global _folder_cache_loaded
+    with _folder_lock:
+        _folder_ids.clear()
+        _verified_folder_ids.clear()
+        _folder_warmed_roots.clear()
+        _folder_cache_loaded = False
+        try:
+            os.remove(_folder_cache_path())
+        except FileNotFoundError:
+            pass
+        except OSError as e:
+            logger.warning(f"Could not remove Drive folder cache: {e}")
+
+
 def find_or_create_folder(service, parent_folder_id, folder_name):
     """
     Finds a folder by name within a parent folder. If not found, creates it.
+    Answers from the folder-ID cache when possible; a cached ID not yet seen
+    this run is checked with one files().get, and a trashed or deleted one is
+    evicted. A miss costs one targeted files().list (plus a create if needed).
+    No Drive call is made while holding the cache lock.
     Returns the folder ID or None if an error occurs.
     """
+    key = _folder_key(parent_folder_id, folder_name)
+    with _folder_lock:
+        _load_folder_cache()
+        folder_id = _folder_ids.get(key)
+        if folder_id in _verified_folder_ids:
+            return folder_id
+        # Serializes misses on the same key so two uploads can't both create it.
+        key_lock = _folder_miss_locks.setdefault(key, threading.Lock())
+    with key_lock:
+        with _folder_lock:
+            folder_id = _folder_ids.get(key)
+            if folder_id in _verified_folder_ids:
+                return folder_id
+        if folder_id:
+            if _folder_is_live(service, folder_id):
+                with _folder_lock:
+                    _verified_folder_ids.add(folder_id)
+                return folder_id
+            forget_folder(folder_id)
+        folder_id = _find_or_create_folder_uncached(service, parent_folder_id, folder_name)
+        if folder_id:
+            with _folder_lock:
+                _folder_ids[key] = folder_id
+                _verified_folder_ids.add(folder_id)
+                _persist_folder_cache()
+        return folder_id
+
+
+def _folder_is_live(service, folder_id):
+    """False if Drive reports the folder trashed or gone; other errors keep the cached ID."""
+    try:
+        folder = rate_limiter.drive(service.files().get(fileId=folder_id, fields=DRIVE_FIELDS['folder.check']))
+    except HttpError as error:
+        if error.resp.status == 404:
+            return False
+        logger.warning(f"Could not check cached Drive folder {folder_id}: {error}")
+        return True
+    if folder.get('trashed'):
+        logger.warning(f"Cached Drive folder {folder_id} is in the trash; resolving it again.")
+        return False
+    return True
+
+
+def _find_or_create_folder_uncached(service, parent_folder_id, folder_name):
     try:
-        query = f"name='{folder_name}' and '{parent_folder_id}' in parents and mimeType='application/vnd.google-apps.folder' and trashed=false"
-        response = service.files().list(q=query, spaces='drive', fields='files(id, name)').execute()
+        query = f"name='{folder_name}' and '{parent_folder_id}' in parents and mimeType='{FOLDER_MIME_TYPE}' and trashed=false"
+        response = rate_limiter.drive(service.files().list(q=query, spaces='drive', fields=DRIVE_FIELDS['folder.find']))
         folders = response.get('files', [])
         if folders:
             logger.info(f"Found folder '{folder_name}' with ID: {folders[0].get('id')}")
@@ -63,60 +349,213 @@ def find_or_create_folder(service, parent_folder_id, folder_name):
             logger.info(f"Folder '{folder_name}' not found in parent ID '{parent_folder_id}'. Creating it.")
             file_metadata = {
                 'name': folder_name,
-                'mimeType': 'application/vnd.google-apps.folder',
+                'mimeType': FOLDER_MIME_TYPE,
                 'parents': [parent_folder_id]
             }
-            folder = service.files().create(body=file_metadata, fields='id').execute()
+            folder = rate_limiter.drive(service.files().create(body=file_metadata, fields=DRIVE_FIELDS['folder.create']),
+                                         idempotent=False)
             logger.info(f"Created folder '{folder_name}' with ID: {folder.get('id')}")
             return folder.get('id')
     except HttpError as error:
         logger.error(f"An error occurred trying to find/create folder '{folder_name}': {error}")
         return None
 
+def file_md5(local_file_path):
+    """Hex MD5 of a local file, comparable with Drive's md5Checksum."""
+    digest = hashlib.md5()
+    with open(local_file_path, 'rb') as f:
+        for chunk in iter(lambda: f.read(MD5_READ_CHUNK_BYTES), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def _count_upload(kind, num_bytes):
+    with _upload_stats_lock:
+        _upload_stats[f'{kind}_files'] += 1
+        _upload_stats[f'{kind}_bytes'] += num_bytes
+
+
+def get_upload_stats():
+    """Files and bytes uploaded vs skipped (identical content already in Drive) so far this run."""
+    with _upload_stats_lock:
+        return dict(_upload_stats)
+
+
+def reset_upload_stats():
+    with _upload_stats_lock:
+        for key in _upload_stats:
+            _upload_stats[key] = 0
+
+
+def _send_upload(request, resumable, upload_filename, creates=False):
+    """
+    Sends a create/update media request. Small files go as a single multipart
+    request; resumable sessions (one extra round-trip to open) are kept for
+    files of at least GDRIVE_RESUMABLE_THRESHOLD_BYTES. A multipart create is
+    only retried when throttled; resumable chunks are always safe to resend.
+    """
+    if not resumable:
+        return rate_limiter.drive(request, idempotent=not creates)
+    response = None
+    # resumable upload loop; a retried chunk resumes from the last byte Drive acknowledged
+    while response is None:
+        status, response = rate_limiter.call(request.next_chunk, 'drive', description=f"Upload of '{upload_filename}'")
+        if status:
+            logger.info(f"Uploaded {int(status.progress() * 100)}% of {upload_filename}")
+    return response
+
+
 def upload_file_to_gdrive(service, local_file_path, gdrive_folder_id, remote_filename=None):
     """
-    Uploads a local file to the specified Google Drive folder.
+    Uploads a local file to the specified Google Drive folder as a new file.
+    Returns the file ID if successful, None otherwise.
+    """
+    return upsert_file_to_gdrive(service, local_file_path, gdrive_folder_id, remote_filename)
+
+
+def upsert_file_to_gdrive(service, local_file_path, gdrive_folder_id, remote_filename=None,
+                          existing_file_id=None, existing_md5=None):
+    """
+    Stores a local file in a Google Drive folder in a single request: uploads a
+    new revision of `existing_file_id` in place when given (keeping the Drive
+    file ID stable), otherwise creates the file. An existing ID that Drive no
+    longer knows (404) falls back to create. When `existing_md5` (the Drive
+    file's md5Checksum) equals the local file's MD5, nothing is uploaded.
     Returns the file ID if successful, None otherwise.
     """
     if not os.path.exists(local_file_path):
         logger.error(f"Local file not found for upload: {local_file_path}")
         return None
 
-    file_basename = os.path.basename(local_file_path)
-    upload_filename = remote_filename if remote_filename else file_basename
+    def make_media(resumable, chunksize):
+        return MediaFileUpload(local_file_path, resumable=resumable, chunksize=chunksize)
+
+    return _upsert_media(
+        service, make_media, os.path.getsize(local_file_path), lambda: file_md5(local_file_path),
+        local_file_path, remote_filename or os.path.basename(local_file_path),
+        gdrive_folder_id, existing_file_id, existing_md5,
+    )
+
+
+def upsert_content_to_gdrive(service, content, gdrive_folder_id, remote_filename,
+                             existing_file_id=None, existing_md5=None, mimetype=None):
+    """
+    upsert_file_to_gdrive for in-memory data: `content` is bytes or a seekable
+    binary file object, uploaded through MediaIoBaseUpload without touching
+    local disk. `mimetype` defaults to a guess from remote_filename.
+    Returns the file ID if successful, None otherwise.
+    """
+    stream = io.BytesIO(content) if isinstance(content, (bytes, bytearray)) else content
+    stream.seek(0, io.SEEK_END)
+    size = stream.tell()
+    mimetype = mimetype or mimetypes.guess_type(remote_filename)[0] or 'application/octet-stream'
+
+    def make_media(resumable, chunksize):
+        stream.seek(0)
+        return MediaIoBaseUpload(stream, mimetype=mimetype, resumable=resumable, chunksize=chunksize)
+
+    def content_md5():
+        stream.seek(0)
+        digest = hashlib.md5()
+        for chunk in iter(lambda: stream.read(MD5_READ_CHUNK_BYTES), b''):
+            digest.update(chunk)
+        return digest.hexdigest()
+
+    return _upsert_media(
+        service, make_media, size, content_md5, f"memory ({size} bytes)", remote_filename,
+        gdrive_folder_id, existing_file_id, existing_md5,
+    )
+
+
+def _upsert_media(service, make_media, file_size, content_md5, source, upload_filename,
+                  gdrive_folder_id, existing_file_id, existing_md5):
+    if existing_file_id and existing_md5 and content_md5() == existing_md5:
+        logger.info(f"'{upload_filename}' (ID: {existing_file_id}) is unchanged in Drive (md5 {existing_md5}); skipping upload.")
+        _count_upload('skipped', file_size)
+        return existing_file_id
 
     try:
-        file_metadata = {
-            'name': upload_filename,
-            'parents': [gdrive_folder_id]
-        }
-        media = MediaFileUpload(local_file_path, resumable=True)
-        request = service.files().create(body=file_metadata, media_body=media, fields='id')
-        
-        response = None
-        file_id = None
-        logger.info(f"Starting upload of {local_file_path} as '{upload_filename}' to Drive folder ID {gdrive_folder_id}.")
-        # resumable upload loop
-        while response is None:
-            status, response = request.next_chunk()
-            if status:
-                logger.info(f"Uploaded {int(status.progress() * 100)}% of {upload_filename}")
-        
+        resumable = file_size >= config.GDRIVE_RESUMABLE_THRESHOLD_BYTES
+        media = make_media(resumable, config.GDRIVE_UPLOAD_CHUNK_BYTES if resumable else -1)
+        if existing_file_id:
+            request = service.files().update(fileId=existing_file_id, media_body=media, fields=DRIVE_FIELDS['file.upload'])
+            logger.info(f"Updating '{upload_filename}' (ID: {existing_file_id}) in place from {source}.")
+        else:
+            file_metadata = {
+                'name': upload_filename,
+                'parents': [gdrive_folder_id]
+            }
+            request = service.files().create(body=file_metadata, media_body=media, fields=DRIVE_FIELDS['file.upload'])
+            logger.info(f"Starting upload of {source} as '{upload_filename}' to Drive folder ID {gdrive_folder_id}.")
+
+        started = time.monotonic()
+        response = _send_upload(request, resumable, upload_filename, creates=not existing_file_id)
+        elapsed = max(time.monotonic() - started, 1e-6)
+
         if response and response.get('id'):
             file_id = response.get('id')
-            logger.info(f"Successfully uploaded '{upload_filename}' (ID: {file_id}) to Google Drive folder ID {gdrive_folder_id}.")
+            _count_upload('uploaded', file_size)
+            logger.info(f"Successfully uploaded '{upload_filename}' (ID: {file_id}) to Google Drive folder ID {gdrive_folder_id}: "
+                        f"{file_size} bytes in {elapsed:.2f}s ({file_size / elapsed / 1024:.1f} KiB/s, "
+                        f"{'resumable' if resumable else 'multipart'}).")
             return file_id
         else:
             logger.error(f"Google Drive upload of '{upload_filename}' failed. No file ID in response. Response: {response}")
             return None
-            
+
     except HttpError as error:
+        if error.resp.status == 404:
+            if existing_file_id:
+                logger.warning(f"Drive file {existing_file_id} for '{upload_filename}' no longer exists; creating it instead.")
+                return _upsert_media(service, make_media, file_size, content_md5, source, upload_filename,
+                                     gdrive_folder_id, None, None)
+            forget_folder(gdrive_folder_id)
         logger.error(f"An HttpError occurred during Google Drive upload of '{upload_filename}': {error}")
         return None
     except Exception as e:
         logger.error(f"An unexpected error occurred during Google Drive upload of '{upload_filename}': {e}", exc_info=True)
         return None
 
+def archive_files_to_folder(service, gdrive_folder_id, uploads, resolve_folder=None):
+    """
+    Stores every (source, remote_filename) of `uploads` in one Drive folder,
+    where source is a local path or in-memory bytes. The folder is listed once
+    (names and md5Checksum); each file is then upserted, up to
+    GDRIVE_UPLOAD_WORKERS at a time on per-thread Drive clients.
+
+    If Drive reports the folder gone (it is evicted from the folder cache) and
+    `resolve_folder` is given, it is called once for a fresh folder ID and the
+    uploads are retried there.
+    Returns the resulting file ID (or None on failure) per upload, in order.
+    """
+    file_ids = _archive_files(service, gdrive_folder_id, uploads)
+    if resolve_folder and not all(file_ids) and gdrive_folder_id not in known_folder_ids():
+        new_folder_id = resolve_folder()
+        if new_folder_id and new_folder_id != gdrive_folder_id:
+            logger.warning(f"Drive folder {gdrive_folder_id} is gone; retrying {len(uploads)} upload(s) "
+                           f"in folder {new_folder_id}.")
+            file_ids = _archive_files(service, new_folder_id, uploads)
+    return file_ids
+
+
+def _archive_files(service, gdrive_folder_id, uploads):
+    existing_files = list_files_by_name(service, gdrive_folder_id)
+
+    def archive(upload, drive_service):
+        source, remote_filename = upload
+        existing = existing_files.get(remote_filename) or {}
+        upsert = upsert_file_to_gdrive if isinstance(source, str) else upsert_content_to_gdrive
+        return upsert(drive_service, source, gdrive_folder_id, remote_filename=remote_filename,
+                      existing_file_id=existing.get('id'), existing_md5=existing.get('md5Checksum'))
+
+    workers = min(config.GDRIVE_UPLOAD_WORKERS, len(uploads))
+    if workers > 1 and google_services.service_credentials(service) is not None:
+        with ThreadPoolExecutor(max_workers=workers, thread_name_prefix="gdrive-upload") as pool:
+            return list(pool.map(
+                lambda upload: archive(upload, google_services.worker_service(service, 'drive', 'v3')), uploads))
+    return [archive(upload, service) for upload in uploads]
+
+
 def find_file_id_by_name_in_folder(service, folder_id, filename):
     """
     Finds a file by its exact name within a specific Google Drive folder.
@@ -126,9 +565,9 @@ def find_file_id_by_name_in_folder(service, folder_id, filename):
         # Ensure filename is properly escaped for the query
         escaped_filename = filename.replace("'", "\\'")
         query = f"name = '{escaped_filename}' and '{folder_id}' in parents and trashed = false"
-        response = service.files().list(q=query,
-                                        spaces='drive',
-                                        fields='files(id, name)').execute()
+        response = rate_limiter.drive(service.files().list(q=query,
+                                                           spaces='drive',
+                                                           fields=DRIVE_FIELDS['file.find']))
         files = response.get('files', [])
         if files:
             logger.info(f"Found file '{filename}' with ID {files[0]['id']} in folder {folder_id}.")
@@ -137,6 +576,8 @@ def find_file_id_by_name_in_folder(service, folder_id, filename):
             logger.info(f"File '{filename}' not found in folder {folder_id}.")
             return None
     except HttpError as error:
+        if error.resp.status == 404:
+            forget_folder(folder_id)
         logger.error(f"HttpError searching for file '{filename}' in folder {folder_id}: {error}")
         return None
     except Exception as e:
@@ -146,7 +587,8 @@ def find_file_id_by_name_in_folder(service, folder_id, filename):
 def list_files_in_folder(service, folder_id):
     """
     Lists all (non-trashed) children of a Google Drive folder.
-    Returns a list of dicts with keys: id, name, mimeType. Empty list on error.
+    Returns a list of dicts with keys: id, name, mimeType (and md5Checksum for
+    binary files). Empty list on error.
     Pages through results so folders with >100 items are fully enumerated.
     """
     results = []
@@ -154,19 +596,21 @@ def list_files_in_folder(service, folder_id):
     try:
         while True:
             query = f"'{folder_id}' in parents and trashed = false"
-            response = service.files().list(
+            response = rate_limiter.drive(service.files().list(
                 q=query,
                 spaces='drive',
-                fields='nextPageToken, files(id, name, mimeType)',
+                fields=DRIVE_FIELDS['folder.list'],
                 pageSize=1000,
                 pageToken=page_token,
-            ).execute()
+            ))
             results.extend(response.get('files', []) or [])
             page_token = response.get('nextPageToken')
             if not page_token:
                 break
         return results
     except HttpError as error:
+        if error.resp.status == 404:
+            forget_folder(folder_id)
         logger.error(f"HttpError listing folder {folder_id}: {error}")
         return []
     except Exception as e:
@@ -174,6 +618,19 @@ def list_files_in_folder(service, folder_id):
         return []
 
 
+def list_files_by_name(service, folder_id):
+    """
+    Returns {name: {'id', 'md5Checksum'}} for the (non-folder) files in
+    folder_id, from one paged listing. Where names repeat, the first listed
+    file wins.
+    """
+    files = {}
+    for entry in list_files_in_folder(service, folder_id):
+        if entry.get('mimeType') != FOLDER_MIME_TYPE:
+            files.setdefault(entry['name'], entry)
+    return files
+
+
 def download_file_to_local(service, file_id, local_path):
     """
     Downloads a Google Drive file by ID to a local path.
@@ -185,7 +642,7 @@ def download_file_to_local(service, file_id, local_path):
             downloader = MediaIoBaseDownload(fh, request)
             done = False
             while not done:
-                status, done = downloader.next_chunk()
+                status, done = rate_limiter.call(downloader.next_chunk, 'drive', description=f"Download of {file_id}")
                 if status:
                     logger.debug(f"Download {file_id}: {int(status.progress() * 100)}%")
         logger.info(f"Successfully downloaded file ID {file_id} to {local_path}.")
@@ -204,7 +661,7 @@ def delete_file_by_id(service, file_id):
     Returns True if successful, False otherwise.
     """
     try:
-        service.files().delete(fileId=file_id).execute()
+        rate_limiter.drive(service.files().delete(fileId=file_id))
         logger.info(f"Successfully deleted file with ID: {file_id} from Google Drive.")
         return True
     except HttpError as error:
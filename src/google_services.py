@@ -0,0 +1,38 @@
+import threading
+
+import google_auth_httplib2
+import httplib2
+from googleapiclient.discovery import build
+
+# Service objects share one httplib2.Http, which is not thread-safe. Worker
+# threads (Gmail downloads, Drive uploads) each build their own client on top
+# of the same credentials.
+_thread_local = threading.local()
+
+
+def service_credentials(service):
+    """The google-auth credentials behind `service`, or None if it wasn't built with any."""
+    return getattr(getattr(service, '_http', None), 'credentials', None)
+
+
+def worker_service(service, api, version):
+    """
+    Returns an `api`/`version` service owned by the calling thread, built from
+    the credentials behind `service` and reused for later calls on the same
+    thread. Returns None if the credentials can't be recovered.
+    """
+    cached = getattr(_thread_local, 'services', None)
+    if cached is None:
+        cached = _thread_local.services = {}
+    key = (id(service), api, version)
+    # The entry keeps `service` alive, so its id() can't be reused by another object.
+    entry = cached.get(key)
+    if entry is not None and entry[0] is service:
+        return entry[1]
+    creds = service_credentials(service)
+    if creds is None:
+        return None
+    authorized_http = google_auth_httplib2.AuthorizedHttp(creds, http=httplib2.Http())
+    worker = build(api, version, http=authorized_http, cache_discovery=False)
+    cached[key] = (service, worker)
+    return worker
@@ -3,9 +3,9 @@
 import os
 # import argparse # No longer needed as we are not parsing CLI args for a single zip
 import logging # Retained for derive_info_from_zip_filename if it uses it
-import tempfile
-import shutil
 import re
+import signal
+import sys
 import traceback # For detailed error logging
 from datetime import datetime, date
 # from logging.handlers import RotatingFileHandler # Removed for file logging
@@ -13,7 +13,7 @@ import csv # Added for CSV parsing
 
 # Import the config module itself
 from src import config 
-from src.zip_processor import extract_zip
+from src.zip_processor import read_zip_members
 from src.data_extractor import (
     extract_csv_data,
     extract_ewallet_etax_pdf_data,
@@ -21,10 +21,12 @@ from src.data_extractor import (
 )
 from src.db_loader import (
     load_merchant_transaction_summaries,
-    load_shopeepay_settlements,
     get_supabase_client,
     get_ewallet_csv_summary,
-    update_ewallet_csv_tax_invoice_no,
+    prefetch_ewallet_csv_summaries,
+    bulk_update_ewallet_csv_tax_invoice_nos,
+    WriteBuffer,
+    upsert_shopeepay_settlements,
 )
 from src import email_handler
 from src import gdrive_handler # Added for Google Drive operations
@@ -157,32 +159,56 @@ def _ensure_gdrive_folder_structure(gdrive_service, report_date_str, base_folder
         logger.error(f"Error ensuring GDrive folder structure for date {report_date_str}: {e}", exc_info=True)
     return None
 
-def process_single_zip(report_info, gdrive_service):
+def _archive_to_gdrive(gdrive_service, day_folder_id, uploads, report_date_str=None, base_folder_id=None):
+    """
+    Stores each (source, remote_filename) of `uploads` in the day folder, where
+    source is a local path or in-memory bytes (see
+    gdrive_handler.archive_files_to_folder; files of one report upload in
+    parallel). With `report_date_str`, a day folder deleted from Drive is
+    resolved again under base_folder_id and the uploads retried once.
+    Returns the number stored (including unchanged files).
+    """
+    resolve_folder = None
+    if report_date_str:
+        resolve_folder = lambda: _ensure_gdrive_folder_structure(gdrive_service, report_date_str, base_folder_id)
+    file_ids = gdrive_handler.archive_files_to_folder(gdrive_service, day_folder_id, uploads, resolve_folder)
+    for (_, remote_filename), file_id in zip(uploads, file_ids):
+        if not file_id:
+            logger.error(f"Failed to archive '{remote_filename}' to GDrive folder {day_folder_id}.")
+    return sum(1 for file_id in file_ids if file_id)
+
+def _write_source(report_info):
+    """Identifies one report item's rows in a WriteBuffer."""
+    return (report_info['message_id'], report_info['original_filename'])
+
+def process_single_zip(report_info, gdrive_service, write_buffer=None):
     """
     Processes a single downloaded K-Merchant ZIP file.
     Extracts, parses TAX_SUMMARY_BY_TAX_ID_CSV_..., loads to Supabase, and archives all contents to GDrive.
+    With `write_buffer` the CSV rows are queued there instead of loaded, and the
+    result only counts once the buffer flush has written them.
     """
     zip_path = report_info['zip_path']
     original_filename = report_info['original_filename']
     # message_id = report_info['message_id'] # Available if needed for finer-grained error reporting
 
     logging.info(f"Processing KMERCHANT_ZIP: {original_filename} (path: {zip_path})")
-    temp_extract_dir = tempfile.mkdtemp(prefix="kbank_zip_extract_")
-    all_extracted_files = []
     gdrive_upload_successful = False
     csv_load_successful = False
     processing_successful_overall = False
 
     try:
-        extracted_file_paths = extract_zip(zip_path, temp_extract_dir)
-        all_extracted_files.extend(extracted_file_paths)
+        # Members are held in memory (these ZIPs are a few small CSVs/PDFs), so
+        # nothing is extracted to disk before parsing and archiving.
+        zip_members = read_zip_members(zip_path)
 
-        if not extracted_file_paths:
+        if not zip_members:
             logging.warning(f"No files extracted from {original_filename}. Skipping.")
             return False # Considered failure for this report
 
         # --- Identify key files and derive info ---
-        csv_file_path = next((f for f in extracted_file_paths if f.lower().endswith(".csv") and "tax_summary_by_tax_id_csv" in os.path.basename(f).lower()), None)
+        csv_member = next(((name, content) for name, content in zip_members if name.lower().endswith(".csv") and "tax_summary_by_tax_id_csv" in os.path.basename(name).lower()), None)
+        csv_file_path = csv_member[0] if csv_member else None
         
         merchant_id, report_date_str = derive_info_from_zip_filename(original_filename)
 
@@ -196,8 +222,12 @@ def process_single_zip(report_info, gdrive_service):
         if csv_file_path:
             logging.info(f"Processing CSV from ZIP: {os.path.basename(csv_file_path)}")
             # process_date for this type of report is usually the same as report_date
-            csv_data_list = extract_csv_data(csv_file_path, merchant_id, report_date_str, report_date_str, 'KMERCHANT_ZIP') 
-            if csv_data_list:
+            csv_data_list = extract_csv_data(csv_file_path, merchant_id, report_date_str, report_date_str, 'KMERCHANT_ZIP', csv_content=csv_member[1])
+            if csv_data_list and write_buffer is not None:
+                write_buffer.add_merchant_transaction_summaries(_write_source(report_info), csv_data_list)
+                csv_load_successful = True
+                logging.info(f"Queued {len(csv_data_list)} records from CSV {os.path.basename(csv_file_path)} for the next bulk write.")
+            elif csv_data_list:
                 s_count, f_count = load_merchant_transaction_summaries(csv_data_list) 
                 logging.info(f"Loaded {s_count} records (failed: {f_count}) from CSV {os.path.basename(csv_file_path)}.")
                 if s_count > 0 and f_count == 0:
@@ -217,31 +247,13 @@ def process_single_zip(report_info, gdrive_service):
         if gdrive_service and report_date_str: # report_date_str needed for folder structure
             day_folder_id = _ensure_gdrive_folder_structure(gdrive_service, report_date_str, config.GDRIVE_ROOT_FOLDER_ID)
             if day_folder_id:
-                files_uploaded_to_gdrive = 0
-                # Upload original ZIP
-                if os.path.exists(zip_path):
-                    # Check and delete existing original ZIP file
-                    existing_zip_id = gdrive_handler.find_file_id_by_name_in_folder(gdrive_service, day_folder_id, original_filename)
-                    if existing_zip_id:
-                        logger.info(f"Found existing ZIP '{original_filename}' (ID: {existing_zip_id}) in GDrive folder {day_folder_id}. Deleting it.")
-                        gdrive_handler.delete_file_by_id(gdrive_service, existing_zip_id)
-                    
-                    if gdrive_handler.upload_file_to_gdrive(gdrive_service, zip_path, day_folder_id, remote_filename=original_filename):
-                        files_uploaded_to_gdrive += 1
-                # Upload all extracted files
-                for extracted_file_path in all_extracted_files:
-                    if os.path.exists(extracted_file_path):
-                        extracted_filename = os.path.basename(extracted_file_path)
-                        # Check and delete existing extracted file
-                        existing_extracted_file_id = gdrive_handler.find_file_id_by_name_in_folder(gdrive_service, day_folder_id, extracted_filename)
-                        if existing_extracted_file_id:
-                            logger.info(f"Found existing extracted file '{extracted_filename}' (ID: {existing_extracted_file_id}) in GDrive folder {day_folder_id}. Deleting it.")
-                            gdrive_handler.delete_file_by_id(gdrive_service, existing_extracted_file_id)
-
-                        if gdrive_handler.upload_file_to_gdrive(gdrive_service, extracted_file_path, day_folder_id): # Uses original basename from extracted_file_path
-                            files_uploaded_to_gdrive += 1
+                # Original ZIP plus all its members (under their original basenames)
+                uploads = [(zip_path, original_filename)] if os.path.exists(zip_path) else []
+                uploads += [(content, os.path.basename(name)) for name, content in zip_members]
+                files_uploaded_to_gdrive = _archive_to_gdrive(gdrive_service, day_folder_id, uploads,
+                                                              report_date_str, config.GDRIVE_ROOT_FOLDER_ID)
                 
-                expected_files_to_upload = len(all_extracted_files) + (1 if os.path.exists(zip_path) else 0)
+                expected_files_to_upload = len(uploads)
                 if files_uploaded_to_gdrive >= expected_files_to_upload : # Check if all expected files uploaded
                     gdrive_upload_successful = True
                     logging.info(f"Successfully uploaded all {files_uploaded_to_gdrive} associated file(s) for {original_filename} to Google Drive.")
@@ -269,15 +281,12 @@ def process_single_zip(report_info, gdrive_service):
     except Exception as e:
         logging.error(f"ERROR processing KMERCHANT_ZIP file {original_filename} (path: {zip_path}): {e}", exc_info=True)
         return False
-    finally:
-        if os.path.exists(temp_extract_dir):
-            shutil.rmtree(temp_extract_dir)
-            logging.info(f"Cleaned up temporary directory: {temp_extract_dir}")
 
-def process_ewallet_csv(report_info, gdrive_service, supabase_client):
+def process_ewallet_csv(report_info, gdrive_service, supabase_client, write_buffer=None):
     """
     Processes a single eWallet CSV file.
-    Parses, loads to Supabase, and archives to GDrive.
+    Parses, loads to Supabase, and archives to GDrive. With `write_buffer` the
+    summary row is queued there instead (see process_single_zip).
     """
     csv_path = report_info['csv_path']
     original_filename = report_info['original_filename']
@@ -380,7 +389,11 @@ def process_ewallet_csv(report_info, gdrive_service, supabase_client):
                         data_for_supabase = None # Invalidate data if parsing fails
                         break
         
-        if data_for_supabase and supabase_client:
+        if data_for_supabase and supabase_client and write_buffer is not None:
+            write_buffer.add_merchant_transaction_summaries(_write_source(report_info), [data_for_supabase])
+            supabase_load_successful = True
+            logger.info(f"Queued data for {original_filename} for the next bulk write.")
+        elif data_for_supabase and supabase_client:
             s_count, f_count = load_merchant_transaction_summaries([data_for_supabase])
             if s_count > 0:
                 supabase_load_successful = True
@@ -402,13 +415,8 @@ def process_ewallet_csv(report_info, gdrive_service, supabase_client):
         if gdrive_service and date_for_gdrive_folder:
             day_folder_id = _ensure_gdrive_folder_structure(gdrive_service, date_for_gdrive_folder, config.GDRIVE_ROOT_FOLDER_ID)
             if day_folder_id:
-                # Check and delete existing CSV file
-                existing_csv_id = gdrive_handler.find_file_id_by_name_in_folder(gdrive_service, day_folder_id, original_filename)
-                if existing_csv_id:
-                    logger.info(f"Found existing eWallet CSV '{original_filename}' (ID: {existing_csv_id}) in GDrive folder {day_folder_id}. Deleting it.")
-                    gdrive_handler.delete_file_by_id(gdrive_service, existing_csv_id)
-
-                if gdrive_handler.upload_file_to_gdrive(gdrive_service, csv_path, day_folder_id, remote_filename=original_filename):
+                if _archive_to_gdrive(gdrive_service, day_folder_id, [(csv_path, original_filename)],
+                                      date_for_gdrive_folder, config.GDRIVE_ROOT_FOLDER_ID):
                     gdrive_upload_successful = True
                     logger.info(f"Successfully uploaded {original_filename} to Google Drive.")
                 else:
@@ -427,7 +435,30 @@ def process_ewallet_csv(report_info, gdrive_service, supabase_client):
         logger.error(f"ERROR processing EWALLET_CSV file {original_filename} (path: {csv_path}): {e}", exc_info=True)
         return False
 
-def process_ewallet_etax_pdf(report_info, gdrive_service, supabase_client):
+def _prefetch_etax_csv_summaries(reports):
+    """
+    One bulk EWALLET_CSV lookup covering every EWALLET_ETAX_PDF in `reports`
+    (merchant IDs and DDMMYYYY dates from the filenames). Returns the index for
+    process_ewallet_etax_pdf, or None to fall back to per-PDF lookups.
+    """
+    keys = set()
+    for report in reports:
+        if report['report_type'] != "EWALLET_ETAX_PDF":
+            continue
+        match = re.search(r"E-TAX_INVOICE_EWALLET_(\d+)_(\d{8})\.pdf$", report['original_filename'], re.IGNORECASE)
+        if not match:
+            continue
+        try:
+            process_date_str = datetime.strptime(match.group(2), "%d%m%Y").strftime("%Y-%m-%d")
+        except ValueError:
+            continue
+        keys.add((match.group(1), process_date_str))
+    if not keys:
+        return None
+    dates = sorted(process_date for _, process_date in keys)
+    return prefetch_ewallet_csv_summaries({merchant_id for merchant_id, _ in keys}, dates[0], dates[-1])
+
+def process_ewallet_etax_pdf(report_info, gdrive_service, supabase_client, csv_summaries=None, pending_updates=None):
     """
     Processes a single eWallet E-TAX PDF file: archives to GDrive, parses the
     tax invoice number, and back-populates the matching EWALLET_CSV summary row.
@@ -439,6 +470,12 @@ def process_ewallet_etax_pdf(report_info, gdrive_service, supabase_client):
                       next scheduled run picks it up again
         "FAILED"    — GDrive upload or PDF parsing failed; caller should add
                       EWALLET_ETAX_PROCESSING_FAILED label
+        "PENDING"   — only when `pending_updates` is given: archived and parsed,
+                      the DB update was appended to `pending_updates`; the caller
+                      applies them with apply_ewallet_etax_updates
+
+    `csv_summaries` is an optional prefetched EWALLET_CSV index (see
+    _prefetch_etax_csv_summaries) used instead of a per-PDF lookup.
     """
     pdf_path = report_info['pdf_path']
     original_filename = report_info['original_filename']
@@ -477,13 +514,8 @@ def process_ewallet_etax_pdf(report_info, gdrive_service, supabase_client):
         if gdrive_service and date_for_gdrive_folder:
             day_folder_id = _ensure_gdrive_folder_structure(gdrive_service, date_for_gdrive_folder, config.GDRIVE_ROOT_FOLDER_ID)
             if day_folder_id:
-                # Check and delete existing PDF file
-                existing_pdf_id = gdrive_handler.find_file_id_by_name_in_folder(gdrive_service, day_folder_id, original_filename)
-                if existing_pdf_id:
-                    logger.info(f"Found existing eWallet ETAX PDF '{original_filename}' (ID: {existing_pdf_id}) in GDrive folder {day_folder_id}. Deleting it.")
-                    gdrive_handler.delete_file_by_id(gdrive_service, existing_pdf_id)
-
-                if gdrive_handler.upload_file_to_gdrive(gdrive_service, pdf_path, day_folder_id, remote_filename=original_filename):
+                if _archive_to_gdrive(gdrive_service, day_folder_id, [(pdf_path, original_filename)],
+                                      date_for_gdrive_folder, config.GDRIVE_ROOT_FOLDER_ID):
                     gdrive_upload_successful = True
                     logger.info(f"Successfully uploaded {original_filename} to Google Drive.")
                 else:
@@ -527,7 +559,7 @@ def process_ewallet_etax_pdf(report_info, gdrive_service, supabase_client):
             return "RETRY"
 
         # Cross-validate parsed amounts against the existing CSV row
-        csv_row = get_ewallet_csv_summary(merchant_id, process_date_str)
+        csv_row = get_ewallet_csv_summary(merchant_id, process_date_str, prefetched=csv_summaries)
         if csv_row:
             csv_comm = csv_row.get('total_fee_commission_amount')
             csv_vat = csv_row.get('vat_on_fee_amount')
@@ -543,47 +575,81 @@ def process_ewallet_etax_pdf(report_info, gdrive_service, supabase_client):
                         f"PDF={pdf_val} CSV={csv_val}. Proceeding with tax_invoice_no update anyway."
                     )
 
-        rows_updated = update_ewallet_csv_tax_invoice_no(
-            merchant_id=merchant_id,
-            process_date=process_date_str,
-            tax_invoice_no=parsed['tax_invoice_no'],
-        )
-        if rows_updated >= 1:
-            return "PROCESSED"
-
-        # 0 rows updated: either CSV not yet ingested, or CSV row already has a tax_invoice_no.
-        if csv_row and csv_row.get('tax_invoice_no'):
-            logger.info(
-                f"EWALLET_CSV row for merchant_id={merchant_id} process_date={process_date_str} "
-                f"already has tax_invoice_no={csv_row['tax_invoice_no']}. No update needed."
-            )
-            return "PROCESSED"
-
-        # Age threshold of 2 days (not 1) absorbs timezone skew between the
-        # UTC GitHub Actions runner and the Bangkok-local filename date — a PDF
-        # received at 07:30 Bangkok already shows age_days=1 on a UTC clock
-        # before the matching CSV email had time to arrive.
-        age_days = (date.today() - process_date_obj).days
-        if age_days >= 2:
-            logger.warning(
-                f"No matching EWALLET_CSV row for merchant_id={merchant_id} process_date={process_date_str} "
-                f"after {age_days}d; CSV email may have been missed. Marking PDF email PROCESSED to avoid infinite retry."
-            )
-            return "PROCESSED"
+        pending = {
+            "original_filename": original_filename,
+            "merchant_id": merchant_id,
+            "process_date_str": process_date_str,
+            "process_date_obj": process_date_obj,
+            "tax_invoice_no": parsed['tax_invoice_no'],
+            "csv_row": csv_row,
+        }
+        if pending_updates is not None:
+            pending_updates.append(pending)
+            return "PENDING"
+        return apply_ewallet_etax_updates([pending])[0]
+    except Exception as e:
+        logger.error(f"ERROR processing EWALLET_ETAX_PDF file {original_filename} (path: {pdf_path}): {e}", exc_info=True)
+        return "FAILED"
+
+def apply_ewallet_etax_updates(pending_updates):
+    """
+    Writes the tax_invoice_no of every PENDING e-Tax PDF in one bulk Supabase
+    call and returns the final "PROCESSED" / "RETRY" outcome for each, in order.
+    """
+    outcomes = bulk_update_ewallet_csv_tax_invoice_nos(
+        [(p["merchant_id"], p["process_date_str"], p["tax_invoice_no"]) for p in pending_updates]
+    )
+    return [_resolve_etax_update(p, outcomes.get((p["merchant_id"], p["process_date_str"]), "error"))
+            for p in pending_updates]
+
+def _resolve_etax_update(pending, update_outcome):
+    """Maps one bulk-update outcome of a parsed e-Tax PDF to "PROCESSED" or "RETRY"."""
+    merchant_id = pending["merchant_id"]
+    process_date_str = pending["process_date_str"]
+    csv_row = pending["csv_row"]
 
+    if update_outcome == "updated":
+        if csv_row:
+            # Keep a shared prefetched row current for duplicate PDFs later in this run.
+            csv_row['tax_invoice_no'] = pending["tax_invoice_no"]
+        return "PROCESSED"
+
+    if update_outcome == "already_set":
         logger.info(
-            f"No matching EWALLET_CSV row yet for merchant_id={merchant_id} process_date={process_date_str} "
-            f"(age {age_days}d). Deferring labeling — will retry on next run."
+            f"EWALLET_CSV row for merchant_id={merchant_id} process_date={process_date_str} "
+            f"already has a tax_invoice_no. No update needed."
+        )
+        return "PROCESSED"
+
+    if update_outcome != "not_found":
+        logger.warning(
+            f"tax_invoice_no update failed for {pending['original_filename']} "
+            f"(merchant_id={merchant_id} process_date={process_date_str}). Will retry on next run."
         )
         return "RETRY"
-    except Exception as e:
-        logger.error(f"ERROR processing EWALLET_ETAX_PDF file {original_filename} (path: {pdf_path}): {e}", exc_info=True)
-        return "FAILED"
+
+    # Age threshold of 2 days (not 1) absorbs timezone skew between the
+    # UTC GitHub Actions runner and the Bangkok-local filename date — a PDF
+    # received at 07:30 Bangkok already shows age_days=1 on a UTC clock
+    # before the matching CSV email had time to arrive.
+    age_days = (date.today() - pending["process_date_obj"]).days
+    if age_days >= 2:
+        logger.warning(
+            f"No matching EWALLET_CSV row for merchant_id={merchant_id} process_date={process_date_str} "
+            f"after {age_days}d; CSV email may have been missed. Marking PDF email PROCESSED to avoid infinite retry."
+        )
+        return "PROCESSED"
+
+    logger.info(
+        f"No matching EWALLET_CSV row yet for merchant_id={merchant_id} process_date={process_date_str} "
+        f"(age {age_days}d). Deferring labeling — will retry on next run."
+    )
+    return "RETRY"
 
 SHOPEEPAY_EXPECTED_BANK_TAIL = "0294"  # KBank Savings 170-3-27029-4
 
 
-def process_shopeepay_email(report_info, gdrive_service, supabase_client):
+def process_shopeepay_email(report_info, gdrive_service, supabase_client, pending_archives=None):
     """
     Process a single ShopeePay daily-settlement email (body-only, HTML).
 
@@ -595,13 +661,17 @@ def process_shopeepay_email(report_info, gdrive_service, supabase_client):
                           when the parser produced one — see logic below)
         "FAILED"        — parser broke or DB/Drive errored; caller applies
                           SHOPEEPAY_EMAIL_FAILED so the next run retries
+        "PENDING"       — only with `pending_archives`: parsed and appended
+                          there; the caller finishes all of them with one
+                          finish_shopeepay_emails call
 
     Idempotency: ordering is DB-upsert first → Drive archive → DB update with
     gdrive_file_id. The DB upsert is keyed on UNIQUE(settlement_date) so
-    duplicate-resend emails collapse. The Drive upload is skipped when a row
-    already has a non-null gdrive_file_id (handles the failure window where a
-    prior run loaded to DB but couldn't upload to Drive — next run picks up
-    where it left off without re-uploading on the happy path).
+    duplicate-resend emails collapse, and it keeps an existing gdrive_file_id
+    in the same statement. The Drive upload is skipped when a row already has
+    a non-null gdrive_file_id (handles the failure window where a prior run
+    loaded to DB but couldn't upload to Drive — next run picks up where it
+    left off without re-uploading on the happy path).
     """
     message_id = report_info.get("message_id")
     subject = report_info.get("subject", "")
@@ -647,30 +717,8 @@ def process_shopeepay_email(report_info, gdrive_service, supabase_client):
         logger.error(f"Supabase client unavailable — cannot load ShopeePay email {message_id}")
         return "FAILED"
 
-    # Step 1: read any existing row for this settlement_date to recover gdrive_file_id
-    # set by an earlier (partially-successful) run.
-    sb = supabase_client
-    try:
-        table_query = (
-            sb.schema(config.SUPABASE_SCHEMA).table("shopeepay_daily_settlements")
-            if config.SUPABASE_SCHEMA
-            else sb.table("shopeepay_daily_settlements")
-        )
-        existing = (
-            table_query.select("gdrive_file_id")
-            .eq("settlement_date", parsed["settlement_date"])
-            .execute()
-        )
-        existing_gdrive_file_id = (existing.data or [{}])[0].get("gdrive_file_id") if existing.data else None
-    except Exception as e:
-        logger.error(
-            f"ShopeePay {message_id}: failed to read existing row: {e}",
-            exc_info=True,
-        )
-        return "FAILED"
-
-    # Step 2: upsert row. Don't clobber an existing gdrive_file_id with NULL —
-    # carry it forward if we already archived in a prior run.
+    # Step 1 (in finish_shopeepay_emails): upsert row. The upsert RPC keeps an
+    # existing gdrive_file_id, so NULL here never clobbers an earlier archive.
     record = {
         "settlement_date":         parsed["settlement_date"],
         "gross_amount":            parsed["gross_amount"],
@@ -683,83 +731,126 @@ def process_shopeepay_email(report_info, gdrive_service, supabase_client):
         "net_amount":              parsed["net_amount"],
         "bank_account_tail":       parsed["bank_account_tail"],
         "source_message_id":       message_id,
-        "gdrive_file_id":          existing_gdrive_file_id,
+        "gdrive_file_id":          None,
         "raw_body":                body_raw,
         # `updated_at` deliberately omitted — DB default `now()` is used.
     }
-    success, failure = load_shopeepay_settlements([record])
-    if failure > 0 or success == 0:
-        logger.error(
-            f"ShopeePay {message_id}: load failed (success={success} failure={failure})"
+    pending = {
+        "report_info": report_info,
+        "record": record,
+        "parsed": parsed,
+        "body_raw": body_raw,
+        "body_text": body_text,
+        "outcome": outcome,
+    }
+    if pending_archives is not None:
+        pending_archives.append(pending)
+        return "PENDING"
+    return finish_shopeepay_emails([pending], gdrive_service, supabase_client)[0]
+
+
+def finish_shopeepay_emails(pending_archives, gdrive_service, supabase_client):
+    """
+    Steps 1-3 for parsed ShopeePay emails: one upsert RPC for all their rows,
+    which also reports each row's gdrive_file_id, then the Drive archive for
+    rows not yet archived. Entries whose row was not written fail on their own.
+    Returns the final outcome of each entry of `pending_archives`, in order.
+    """
+    archived = upsert_shopeepay_settlements([pending["record"] for pending in pending_archives])
+    if archived is None:
+        for pending in pending_archives:
+            logger.error(f"ShopeePay {pending['report_info'].get('message_id')}: load failed")
+        return ["FAILED"] * len(pending_archives)
+
+    outcomes = []
+    for pending in pending_archives:
+        parsed = pending["parsed"]
+        if parsed["settlement_date"] not in archived:
+            logger.error(f"ShopeePay {pending['report_info'].get('message_id')}: "
+                         f"settlement_date={parsed['settlement_date']} load failed")
+            outcomes.append("FAILED")
+            continue
+        # Record the new ID so a same-day resend later in this batch isn't uploaded twice.
+        archived[parsed["settlement_date"]] = _archive_shopeepay_email(
+            pending, archived.get(parsed["settlement_date"]), gdrive_service, supabase_client
         )
-        return "FAILED"
+        logger.info(
+            f"ShopeePay {pending['outcome']}: settlement_date={parsed['settlement_date']} "
+            f"net={parsed['net_amount']} message_id={pending['report_info'].get('message_id')}"
+        )
+        outcomes.append(pending["outcome"])
+    return outcomes
 
-    # Step 3: archive to Drive ONLY if not already done. Drive failure is
-    # non-fatal — the row is in the DB; next run will pick up the missing
-    # gdrive_file_id and retry the upload.
+
+def _archive_shopeepay_email(pending, existing_gdrive_file_id, gdrive_service, supabase_client):
+    """
+    Step 3: archive to Drive ONLY if not already done. Drive failure is
+    non-fatal — the row is in the DB; next run will pick up the missing
+    gdrive_file_id and retry the upload. Returns the row's gdrive_file_id
+    afterwards (None if still not archived).
+    """
+    report_info = pending["report_info"]
+    parsed = pending["parsed"]
+    message_id = report_info.get("message_id")
     if existing_gdrive_file_id:
         logger.info(
             f"ShopeePay {message_id}: settlement_date={parsed['settlement_date']} "
             f"already archived (gdrive_file_id={existing_gdrive_file_id}) — skipping upload"
         )
-    elif not gdrive_service:
+        return existing_gdrive_file_id
+    if not gdrive_service:
         logger.warning(
             f"ShopeePay {message_id}: GDrive service unavailable — DB row written without archive"
         )
-    else:
-        try:
-            root_folder_id = config.GDRIVE_SHOPEEPAY_ROOT_FOLDER_ID or gdrive_handler.find_or_create_folder(
-                gdrive_service, config.GDRIVE_ROOT_FOLDER_ID, "ShopeePay"
-            )
-            day_folder_id = _ensure_gdrive_folder_structure(
-                gdrive_service, parsed["settlement_date"], root_folder_id
-            )
-            if not day_folder_id:
-                logger.error(f"ShopeePay {message_id}: could not create Drive day folder")
-                return outcome  # DB succeeded; treat as soft success
+        return None
+    try:
+        root_folder_id = config.GDRIVE_SHOPEEPAY_ROOT_FOLDER_ID or gdrive_handler.find_or_create_folder(
+            gdrive_service, config.GDRIVE_ROOT_FOLDER_ID, "ShopeePay"
+        )
+        day_folder_id = _ensure_gdrive_folder_structure(
+            gdrive_service, parsed["settlement_date"], root_folder_id
+        )
+        if not day_folder_id:
+            logger.error(f"ShopeePay {message_id}: could not create Drive day folder")
+            return None  # DB succeeded; treat as soft success
+
+        ext = "html" if report_info.get("body_kind") == "html" else "txt"
+        # Through archive_files_to_folder so a deleted day folder is re-created
+        # and the upload retried; the listing also reuses a file left by an
+        # earlier run whose gdrive_file_id patch failed.
+        (gdrive_file_id,) = gdrive_handler.archive_files_to_folder(
+            gdrive_service,
+            day_folder_id,
+            [((pending["body_raw"] if pending["body_raw"] else pending["body_text"]).encode("utf-8"),
+              f"shopeepay-settlement-{parsed['settlement_date']}.{ext}")],
+            resolve_folder=lambda: _ensure_gdrive_folder_structure(
+                gdrive_service, parsed["settlement_date"], root_folder_id),
+        )
 
-            ext = "html" if report_info.get("body_kind") == "html" else "txt"
-            local_file = None
+        if gdrive_file_id:
+            # Patch the row with the freshly-uploaded gdrive_file_id.
             try:
-                fd, local_file = tempfile.mkstemp(
-                    prefix=f"shopeepay-settlement-{parsed['settlement_date']}-",
-                    suffix=f".{ext}",
+                table_query = (
+                    supabase_client.schema(config.SUPABASE_SCHEMA).table("shopeepay_daily_settlements")
+                    if config.SUPABASE_SCHEMA
+                    else supabase_client.table("shopeepay_daily_settlements")
                 )
-                with os.fdopen(fd, "w", encoding="utf-8") as f:
-                    f.write(body_raw if body_raw else body_text)
-                gdrive_file_id = gdrive_handler.upload_file_to_gdrive(
-                    gdrive_service,
-                    local_file,
-                    day_folder_id,
-                    remote_filename=f"shopeepay-settlement-{parsed['settlement_date']}.{ext}",
+                table_query.update({"gdrive_file_id": gdrive_file_id}).eq(
+                    "settlement_date", parsed["settlement_date"]
+                ).execute()
+            except Exception as e:
+                logger.warning(
+                    f"ShopeePay {message_id}: failed to patch gdrive_file_id: {e}"
                 )
-            finally:
-                if local_file and os.path.exists(local_file):
-                    os.remove(local_file)
-
-            if gdrive_file_id:
-                # Patch the row with the freshly-uploaded gdrive_file_id.
-                try:
-                    table_query.update({"gdrive_file_id": gdrive_file_id}).eq(
-                        "settlement_date", parsed["settlement_date"]
-                    ).execute()
-                except Exception as e:
-                    logger.warning(
-                        f"ShopeePay {message_id}: failed to patch gdrive_file_id: {e}"
-                    )
-            else:
-                logger.warning(f"ShopeePay {message_id}: Drive upload returned no file_id")
-        except Exception as e:
-            logger.warning(
-                f"ShopeePay {message_id}: Drive archive failed (non-fatal): {e}",
-                exc_info=True,
-            )
-
-    logger.info(
-        f"ShopeePay {outcome}: settlement_date={parsed['settlement_date']} "
-        f"net={parsed['net_amount']} message_id={message_id}"
-    )
-    return outcome
+            return gdrive_file_id
+        else:
+            logger.warning(f"ShopeePay {message_id}: Drive upload returned no file_id")
+    except Exception as e:
+        logger.warning(
+            f"ShopeePay {message_id}: Drive archive failed (non-fatal): {e}",
+            exc_info=True,
+        )
+    return None
 
 
 def main():
@@ -768,6 +859,7 @@ def main():
     # --- Define Report Configurations ---
     KMERCHANT_ZIP_CONFIG = {
         'search_query': 'subject:("K-Merchant Reports as of") has:attachment',
+        'subject_phrase': "K-Merchant Reports as of",
         'desired_filename_extension': ".zip",
         'report_type': "KMERCHANT_ZIP",
         'file_path_key': "zip_path",
@@ -776,6 +868,7 @@ def main():
     }
     EWALLET_CSV_CONFIG = {
         'search_query': 'subject:("EWALLET REPORT") has:attachment filename:.csv',
+        'subject_phrase': "EWALLET REPORT",
         'desired_filename_extension': ".csv",
         'report_type': "EWALLET_CSV",
         'file_path_key': "csv_path",
@@ -784,6 +877,7 @@ def main():
     }
     EWALLET_ETAX_PDF_CONFIG = {
         'search_query': 'subject:("E-TAX INVOICE FOR EWALLET") has:attachment filename:.pdf',
+        'subject_phrase': "E-TAX INVOICE FOR EWALLET",
         'desired_filename_extension': ".pdf",
         'report_type': "EWALLET_ETAX_PDF",
         'file_path_key': "pdf_path",
@@ -801,6 +895,11 @@ def main():
         logging.error("Failed to initialize Gmail service. Exiting.")
         return
     logging.info("Gmail service initialized successfully.")
+    # Resolve every LABEL_* up front so per-message add/remove calls hit the registry.
+    email_handler.resolve_label_ids(gmail_service)
+    # Label changes are queued per message and applied with batchModify at the
+    # end of the run (or on exit, if the run dies part-way).
+    label_batch = email_handler.LabelMutationBatch(gmail_service)
 
     logging.info("Initializing Google Drive service...")
     gdrive_service = gdrive_handler.get_gdrive_service()
@@ -818,22 +917,28 @@ def main():
 
 
     # --- Fetch all types of reports ---
+    # ShopeePay daily settlement emails have no attachments and live in the HTML
+    # body, so they are routed to a separate (body-only) processing loop below.
+    SHOPEEPAY_EMAIL_CONFIG = {
+        "search_query":    "from:support_th@shopeepay.com",
+        "from_phrase":     "support_th@shopeepay.com",
+        "processed_label": email_handler.LABEL_SHOPEEPAY_EMAIL_PROCESSED,
+        "failed_label":    email_handler.LABEL_SHOPEEPAY_EMAIL_FAILED,
+    }
+    logging.info(f"Fetching reports for types: {[rc['report_type'] for rc in report_configs]} + ShopeePay (one combined search)...")
+    try:
+        all_fetched_reports, shopeepay_items = email_handler.fetch_all_new_reports(
+            gmail_service,
+            config.DOWNLOAD_REPORTS_DIR,
+            report_configs,
+            [SHOPEEPAY_EMAIL_CONFIG],
+        )
+    except Exception as e_fetch:
+        logging.error(f"Error fetching reports: {e_fetch}", exc_info=True)
+        all_fetched_reports, shopeepay_items = [], []
     for rep_config in report_configs:
-        logging.info(f"Fetching reports for type: {rep_config['report_type']}...")
-        try:
-            fetched_items = email_handler.fetch_new_reports(
-                gmail_service,
-                rep_config['search_query'],
-                config.DOWNLOAD_REPORTS_DIR,
-                rep_config 
-            )
-            if fetched_items:
-                all_fetched_reports.extend(fetched_items)
-                logging.info(f"Fetched {len(fetched_items)} items for type: {rep_config['report_type']}.")
-            else:
-                logging.info(f"No new items found for type: {rep_config['report_type']}.")
-        except Exception as e_fetch:
-            logging.error(f"Error fetching reports for type {rep_config['report_type']}: {e_fetch}", exc_info=True)
+        fetched_count = sum(1 for item in all_fetched_reports if item['report_type'] == rep_config['report_type'])
+        logging.info(f"Fetched {fetched_count} items for type: {rep_config['report_type']}.")
 
 
     if not all_fetched_reports:
@@ -842,6 +947,33 @@ def main():
     logging.info(f"Fetched a total of {len(all_fetched_reports)} new report item(s) across all types.")
     successful_processing_count = 0
     failed_processing_count = 0
+    etax_csv_summaries = None
+    etax_prefetch_attempted = False  # at most once per run; None afterwards means per-PDF lookups
+    # Parsed e-Tax PDFs whose tax_invoice_no is written in one bulk call after the loop.
+    etax_pending_updates = []
+    etax_pending_reports = []
+    # Summary rows from ZIPs and eWallet CSVs are written in a few bulk upserts;
+    # those reports are labeled once their rows have been flushed.
+    write_buffer = WriteBuffer()
+    buffered_reports = []
+
+    def settle_buffered_reports():
+        nonlocal successful_processing_count, failed_processing_count
+        write_buffer.flush()
+        for buffered_info, buffered_config in buffered_reports:
+            msg_id = buffered_info['message_id']
+            filename = buffered_info['original_filename']
+            if write_buffer.succeeded(_write_source(buffered_info)):
+                successful_processing_count += 1
+                logging.info(f"Successfully processed: {buffered_info['report_type']} from Message ID: {msg_id}, File: {filename}.")
+                label_batch.add_labels(msg_id, buffered_config['processed_label'])
+                label_batch.mark_as_read(msg_id)
+                label_batch.remove_labels(msg_id, buffered_config['failed_label'])
+            else:
+                failed_processing_count += 1
+                logging.error(f"Failed to load data for: {buffered_info['report_type']} from Message ID: {msg_id}, File: {filename}.")
+                label_batch.add_labels(msg_id, buffered_config['failed_label'])
+        buffered_reports.clear()
 
     for report_info in all_fetched_reports:
         report_type = report_info['report_type']
@@ -868,39 +1000,53 @@ def main():
         try:
             if report_type == "KMERCHANT_ZIP":
                 if not gdrive_service: logging.warning("GDrive service unavailable for KMERCHANT_ZIP processing.")
-                processing_successful = process_single_zip(report_info, gdrive_service)
+                processing_successful = process_single_zip(report_info, gdrive_service, write_buffer)
             elif report_type == "EWALLET_CSV":
                 if not supabase_client: logging.warning("Supabase client unavailable for EWALLET_CSV processing.")
                 if not gdrive_service: logging.warning("GDrive service unavailable for EWALLET_CSV processing.")
-                processing_successful = process_ewallet_csv(report_info, gdrive_service, supabase_client)
+                processing_successful = process_ewallet_csv(report_info, gdrive_service, supabase_client, write_buffer)
             elif report_type == "EWALLET_ETAX_PDF":
                 if not gdrive_service: logging.warning("GDrive service unavailable for EWALLET_ETAX_PDF processing.")
-                etax_outcome = process_ewallet_etax_pdf(report_info, gdrive_service, supabase_client)
+                if not etax_prefetch_attempted and supabase_client:
+                    # Built at the first PDF, i.e. after this run's EWALLET_CSVs (fetched
+                    # earlier in config order) have been flushed to the DB.
+                    etax_prefetch_attempted = True
+                    settle_buffered_reports()
+                    etax_csv_summaries = _prefetch_etax_csv_summaries(all_fetched_reports)
+                etax_outcome = process_ewallet_etax_pdf(report_info, gdrive_service, supabase_client,
+                                                        csv_summaries=etax_csv_summaries,
+                                                        pending_updates=etax_pending_updates)
                 processing_successful = (etax_outcome == "PROCESSED")
+                if etax_outcome == "PENDING":
+                    etax_pending_reports.append((report_info, current_config))
             else:
                 logging.warning(f"Unknown report type: {report_type} for message {message_id}, file {original_filename}. Skipping.")
                 processing_successful = False
 
-            if etax_outcome == "RETRY":
+            if etax_outcome == "PENDING":
+                logging.info(f"Parsed EWALLET_ETAX_PDF {original_filename}; labeling after the bulk tax_invoice_no update.")
+            elif etax_outcome == "RETRY":
                 # Don't label either way — leave the email un-touched so the next scheduled run picks it up.
                 logging.info(
                     f"Deferred labeling for EWALLET_ETAX_PDF (MsgID: {message_id}, File: {original_filename}) — will retry on next run."
                 )
+            elif processing_successful and write_buffer.is_buffered(_write_source(report_info)):
+                buffered_reports.append((report_info, current_config))
             elif processing_successful:
                 successful_processing_count += 1
                 logging.info(f"Successfully processed: {report_type} from Message ID: {message_id}, File: {original_filename}.")
-                email_handler.add_label_to_email(gmail_service, message_id, current_processed_label)
-                email_handler.mark_email_as_read(gmail_service, message_id)
-                email_handler.remove_label_from_email(gmail_service, message_id, current_failed_label) # Remove fail label if it was there
+                label_batch.add_labels(message_id, current_processed_label)
+                label_batch.mark_as_read(message_id)
+                label_batch.remove_labels(message_id, current_failed_label) # Remove fail label if it was there
             else:
                 failed_processing_count += 1
                 logging.error(f"Failed to process: {report_type} from Message ID: {message_id}, File: {original_filename}.")
-                email_handler.add_label_to_email(gmail_service, message_id, current_failed_label)
+                label_batch.add_labels(message_id, current_failed_label)
 
         except Exception as e_proc:
             failed_processing_count += 1
             logging.error(f"Unhandled exception processing {report_type} (MsgID: {message_id}, File: {original_filename}): {e_proc}", exc_info=True)
-            email_handler.add_label_to_email(gmail_service, message_id, current_failed_label)
+            label_batch.add_labels(message_id, current_failed_label)
 
 
         # Clean up the downloaded file after processing attempt
@@ -913,64 +1059,84 @@ def main():
         except OSError as e_del:
             logging.error(f"Error deleting file {downloaded_file_path}: {e_del}")
 
-    # --- P4-SHOPEEPAY: body-only ShopeePay daily settlement emails ---
-    # These have no attachments and live in HTML body, so they use a separate
-    # fetch path and a separate processing loop.
-    SHOPEEPAY_EMAIL_CONFIG = {
-        "search_query":    "from:support_th@shopeepay.com",
-        "processed_label": email_handler.LABEL_SHOPEEPAY_EMAIL_PROCESSED,
-        "failed_label":    email_handler.LABEL_SHOPEEPAY_EMAIL_FAILED,
-    }
-    try:
-        shopeepay_items = email_handler.fetch_new_body_only_reports(
-            gmail_service,
-            SHOPEEPAY_EMAIL_CONFIG["search_query"],
-            SHOPEEPAY_EMAIL_CONFIG["processed_label"],
-        )
-    except Exception as e_fetch_sp:
-        logging.error(f"Error fetching ShopeePay emails: {e_fetch_sp}", exc_info=True)
-        shopeepay_items = []
+    settle_buffered_reports()
+
+    if etax_pending_updates:
+        try:
+            etax_outcomes = apply_ewallet_etax_updates(etax_pending_updates)
+        except Exception as e_etax:
+            logging.error(f"Unhandled exception in bulk tax_invoice_no update: {e_etax}", exc_info=True)
+            etax_outcomes = ["RETRY"] * len(etax_pending_updates)
+        for (report_info, etax_config), etax_outcome in zip(etax_pending_reports, etax_outcomes):
+            message_id = report_info['message_id']
+            original_filename = report_info['original_filename']
+            if etax_outcome == "PROCESSED":
+                successful_processing_count += 1
+                logging.info(f"Successfully processed: EWALLET_ETAX_PDF from Message ID: {message_id}, File: {original_filename}.")
+                label_batch.add_labels(message_id, etax_config['processed_label'])
+                label_batch.mark_as_read(message_id)
+                label_batch.remove_labels(message_id, etax_config['failed_label'])
+            else:
+                logging.info(
+                    f"Deferred labeling for EWALLET_ETAX_PDF (MsgID: {message_id}, File: {original_filename}) — will retry on next run."
+                )
 
+    # --- P4-SHOPEEPAY: body-only ShopeePay daily settlement emails ---
+    # Fetched together with the attachment reports above.
     shopeepay_success = 0
     shopeepay_needs_review = 0
     shopeepay_failure = 0
+    # Rows of every email go out in one upsert RPC; the Drive archive runs
+    # afterwards for the rows that still need it.
+    shopeepay_outcomes = {}
+    shopeepay_pending = []
     for ri in shopeepay_items:
         sp_msg_id = ri.get("message_id")
         try:
-            outcome = process_shopeepay_email(ri, gdrive_service, supabase_client)
+            shopeepay_outcomes[sp_msg_id] = process_shopeepay_email(
+                ri, gdrive_service, supabase_client, pending_archives=shopeepay_pending,
+            )
         except Exception as e_proc_sp:
             logger.error(
                 f"Unhandled exception processing ShopeePay email {sp_msg_id}: {e_proc_sp}",
                 exc_info=True,
             )
-            outcome = "FAILED"
+            shopeepay_outcomes[sp_msg_id] = "FAILED"
+    if shopeepay_pending:
+        try:
+            finished = finish_shopeepay_emails(shopeepay_pending, gdrive_service, supabase_client)
+        except Exception as e_proc_sp:
+            logger.error(f"Unhandled exception finishing ShopeePay emails: {e_proc_sp}", exc_info=True)
+            finished = ["FAILED"] * len(shopeepay_pending)
+        for pending, outcome in zip(shopeepay_pending, finished):
+            shopeepay_outcomes[pending["report_info"].get("message_id")] = outcome
+
+    for ri in shopeepay_items:
+        sp_msg_id = ri.get("message_id")
+        outcome = shopeepay_outcomes[sp_msg_id]
         if outcome == "PROCESSED":
             shopeepay_success += 1
-            email_handler.add_label_to_email(
-                gmail_service, sp_msg_id, SHOPEEPAY_EMAIL_CONFIG["processed_label"]
-            )
-            email_handler.mark_email_as_read(gmail_service, sp_msg_id)
-            email_handler.remove_label_from_email(
-                gmail_service, sp_msg_id, SHOPEEPAY_EMAIL_CONFIG["failed_label"]
-            )
-            email_handler.remove_label_from_email(
-                gmail_service, sp_msg_id, email_handler.LABEL_SHOPEEPAY_EMAIL_NEEDS_REVIEW
+            label_batch.add_labels(sp_msg_id, SHOPEEPAY_EMAIL_CONFIG["processed_label"])
+            label_batch.mark_as_read(sp_msg_id)
+            label_batch.remove_labels(
+                sp_msg_id,
+                SHOPEEPAY_EMAIL_CONFIG["failed_label"],
+                email_handler.LABEL_SHOPEEPAY_EMAIL_NEEDS_REVIEW,
             )
         elif outcome == "NEEDS_REVIEW":
             # Row was still ingested; flag for human follow-up. Also stop
             # re-fetching via the PROCESSED label since the data is in the DB.
             shopeepay_needs_review += 1
-            email_handler.add_label_to_email(
-                gmail_service, sp_msg_id, email_handler.LABEL_SHOPEEPAY_EMAIL_NEEDS_REVIEW
-            )
-            email_handler.add_label_to_email(
-                gmail_service, sp_msg_id, SHOPEEPAY_EMAIL_CONFIG["processed_label"]
+            label_batch.add_labels(
+                sp_msg_id,
+                email_handler.LABEL_SHOPEEPAY_EMAIL_NEEDS_REVIEW,
+                SHOPEEPAY_EMAIL_CONFIG["processed_label"],
             )
         else:  # "FAILED"
             shopeepay_failure += 1
-            email_handler.add_label_to_email(
-                gmail_service, sp_msg_id, SHOPEEPAY_EMAIL_CONFIG["failed_label"]
-            )
+            label_batch.add_labels(sp_msg_id, SHOPEEPAY_EMAIL_CONFIG["failed_label"])
+
+    applied_labels, failed_labels = label_batch.flush()
 
     logging.info("\n--- Processing Summary ---")
     logging.info(f"Total reports processed: {len(all_fetched_reports)}")
@@ -981,6 +1147,19 @@ def main():
         f"{shopeepay_success} succeeded, {shopeepay_needs_review} needs-review, "
         f"{shopeepay_failure} failed."
     )
+    logger.info(
+        f"Gmail labels: {applied_labels} message(s) updated via batchModify, "
+        f"{len(failed_labels)} failed (will be picked up again next run)."
+    )
+    upload_stats = gdrive_handler.get_upload_stats()
+    logger.info(
+        f"Google Drive archive: {upload_stats['uploaded_files']} file(s) uploaded "
+        f"({upload_stats['uploaded_bytes']} bytes), {upload_stats['skipped_files']} unchanged "
+        f"file(s) skipped ({upload_stats['skipped_bytes']} bytes)."
+    )
 
 if __name__ == '__main__':
+    # Turn SIGTERM (e.g. a cancelled Actions job) into a normal exit so queued
+    # Gmail label changes are still flushed by the atexit hook.
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(128 + signum))
     main() 
\ No newline at end of file
@@ -0,0 +1,215 @@
+import json
+import logging
+import random
+import threading
+import time
+
+from googleapiclient.errors import HttpError
+
+from . import config
+
+logger = logging.getLogger(__name__)
+
+# Statuses worth retrying: throttling and transient server errors.
+RETRYABLE_STATUSES = frozenset({429, 500, 502, 503, 504})
+# Gmail/Drive also signal throttling as 403 with one of these reasons.
+RATE_LIMIT_REASONS = frozenset({'rateLimitExceeded', 'userRateLimitExceeded'})
+
+RETRY_BASE_DELAY_SECONDS = 1.0
+RETRY_MAX_DELAY_SECONDS = 32.0
+
+# Gmail per-user quota units per method
+# (https://developers.google.com/gmail/api/reference/quota). Drive counts
+# plain requests, so every Drive call costs 1.
+GMAIL_QUOTA_UNITS = {
+    'messages.list': 5,
+    'messages.get': 5,
+    'messages.modify': 5,
+    'messages.batchModify': 50,
+    'attachments.get': 5,
+    'labels.list': 1,
+    'labels.create': 5,
+    'history.list': 2,
+    'getProfile': 1,
+}
+
+# A throttled call halves the limiter's concurrency and refill rate; this many
+# consecutive successes win one slot (and 10% of the rate) back.
+RECOVERY_SUCCESSES = 20
+MIN_RATE_FRACTION = 0.1
+
+
+class TokenBucket:
+    """Blocking token bucket: `rate` tokens per second, at most `capacity` banked."""
+
+    def __init__(self, rate, capacity):
+        self.rate = float(rate)
+        self.capacity = float(capacity)
+        self._tokens = float(capacity)
+        self._updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def _refill(self):
+        now = time.monotonic()
+        self._tokens = min(self.capacity, self._tokens + (now - self._updated) * self.rate)
+        self._updated = now
+
+    def acquire(self, tokens=1):
+        tokens = min(float(tokens), self.capacity)
+        while True:
+            with self._lock:
+                self._refill()
+                if self._tokens >= tokens:
+                    self._tokens -= tokens
+                    return
+                wait = (tokens - self._tokens) / self.rate
+            time.sleep(wait)
+
+
+class AdaptiveLimiter:
+    """
+    Gates calls to one API: a token bucket sized to the per-user quota plus a
+    concurrency cap. Both back off multiplicatively when the API throttles and
+    recover additively while calls succeed, so worker pools settle just under
+    the quota instead of hammering it.
+    """
+
+    def __init__(self, name, rate, max_concurrency):
+        self.name = name
+        self.max_rate = float(rate)
+        self.max_concurrency = max(1, int(max_concurrency))
+        self.bucket = TokenBucket(rate, capacity=rate)
+        self.concurrency = self.max_concurrency
+        self._in_flight = 0
+        self._successes = 0
+        self._cond = threading.Condition()
+
+    def acquire(self, units=1):
+        with self._cond:
+            while self._in_flight >= self.concurrency:
+                self._cond.wait()
+            self._in_flight += 1
+        self.bucket.acquire(units)
+
+    def release(self):
+        with self._cond:
+            self._in_flight -= 1
+            self._cond.notify()
+
+    def on_success(self):
+        with self._cond:
+            self._successes += 1
+            if self._successes < RECOVERY_SUCCESSES:
+                return
+            self._successes = 0
+            if self.concurrency < self.max_concurrency:
+                self.concurrency += 1
+                self._cond.notify()
+            self.bucket.rate = min(self.max_rate, self.bucket.rate + self.max_rate * 0.1)
+
+    def on_throttle(self):
+        with self._cond:
+            self._successes = 0
+            self.concurrency = max(1, self.concurrency // 2)
+            self.bucket.rate = max(self.max_rate * MIN_RATE_FRACTION, self.bucket.rate / 2)
+            logger.warning(f"{self.name} API throttled; concurrency now {self.concurrency}, "
+                           f"rate {self.bucket.rate:.0f}/s.")
+
+
+_limiters = {}
+_limiters_lock = threading.Lock()
+
+
+def get_limiter(api):
+    """Returns the process-wide limiter for 'gmail' or 'drive'."""
+    with _limiters_lock:
+        limiter = _limiters.get(api)
+        if limiter is None:
+            rate = config.GMAIL_QUOTA_UNITS_PER_SECOND if api == 'gmail' else config.DRIVE_REQUESTS_PER_SECOND
+            limiter = _limiters[api] = AdaptiveLimiter(api, rate, config.GOOGLE_API_MAX_CONCURRENCY)
+        return limiter
+
+
+def reset_limiters():
+    """Drops all limiters so the next call rebuilds them from config."""
+    with _limiters_lock:
+        _limiters.clear()
+
+
+def _error_reasons(error):
+    """The `errors[].reason` values from an HttpError's JSON body."""
+    try:
+        body = json.loads(error.content.decode('utf-8'))
+        return {e.get('reason') for e in body['error'].get('errors', [])}
+    except (AttributeError, KeyError, TypeError, ValueError):
+        return set()
+
+
+def is_throttled(error):
+    """True if `error` is the API asking us to slow down."""
+    status = error.resp.status
+    return status == 429 or (status == 403 and bool(_error_reasons(error) & RATE_LIMIT_REASONS))
+
+
+def is_retryable(error):
+    """True if `error` is transient and the call may simply be repeated."""
+    return error.resp.status in RETRYABLE_STATUSES or is_throttled(error)
+
+
+def backoff_delay(attempt):
+    """Full-jitter exponential backoff for retry number `attempt` (1-based)."""
+    return random.uniform(0, min(RETRY_MAX_DELAY_SECONDS, RETRY_BASE_DELAY_SECONDS * (2 ** attempt)))
+
+
+def call(fn, api, units=1, description=None, idempotent=True):
+    """
+    Calls `fn()` under the `api` limiter, retrying throttling, 5xx and
+    connection errors with jittered exponential backoff up to
+    GOOGLE_API_MAX_ATTEMPTS times. The last error is re-raised, so callers keep
+    their existing HttpError handling.
+
+    Non-idempotent calls (creates) are only retried when throttled: a 5xx or a
+    dropped connection may arrive after the server already acted, and a repeat
+    would then create a duplicate.
+    """
+    limiter = get_limiter(api)
+    max_attempts = max(1, config.GOOGLE_API_MAX_ATTEMPTS)
+    for attempt in range(1, max_attempts + 1):
+        limiter.acquire(units)
+        try:
+            result = fn()
+        except HttpError as error:
+            throttled = is_throttled(error)
+            if throttled:
+                limiter.on_throttle()
+            retryable = throttled if not idempotent else is_retryable(error)
+            if not retryable or attempt == max_attempts:
+                raise
+            logger.info(f"{description or api} call failed with HTTP {error.resp.status}; "
+                        f"retrying (attempt {attempt + 1}/{max_attempts}).")
+        except (ConnectionError, TimeoutError) as error:
+            if not idempotent or attempt == max_attempts:
+                raise
+            logger.info(f"{description or api} call failed ({error}); retrying (attempt {attempt + 1}/{max_attempts}).")
+        else:
+            limiter.on_success()
+            return result
+        finally:
+            limiter.release()
+        time.sleep(backoff_delay(attempt))
+
+
+def execute(request, api, units=1, idempotent=True):
+    """Runs `request.execute()` through `call()`; the request's method id names it in logs."""
+    return call(request.execute, api, units=units, description=getattr(request, 'methodId', None),
+                idempotent=idempotent)
+
+
+def gmail(request, method):
+    """Executes a Gmail request, charging the quota units of `method`."""
+    return execute(request, 'gmail', units=GMAIL_QUOTA_UNITS.get(method, 5))
+
+
+def drive(request, idempotent=True):
+    """Executes a Drive request; pass idempotent=False for creates."""
+    return execute(request, 'drive', idempotent=idempotent)
@@ -54,6 +54,44 @@ def extract_zip(zip_path, output_dir):
         logging.error(f"An unexpected error occurred during ZIP extraction: {e} for file {zip_path}")
         return []
 
+def read_zip_members(zip_path):
+    """
+    Reads every file in a password-protected ZIP into memory, without
+    extracting anything to disk.
+
+    Args:
+        zip_path (str): The path to the ZIP file.
+
+    Returns:
+        list: (member_name, bytes) tuples in archive order, or an empty list if reading fails.
+    """
+    if not os.path.exists(zip_path):
+        logging.error(f"ZIP file not found: {zip_path}")
+        return []
+
+    if not ZIP_PASSWORD:
+        logging.error("ZIP_PASSWORD is not configured. Please set it in the .env file.")
+        return []
+
+    try:
+        with zipfile.ZipFile(zip_path, 'r') as zip_ref:
+            pwd = ZIP_PASSWORD.encode('utf-8')
+            members = [(info.filename, zip_ref.read(info, pwd=pwd)) for info in zip_ref.infolist() if not info.is_dir()]
+        logging.info(f"Read {len(members)} files from {zip_path} into memory")
+        return members
+    except zipfile.BadZipFile:
+        logging.error(f"Bad ZIP file or incorrect password for: {zip_path}. Please check the password and file integrity.")
+        return []
+    except RuntimeError as e:
+        if 'password' in str(e).lower():
+            logging.error(f"RuntimeError: Incorrect password for ZIP file: {zip_path}")
+        else:
+            logging.error(f"RuntimeError while reading ZIP: {e} for file {zip_path}")
+        return []
+    except Exception as e:
+        logging.error(f"An unexpected error occurred while reading ZIP: {e} for file {zip_path}")
+        return []
+
 if __name__ == '__main__':
     # Example Usage (for testing this module directly)
     # Make sure to create a dummy .env file in the root with ZIP_PASSWORD="your_test_password"
@@ -0,0 +1,99 @@
+"""
+Applies Google API `fields=` partial-response masks to fake services, so tests
+see exactly the keys a real API call with the same mask would return.
+"""
+
+
+def parse_fields(mask):
+    """Parses a fields mask ("a,b(c,d/e)") into a tree {name: subtree or None (whole value)}."""
+    tree, end = _parse(mask, 0)
+    if end != len(mask):
+        raise ValueError(f"Unbalanced fields mask: {mask!r}")
+    return tree
+
+
+def _parse(mask, i):
+    tree = {}
+    while i < len(mask):
+        start = i
+        while i < len(mask) and mask[i] not in ',()':
+            i += 1
+        path = mask[start:i].strip().split('/')
+        if not all(path):
+            raise ValueError(f"Empty field name in mask: {mask!r}")
+        node = tree
+        for name in path[:-1]:
+            node = node.setdefault(name, {})
+        leaf = path[-1]
+        if i < len(mask) and mask[i] == '(':
+            subtree, i = _parse(mask, i + 1)
+            if i >= len(mask) or mask[i] != ')':
+                raise ValueError(f"Unbalanced fields mask: {mask!r}")
+            i += 1
+            node[leaf] = _merge(node.get(leaf, {}), subtree)
+        else:
+            node[leaf] = None
+        if i < len(mask) and mask[i] == ',':
+            i += 1
+            continue
+        if i < len(mask) and mask[i] == ')':
+            return tree, i
+    return tree, i
+
+
+def _merge(existing, subtree):
+    if existing is None:
+        return None
+    merged = dict(existing)
+    merged.update(subtree)
+    return merged
+
+
+def apply_fields(value, tree):
+    """Keeps only the parts of `value` selected by a parsed mask."""
+    if tree is None:
+        return value
+    if isinstance(value, list):
+        return [apply_fields(item, tree) for item in value]
+    if not isinstance(value, dict):
+        return value
+    return {key: apply_fields(value[key], subtree) for key, subtree in tree.items() if key in value}
+
+
+class _MaskedRequest:
+    def __init__(self, request, tree):
+        self._request = request
+        self._tree = tree
+
+    def execute(self, *args, **kwargs):
+        return apply_fields(self._request.execute(*args, **kwargs), self._tree)
+
+    def __getattr__(self, name):
+        return getattr(self._request, name)
+
+
+class Masked:
+    """
+    Wraps a fake service: every request built with fields=... returns only the
+    masked parts of the fake's response from execute(). Requests built without
+    a mask, and everything else, pass through. `masks` records each mask used.
+    """
+
+    def __init__(self, target, masks=None):
+        self._target = target
+        self.masks = [] if masks is None else masks
+
+    def __getattr__(self, name):
+        attr = getattr(self._target, name)
+        if not callable(attr):
+            return attr
+
+        def call(*args, **kwargs):
+            result = attr(*args, **kwargs)
+            if 'fields' in kwargs and kwargs['fields'] is not None:
+                self.masks.append(kwargs['fields'])
+                return _MaskedRequest(result, parse_fields(kwargs['fields']))
+            if isinstance(result, (dict, list, tuple, str, bytes, int, float, type(None))):
+                return result
+            return Masked(result, self.masks)
+        return call
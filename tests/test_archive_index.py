@@ -0,0 +1,140 @@
+"""Unit tests for the local Drive archive index in src.archive_index."""
+
+import httplib2
+import pytest
+from googleapiclient.errors import HttpError
+
+from src import archive_index, config, gdrive_handler, rate_limiter
+
+
+class _Call:
+    def __init__(self, result):
+        self._result = result
+
+    def execute(self, *args, **kwargs):
+        return self._result
+
+
+class FakeDrive:
+    def __init__(self, folders, files):
+        self.folders = folders
+        self.files_ = files
+        self.queries = []
+        self.folder_listing_fails = False
+
+    def files(self):
+        return self
+
+    def list(self, q, **kwargs):
+        self.queries.append(q)
+        if q.startswith("mimeType="):
+            if self.folder_listing_fails:
+                raise HttpError(httplib2.Response({"status": 400}), b"bad request")
+            return _Call({"files": self.folders})
+        return _Call({"files": self.files_})
+
+
+FOLDERS = [
+    {"id": "y", "name": "2025", "parents": ["root"]},
+    {"id": "m", "name": "202505", "parents": ["y"]},
+    {"id": "d", "name": "2025-05-08", "parents": ["m"]},
+]
+
+
+@pytest.fixture(autouse=True)
+def isolated_state(tmp_path, monkeypatch):
+    monkeypatch.setattr(config, "LOCAL_STATE_DIR", str(tmp_path))
+    gdrive_handler.invalidate_folder_cache()
+    rate_limiter.reset_limiters()
+    yield
+    gdrive_handler.invalidate_folder_cache()
+
+
+def _pdf(file_id, name, modified, parents=("d",), trashed=False):
+    return {"id": file_id, "name": name, "parents": list(parents), "md5Checksum": f"md5-{file_id}",
+            "modifiedTime": modified, "trashed": trashed}
+
+
+def _file_queries(drive):
+    return [q for q in drive.queries if not q.startswith("mimeType=")]
+
+
+def test_full_then_incremental_refresh():
+    drive = FakeDrive(FOLDERS, [
+        _pdf("a", "E-TAX_INVOICE_EWALLET_401_08052025.pdf", "2025-05-08T10:00:00.000Z"),
+        _pdf("x", "E-TAX_INVOICE_EWALLET_401_01012020.pdf", "2025-05-08T11:00:00.000Z", parents=("elsewhere",)),
+    ])
+    conn = archive_index.open_index()
+
+    assert archive_index.refresh(drive, conn, "root", "E-TAX_INVOICE_EWALLET_", "application/pdf") == 1
+    assert "trashed = false" in _file_queries(drive)[-1]
+    rows = archive_index.find_files(conn, "E-TAX_INVOICE_EWALLET_")
+    assert [(r["file_id"], r["folder_path"]) for r in rows] == [("a", "2025/202505/2025-05-08")]
+
+    drive.files_ = [
+        _pdf("a", "E-TAX_INVOICE_EWALLET_401_08052025.pdf", "2025-05-09T09:00:00.000Z", trashed=True),
+        _pdf("b", "E-TAX_INVOICE_EWALLET_401_09052025.pdf", "2025-05-09T10:00:00.000Z"),
+    ]
+    archive_index.refresh(drive, conn, "root", "E-TAX_INVOICE_EWALLET_", "application/pdf")
+    # "x" is not below root, so it is skipped and the watermark moves past it.
+    assert "modifiedTime > '2025-05-08T11:00:00.000Z'" in _file_queries(drive)[-1]
+    assert [r["file_id"] for r in archive_index.find_files(conn, "E-TAX_INVOICE_EWALLET_")] == ["b"]
+    assert archive_index.find_files(conn, "E-TAX_INVOICE_EWALLET_", folder_path_prefix="2024/") == []
+
+
+def test_failed_folder_walk_holds_the_watermark():
+    drive = FakeDrive(FOLDERS, [_pdf("a", "E-TAX_INVOICE_EWALLET_401_08052025.pdf", "2025-05-08T10:00:00.000Z")])
+    conn = archive_index.open_index()
+    archive_index.refresh(drive, conn, "root", "E-TAX_INVOICE_EWALLET_")
+
+    drive.folder_listing_fails = True
+    drive.files_ = [
+        _pdf("b", "E-TAX_INVOICE_EWALLET_401_09052025.pdf", "2025-05-09T10:00:00.000Z", parents=("d2",)),
+        _pdf("c", "E-TAX_INVOICE_EWALLET_401_10052025.pdf", "2025-05-10T10:00:00.000Z"),
+    ]
+    archive_index.refresh(drive, conn, "root", "E-TAX_INVOICE_EWALLET_")
+    # "b" could not be placed, so the watermark stays below it.
+    drive.files_ = []
+    archive_index.refresh(drive, conn, "root", "E-TAX_INVOICE_EWALLET_")
+    assert "modifiedTime > '2025-05-08T10:00:00.000Z'" in _file_queries(drive)[-1]
+    assert [r["file_id"] for r in archive_index.find_files(conn, "E-TAX_INVOICE_EWALLET_")] == ["a", "c"]
+
+
+def test_unknown_parent_rewarms_folder_cache():
+    drive = FakeDrive(FOLDERS, [_pdf("a", "E-TAX_INVOICE_EWALLET_401_08052025.pdf", "2025-05-08T10:00:00.000Z")])
+    conn = archive_index.open_index()
+    archive_index.refresh(drive, conn, "root", "E-TAX_INVOICE_EWALLET_")
+
+    # A Day folder created after the cache was warmed.
+    drive.folders = FOLDERS + [{"id": "d2", "name": "2025-05-09", "parents": ["m"]}]
+    drive.files_ = [_pdf("b", "E-TAX_INVOICE_EWALLET_401_09052025.pdf", "2025-05-09T10:00:00.000Z", parents=("d2",))]
+    assert archive_index.refresh(drive, conn, "root", "E-TAX_INVOICE_EWALLET_") == 1
+    rows = archive_index.find_files(conn, "E-TAX_INVOICE_EWALLET_")
+    assert [(r["file_id"], r["folder_path"]) for r in rows] == [
+        ("a", "2025/202505/2025-05-08"), ("b", "2025/202505/2025-05-09")]
+
+
+def test_full_listing_catches_moves(monkeypatch):
+    drive = FakeDrive(FOLDERS, [_pdf("a", "E-TAX_INVOICE_EWALLET_401_08052025.pdf", "2025-05-08T10:00:00.000Z")])
+    conn = archive_index.open_index()
+    archive_index.refresh(drive, conn, "root", "E-TAX_INVOICE_EWALLET_")
+
+    # Moving a file does not bump modifiedTime, so only a full listing notices.
+    drive.files_ = []
+    archive_index.refresh(drive, conn, "root", "E-TAX_INVOICE_EWALLET_")
+    assert "modifiedTime >" in _file_queries(drive)[-1]
+    assert [r["file_id"] for r in archive_index.find_files(conn, "E-TAX_INVOICE_EWALLET_")] == ["a"]
+
+    drive.files_ = [_pdf("b", "E-TAX_INVOICE_EWALLET_401_09052025.pdf", "2025-05-09T10:00:00.000Z")]
+    archive_index.refresh(drive, conn, "root", "E-TAX_INVOICE_EWALLET_", full=True)
+    assert "trashed = false" in _file_queries(drive)[-1]
+    assert [r["file_id"] for r in archive_index.find_files(conn, "E-TAX_INVOICE_EWALLET_")] == ["b"]
+
+    # An overdue periodic full listing runs without being asked for.
+    conn.execute("UPDATE watermarks SET modified_time = '2000-01-01T00:00:00+00:00' WHERE scope LIKE '%|full'")
+    archive_index.refresh(drive, conn, "root", "E-TAX_INVOICE_EWALLET_")
+    assert "trashed = false" in _file_queries(drive)[-1]
+    monkeypatch.setattr(config, "ARCHIVE_INDEX_FULL_REFRESH_DAYS", 0.0)
+    conn.execute("UPDATE watermarks SET modified_time = '2000-01-01T00:00:00+00:00' WHERE scope LIKE '%|full'")
+    archive_index.refresh(drive, conn, "root", "E-TAX_INVOICE_EWALLET_")
+    assert "modifiedTime >" in _file_queries(drive)[-1]
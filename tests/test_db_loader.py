@@ -0,0 +1,312 @@
+"""Unit tests for src.db_loader against a minimal in-memory PostgREST stand-in."""
+
+from types import SimpleNamespace
+
+import httpx
+from postgrest.exceptions import APIError
+
+from src import db_loader
+
+
+class FakeQuery:
+    """Records the builder chain and serves `rows` filtered by eq/in_/gte/lte and paged by range()."""
+
+    def __init__(self, table):
+        self.table = table
+        self.filters = []
+        self.bounds = None
+        self.op = None
+
+    def select(self, columns):
+        self.op = ("select", columns)
+        return self
+
+    def upsert(self, rows, on_conflict=None, count=None, returning=None):
+        self.op = ("upsert", len(rows))
+        self.payload = rows
+        self.minimal = returning == db_loader.ReturnMethod.minimal
+        return self
+
+    def eq(self, column, value):
+        self.filters.append(lambda row: row.get(column) == value)
+        return self
+
+    def in_(self, column, values):
+        self.filters.append(lambda row: row.get(column) in values)
+        return self
+
+    def gte(self, column, value):
+        self.filters.append(lambda row: row.get(column) >= value)
+        return self
+
+    def lte(self, column, value):
+        self.filters.append(lambda row: row.get(column) <= value)
+        return self
+
+    def order(self, column):
+        return self
+
+    def range(self, start, end):
+        self.bounds = (start, end)
+        return self
+
+    def execute(self):
+        self.table.executed.append(self.op)
+        if self.op[0] == "upsert":
+            if self.table.outage:
+                raise httpx.ConnectError("simulated outage")
+            if any(row.get("process_date") in self.table.rejected_dates for row in self.payload):
+                raise APIError({"code": "23514", "message": "simulated check constraint violation"})
+            self.table.rows.extend(self.payload)
+            if self.minimal:
+                return SimpleNamespace(data=[], count=len(self.payload))
+            return SimpleNamespace(data=self.payload, count=None)
+        rows = [row for row in self.table.rows if all(f(row) for f in self.filters)]
+        if self.bounds:
+            rows = rows[self.bounds[0]:self.bounds[1] + 1]
+        return SimpleNamespace(data=rows)
+
+
+class FakeTable:
+    def __init__(self, rows):
+        self.rows = rows
+        self.executed = []
+        self.rejected_dates = set()
+        self.outage = False
+
+
+class FakeClient:
+    def __init__(self, rows):
+        self.summaries = FakeTable(rows)
+        self.rpc_error = None
+        self.rpc_dropped_dates = set()
+
+    def schema(self, name):
+        return self
+
+    def table(self, name):
+        return FakeQuery(self.summaries)
+
+    def rpc(self, name, params):
+        """Mimics set_ewallet_csv_tax_invoice_nos: NULL-only update with per-row outcomes."""
+        self.summaries.executed.append(("rpc", name))
+        if self.rpc_error:
+            error = self.rpc_error
+            return SimpleNamespace(execute=lambda: (_ for _ in ()).throw(error))
+        if name == db_loader.SHOPEEPAY_UPSERT_RPC:
+            return self._upsert_settlements(params["settlements"])
+        results = []
+        for item in params["updates"]:
+            matches = [row for row in self.summaries.rows
+                       if (row["merchant_id"], row["process_date"], row["report_source_type"])
+                       == (item["merchant_id"], item["process_date"], "EWALLET_CSV")]
+            outcome = "not_found" if not matches else "already_set"
+            for row in matches:
+                if row["tax_invoice_no"] is None:
+                    row["tax_invoice_no"] = item["tax_invoice_no"]
+                    outcome = "updated"
+            results.append(dict(item, outcome=outcome))
+        return SimpleNamespace(execute=lambda: SimpleNamespace(data=results))
+
+    def _upsert_settlements(self, settlements):
+        """Mimics upsert_shopeepay_settlements: upsert keeping an existing gdrive_file_id."""
+        by_date = {row["settlement_date"]: row for row in self.summaries.rows}
+        for item in settlements:
+            existing = by_date.get(item["settlement_date"])
+            if existing:
+                existing.update(item, gdrive_file_id=existing["gdrive_file_id"] or item["gdrive_file_id"])
+            else:
+                self.summaries.rows.append(dict(item))
+                by_date[item["settlement_date"]] = self.summaries.rows[-1]
+        results = [{"settlement_date": item["settlement_date"],
+                    "gdrive_file_id": by_date[item["settlement_date"]]["gdrive_file_id"]} for item in settlements
+                   if item["settlement_date"] not in self.rpc_dropped_dates]
+        return SimpleNamespace(execute=lambda: SimpleNamespace(data=results))
+
+
+def _row(merchant_id, process_date, source="EWALLET_CSV", tax_invoice_no=None):
+    return {"merchant_id": merchant_id, "process_date": process_date, "report_source_type": source,
+            "tax_invoice_no": tax_invoice_no}
+
+
+def test_prefetch_pages_through_rows_and_serves_lookups(monkeypatch):
+    rows = [_row("401", f"2025-05-{day:02d}") for day in range(1, 6)]
+    rows += [_row("401", "2025-05-03", source="KMERCHANT_ZIP"), _row("999", "2025-05-03")]
+    client = FakeClient(rows)
+    monkeypatch.setattr(db_loader, "supabase_client", client)
+    monkeypatch.setattr(db_loader, "PREFETCH_PAGE_SIZE", 2)
+
+    index = db_loader.prefetch_ewallet_csv_summaries(["401"], "2025-05-02", "2025-05-04")
+
+    assert sorted(index) == [("401", "2025-05-02"), ("401", "2025-05-03"), ("401", "2025-05-04")]
+    assert client.summaries.executed == [("select", db_loader.EWALLET_CSV_SUMMARY_COLUMNS)] * 2
+    assert db_loader.get_ewallet_csv_summary("401", "2025-05-03", prefetched=index)["report_source_type"] == "EWALLET_CSV"
+    assert db_loader.get_ewallet_csv_summary("401", "2025-05-09", prefetched=index) is None
+    assert len(client.summaries.executed) == 2
+
+
+def test_bulk_tax_invoice_update_chunks_rpc_calls_and_reports_outcomes(monkeypatch):
+    rows = [_row("401", "2025-05-01"), _row("401", "2025-05-02", tax_invoice_no="T-OLD"), _row("401", "2025-05-03")]
+    client = FakeClient(rows)
+    monkeypatch.setattr(db_loader, "supabase_client", client)
+    monkeypatch.setattr(db_loader, "BULK_TAX_INVOICE_CHUNK_SIZE", 2)
+
+    outcomes = db_loader.bulk_update_ewallet_csv_tax_invoice_nos([
+        ("401", "2025-05-01", "T-1"),
+        ("401", "2025-05-02", "T-2"),
+        ("401", "2025-05-03", "T-3"),
+        ("401", "2025-05-04", "T-4"),
+    ])
+
+    assert outcomes == {
+        ("401", "2025-05-01"): "updated",
+        ("401", "2025-05-02"): "already_set",
+        ("401", "2025-05-03"): "updated",
+        ("401", "2025-05-04"): "not_found",
+    }
+    assert client.summaries.executed == [("rpc", db_loader.BULK_TAX_INVOICE_RPC)] * 2
+    assert [row["tax_invoice_no"] for row in rows] == ["T-1", "T-OLD", "T-3"]
+
+
+def test_bulk_tax_invoice_update_falls_back_only_when_rpc_is_missing(monkeypatch):
+    client = FakeClient([_row("401", "2025-05-01")])
+    monkeypatch.setattr(db_loader, "supabase_client", client)
+    monkeypatch.setattr(db_loader, "BULK_TAX_INVOICE_CHUNK_SIZE", 1)
+    per_row = []
+    monkeypatch.setattr(db_loader, "update_ewallet_csv_tax_invoice_no",
+                        lambda merchant_id, process_date, tax_invoice_no: per_row.append(process_date) or 1)
+    updates = [("401", "2025-05-01", "T-1"), ("401", "2025-05-02", "T-2")]
+
+    client.rpc_error = APIError({"code": "57014", "message": "canceling statement due to statement timeout"})
+    assert db_loader.bulk_update_ewallet_csv_tax_invoice_nos(updates) == {
+        ("401", "2025-05-01"): "error", ("401", "2025-05-02"): "error"}
+    assert per_row == []
+
+    # A missing RPC is not asked again for the second chunk.
+    client.summaries.executed.clear()
+    client.rpc_error = APIError({"code": "PGRST202", "message": "Could not find the function"})
+    assert db_loader.bulk_update_ewallet_csv_tax_invoice_nos(updates) == {
+        ("401", "2025-05-01"): "updated", ("401", "2025-05-02"): "updated"}
+    assert per_row == ["2025-05-01", "2025-05-02"]
+    assert client.summaries.executed == [("rpc", db_loader.BULK_TAX_INVOICE_RPC)]
+
+
+def test_write_buffer_coalesces_rows_and_reports_per_source(monkeypatch):
+    client = FakeClient([])
+    client.summaries.rejected_dates = {"2025-05-09"}
+    monkeypatch.setattr(db_loader, "supabase_client", client)
+    buffer = db_loader.WriteBuffer(batch_rows=3)
+
+    buffer.add_merchant_transaction_summaries("zip-a", [_row("401", "2025-05-01"), _row("401", "2025-05-02")])
+    buffer.add_merchant_transaction_summaries("csv-b", [_row("401", "2025-05-02")])
+    # Three buffered rows triggered a flush; the duplicate 2025-05-02 row collapsed into one.
+    assert client.summaries.executed == [("upsert", 2)]
+    assert [buffer.succeeded(s) for s in ("zip-a", "csv-b")] == [True, True]
+
+    buffer.add_merchant_transaction_summaries("csv-c", [_row("401", "2025-05-09")])
+    buffer.add_merchant_transaction_summaries("csv-d", [])
+    assert buffer.is_buffered("csv-c") and not buffer.is_buffered("csv-d")
+    assert buffer.flush() == (0, 1)
+    assert client.summaries.executed == [("upsert", 2), ("upsert", 1)]
+    assert buffer.succeeded("csv-c") is False
+
+
+def test_shopeepay_load_counts_rows_without_echoing_them(monkeypatch):
+    client = FakeClient([])
+    monkeypatch.setattr(db_loader, "supabase_client", client)
+
+    record = {"settlement_date": "2026-05-01", "net_amount": 10.0, "raw_body": "<html>" + "x" * 4096}
+    assert db_loader.load_shopeepay_settlements([record, dict(record)]) == (1, 0)
+    assert client.summaries.executed == [("upsert", 1)]
+
+
+def test_shopeepay_upsert_rpc_keeps_archived_file_ids(monkeypatch):
+    client = FakeClient([{"settlement_date": "2026-05-01", "net_amount": 1.0, "gdrive_file_id": "drive-1"}])
+    monkeypatch.setattr(db_loader, "supabase_client", client)
+
+    archived = db_loader.upsert_shopeepay_settlements([
+        {"settlement_date": "2026-05-01", "net_amount": 2.0, "gdrive_file_id": None},
+        {"settlement_date": "2026-05-02", "net_amount": 3.0, "gdrive_file_id": None},
+    ])
+
+    assert archived == {"2026-05-01": "drive-1", "2026-05-02": None}
+    assert client.summaries.executed == [("rpc", db_loader.SHOPEEPAY_UPSERT_RPC)]
+    assert client.summaries.rows[0] == {"settlement_date": "2026-05-01", "net_amount": 2.0, "gdrive_file_id": "drive-1"}
+
+
+def test_shopeepay_upsert_rpc_fails_only_dates_it_did_not_return(monkeypatch):
+    client = FakeClient([])
+    client.rpc_dropped_dates = {"2026-05-02"}
+    monkeypatch.setattr(db_loader, "supabase_client", client)
+
+    archived = db_loader.upsert_shopeepay_settlements([
+        {"settlement_date": "2026-05-01", "gdrive_file_id": None},
+        {"settlement_date": "2026-05-02", "gdrive_file_id": None},
+    ])
+    assert archived == {"2026-05-01": None}
+
+
+def test_shopeepay_upsert_falls_back_only_when_rpc_is_missing(monkeypatch):
+    client = FakeClient([{"settlement_date": "2026-05-01", "gdrive_file_id": "drive-1"}])
+    monkeypatch.setattr(db_loader, "supabase_client", client)
+    rows = [{"settlement_date": "2026-05-01", "gdrive_file_id": None},
+            {"settlement_date": "2026-05-02", "gdrive_file_id": None}]
+
+    client.rpc_error = APIError({"code": "57014", "message": "canceling statement due to statement timeout"})
+    assert db_loader.upsert_shopeepay_settlements(rows) == {}
+    assert ("upsert", 2) not in client.summaries.executed
+
+    client.rpc_error = APIError({"code": "PGRST202", "message": "Could not find the function"})
+    archived = db_loader.upsert_shopeepay_settlements(rows)
+    assert ("upsert", 2) in client.summaries.executed
+    assert set(archived) == {"2026-05-01", "2026-05-02"}
+    assert archived == {"2026-05-01": "drive-1", "2026-05-02": None}
+
+
+def test_chunked_load_bisects_failed_chunk_to_isolate_bad_rows(monkeypatch):
+    client = FakeClient([])
+    client.summaries.rejected_dates = {"2025-05-03"}
+    monkeypatch.setattr(db_loader, "supabase_client", client)
+    rows = [_row("401", f"2025-05-{day:02d}") for day in range(1, 6)]
+
+    success, failure, failed = db_loader.load_data_in_chunks(
+        "merchant_transaction_summaries", rows, db_loader.MERCHANT_SUMMARY_CONFLICT_COLUMNS, chunk_size=4, workers=1
+    )
+
+    assert (success, failure) == (4, 1)
+    assert failed == [rows[2]]
+    assert sorted(row["process_date"] for row in client.summaries.rows) == [
+        "2025-05-01", "2025-05-02", "2025-05-04", "2025-05-05"
+    ]
+    assert client.summaries.executed == [("upsert", n) for n in (4, 2, 2, 1, 1, 1)]
+
+
+def test_client_is_built_lazily_once_and_reuses_schema_clients(monkeypatch):
+    monkeypatch.setattr(db_loader, "supabase_client", None)
+    monkeypatch.setattr(db_loader, "_client_init_attempted", False)
+    monkeypatch.setattr(db_loader, "SUPABASE_URL", None)
+    assert db_loader.get_supabase_client() is None
+
+    monkeypatch.setattr(db_loader, "_client_init_attempted", False)
+    monkeypatch.setattr(db_loader, "SUPABASE_URL", "https://example.supabase.co")
+    monkeypatch.setattr(db_loader, "SUPABASE_KEY", "header.payload.signature")
+    client = db_loader.get_supabase_client()
+
+    assert db_loader.get_supabase_client() is client
+    assert client.schema(db_loader.SUPABASE_SCHEMA) is client
+    assert client.schema("public") is client.schema("public")
+    client.aclose()
+
+
+def test_chunked_load_fails_whole_chunks_on_transport_errors(monkeypatch):
+    client = FakeClient([])
+    client.summaries.outage = True
+    monkeypatch.setattr(db_loader, "supabase_client", client)
+    rows = [_row("401", f"2025-05-{day:02d}") for day in range(1, 6)]
+
+    success, failure, failed = db_loader.load_data_in_chunks(
+        "merchant_transaction_summaries", rows, db_loader.MERCHANT_SUMMARY_CONFLICT_COLUMNS, chunk_size=4, workers=1
+    )
+
+    assert (success, failure, failed) == (0, 5, rows)
+    assert client.summaries.executed == [("upsert", 4), ("upsert", 1)]
@@ -0,0 +1,474 @@
+"""Unit tests for the Gmail helpers in src.email_handler that don't need a live mailbox."""
+
+import base64
+import hashlib
+import io
+import threading
+import time
+
+import httplib2
+import pytest
+from googleapiclient.errors import HttpError
+
+from src import config, email_handler, rate_limiter
+from tests.field_masks import Masked
+
+
+class _Call:
+    def __init__(self, result):
+        self._result = result
+
+    def execute(self, *args, **kwargs):
+        return self._result() if callable(self._result) else self._result
+
+
+class FakeGmail:
+    """Just enough of users().labels() / users().messages() to count round-trips."""
+
+    def __init__(self, labels):
+        self.labels_by_name = dict(labels)
+        self.calls = []
+        self.history_id = "100"
+        self.history_records = []    # returned by history().list
+        self.history_expired = False
+        self.search_results = {}     # query -> [message ids]
+        self.message_labels = {}     # message id -> [label ids]
+        self.get_failures = {}       # message id -> [HTTP statuses to fail with, in order]
+        self.messages_by_id = {}     # message id -> full message resource
+        self.modify_errors = []      # (status, content) raised by the next messages.modify calls
+        self.lock = threading.Lock()
+        self.active = 0              # attachment downloads in flight
+        self.peak_active = 0
+
+    # service.users()
+    def users(self):
+        return self
+
+    # .labels() / .messages()
+    def labels(self):
+        return _Labels(self)
+
+    def messages(self):
+        return _Messages(self)
+
+    def getProfile(self, userId, **kwargs):
+        self.calls.append("getProfile")
+        return _Call({"emailAddress": config.GMAIL_USER_EMAIL, "messagesTotal": 42, "historyId": self.history_id})
+
+    def history(self):
+        return _History(self)
+
+    def new_batch_http_request(self, callback):
+        return _Batch(self, callback)
+
+
+class _Labels:
+    def __init__(self, fake):
+        self.fake = fake
+
+    def list(self, userId, **kwargs):
+        self.fake.calls.append("labels.list")
+        return _Call(lambda: {"labels": [{"name": n, "id": i, "type": "user"} for n, i in self.fake.labels_by_name.items()]})
+
+    def create(self, userId, body, **kwargs):
+        self.fake.calls.append("labels.create")
+        label_id = f"Label_{len(self.fake.labels_by_name) + 1}"
+        self.fake.labels_by_name[body["name"]] = label_id
+        return _Call({"id": label_id, "name": body["name"], "type": "user"})
+
+
+class _Batch:
+    def __init__(self, fake, callback):
+        self.fake = fake
+        self.callback = callback
+        self.requests = []
+
+    def add(self, request, request_id):
+        self.requests.append((request_id, request))
+
+    def execute(self):
+        self.fake.calls.append(("batch", [rid for rid, _ in self.requests]))
+        for request_id, request in self.requests:
+            try:
+                self.callback(request_id, request.execute(), None)
+            except HttpError as error:
+                self.callback(request_id, None, error)
+
+
+class _History:
+    def __init__(self, fake):
+        self.fake = fake
+
+    def list(self, userId, startHistoryId, **kwargs):
+        self.fake.calls.append("history.list")
+        if self.fake.history_expired:
+            raise HttpError(httplib2.Response({"status": 404}), b"expired")
+        return _Call({"history": [dict(record, id="101") for record in self.fake.history_records],
+                      "historyId": self.fake.history_id})
+
+
+class _Messages:
+    def __init__(self, fake):
+        self.fake = fake
+
+    def list(self, userId, q, **kwargs):
+        self.fake.calls.append(("messages.list", q))
+        ids = next((v for k, v in self.fake.search_results.items() if q.startswith(k)), [])
+        return _Call({"messages": [{"id": i, "threadId": f"t-{i}"} for i in ids], "resultSizeEstimate": len(ids)})
+
+    def get(self, userId, id, **kwargs):
+        self.fake.calls.append(("messages.get", id))
+        failures = self.fake.get_failures.get(id)
+        if failures:
+            status = failures.pop(0)
+
+            def fail():
+                raise HttpError(httplib2.Response({"status": status}), b"error")
+            return _Call(fail)
+        if id in self.fake.messages_by_id:
+            return _Call(self.fake.messages_by_id[id])
+        return _Call({"id": id, "threadId": f"t-{id}", "labelIds": self.fake.message_labels.get(id, [])})
+
+    def attachments(self):
+        return _Attachments(self.fake)
+
+    def modify(self, userId, id, body, **kwargs):
+        self.fake.calls.append(("messages.modify", id, body))
+        if self.fake.modify_errors:
+            status, content = self.fake.modify_errors.pop(0)
+
+            def fail():
+                raise HttpError(httplib2.Response({"status": status}), content)
+            return _Call(fail)
+        return _Call({"id": id, "threadId": f"t-{id}", "labelIds": body.get("addLabelIds", [])})
+
+    def batchModify(self, userId, body, **kwargs):
+        self.fake.calls.append(("messages.batchModify", body))
+        return _Call({})
+
+
+class _Attachments:
+    def __init__(self, fake):
+        self.fake = fake
+
+    def get(self, userId, messageId, id, **kwargs):
+        self.fake.calls.append(("attachments.get", messageId))
+
+        def download():
+            with self.fake.lock:
+                self.fake.active += 1
+                self.fake.peak_active = max(self.fake.peak_active, self.fake.active)
+            time.sleep(0.02)
+            with self.fake.lock:
+                self.fake.active -= 1
+            data = f"{messageId}/{id}".encode()
+            return {"attachmentId": id, "size": len(data), "data": base64.urlsafe_b64encode(data).decode()}
+        return _Call(download)
+
+
+@pytest.fixture(autouse=True)
+def isolated_label_registry(tmp_path, monkeypatch):
+    monkeypatch.setattr(config, "LOCAL_STATE_DIR", str(tmp_path))
+    monkeypatch.setattr(config, "GMAIL_USER_EMAIL", "ops@example.com")
+    monkeypatch.setattr(config, "GMAIL_LABEL_CACHE_TTL_SECONDS", 3600)
+    email_handler.invalidate_label_cache()
+    rate_limiter.reset_limiters()
+    yield
+    email_handler.invalidate_label_cache()
+    rate_limiter.reset_limiters()
+
+
+def test_labels_resolved_with_one_list_call():
+    fake = FakeGmail({name: f"id-{name}" for name in email_handler.ALL_LABELS})
+    email_handler.resolve_label_ids(fake)
+    for name in email_handler.ALL_LABELS:
+        email_handler.add_label_to_email(fake, "m1", name)
+        email_handler.remove_label_from_email(fake, "m1", name)
+    assert fake.calls.count("labels.list") == 1
+
+
+def test_missing_label_is_created_and_cached():
+    fake = FakeGmail({})
+    first = email_handler.get_label_id(fake, email_handler.LABEL_PROCESSED)
+    second = email_handler.get_label_id(fake, email_handler.LABEL_PROCESSED)
+    assert first == second
+    assert fake.calls.count("labels.create") == 1
+    assert fake.calls.count("labels.list") == 1
+
+
+def test_persisted_cache_skips_list_on_next_run():
+    fake = FakeGmail({email_handler.LABEL_PROCESSED: "Label_9"})
+    email_handler.resolve_label_ids(fake, (email_handler.LABEL_PROCESSED,))
+
+    # Simulate a fresh process: drop the in-memory registry but keep the file.
+    email_handler._label_ids.clear()
+    email_handler._label_ids_listed = False
+
+    fresh = FakeGmail({})
+    assert email_handler.get_label_id(fresh, email_handler.LABEL_PROCESSED) == "Label_9"
+    assert fresh.calls == []
+
+
+def test_only_label_errors_refresh_the_label_cache():
+    fake = FakeGmail({"Processed": "Label_1"})
+    email_handler.get_label_id(fake, "Processed")
+
+    # A message deleted meanwhile: the cache stays and nothing is retried.
+    fake.modify_errors = [(404, b'{"error": {"code": 404, "message": "Requested entity was not found."}}')]
+    with pytest.raises(HttpError):
+        email_handler._modify_labels(fake, "m-1", {"addLabelIds": ["Label_1"]})
+    assert fake.calls.count("labels.list") == 1
+    assert email_handler._label_ids == {"Processed": "Label_1"}
+
+    # The label was deleted and re-created in the Gmail UI under a new ID.
+    fake.labels_by_name["Processed"] = "Label_9"
+    fake.modify_errors = [(400, b'{"error": {"code": 400, "message": "Invalid label: Label_1"}}')]
+    email_handler._modify_labels(fake, "m-2", {"addLabelIds": ["Label_1"]})
+    assert fake.calls.count("labels.list") == 2
+    assert fake.calls[-1] == ("messages.modify", "m-2", {"addLabelIds": ["Label_9"]})
+
+
+def test_label_batch_groups_messages_by_label_sets():
+    fake = FakeGmail({email_handler.LABEL_PROCESSED: "P", email_handler.LABEL_FAILED: "F"})
+    batch = email_handler.LabelMutationBatch(fake)
+    for message_id in ("m1", "m2", "m3"):
+        batch.add_labels(message_id, email_handler.LABEL_PROCESSED)
+        batch.mark_as_read(message_id)
+        batch.remove_labels(message_id, email_handler.LABEL_FAILED)
+    batch.add_labels("m4", email_handler.LABEL_FAILED)
+
+    applied, failed = batch.flush()
+
+    modify_calls = [c[1] for c in fake.calls if c[0] == "messages.batchModify"]
+    assert applied == 4 and failed == []
+    assert len(modify_calls) == 2
+    success_call = next(c for c in modify_calls if c["addLabelIds"] == ["P"])
+    assert success_call["ids"] == ["m1", "m2", "m3"]
+    assert success_call["removeLabelIds"] == ["F", "UNREAD"]
+    assert batch.flush() == (0, [])
+
+
+def test_label_batch_later_change_wins_and_chunks_at_limit(monkeypatch):
+    monkeypatch.setattr(email_handler, "BATCH_MODIFY_MAX_IDS", 2)
+    fake = FakeGmail({email_handler.LABEL_PROCESSED: "P"})
+    batch = email_handler.LabelMutationBatch(fake)
+    for message_id in ("a", "b", "c"):
+        batch.remove_labels(message_id, email_handler.LABEL_PROCESSED)
+        batch.add_labels(message_id, email_handler.LABEL_PROCESSED)
+
+    batch.flush()
+
+    modify_calls = [c[1] for c in fake.calls if c[0] == "messages.batchModify"]
+    assert [c["ids"] for c in modify_calls] == [["a", "b"], ["c"]]
+    assert all(c["removeLabelIds"] == [] for c in modify_calls)
+
+
+def _list_queries(fake):
+    return [c[1] for c in fake.calls if isinstance(c, tuple) and c[0] == "messages.list"]
+
+
+def test_incremental_sync_skips_search_when_mailbox_unchanged(monkeypatch):
+    monkeypatch.setattr(config, "GMAIL_INCREMENTAL_SYNC", True)
+    fake = FakeGmail({email_handler.LABEL_PROCESSED: "P"})
+    fake.search_results = {"subject:x -label:KMERCHANT_PROCESSED": ["m1", "m2"]}
+
+    first = email_handler.search_new_messages(fake, "subject:x", email_handler.LABEL_PROCESSED)
+    assert [m["id"] for m in first] == ["m1", "m2"]
+
+    # m1 got processed; m2 was deferred (no label). Nothing new arrived.
+    fake.message_labels = {"m1": ["P"], "m2": []}
+    fake.calls.clear()
+    second = email_handler.search_new_messages(fake, "subject:x", email_handler.LABEL_PROCESSED)
+
+    assert [m["id"] for m in second] == ["m2"]
+    assert _list_queries(fake) == []
+
+
+def test_incremental_sync_bounds_search_when_mail_arrives(monkeypatch):
+    monkeypatch.setattr(config, "GMAIL_INCREMENTAL_SYNC", True)
+    fake = FakeGmail({email_handler.LABEL_PROCESSED: "P"})
+    email_handler.search_new_messages(fake, "subject:x", email_handler.LABEL_PROCESSED)
+
+    fake.history_records = [{"messagesAdded": [{"message": {"id": "m9"}}]}]
+    fake.calls.clear()
+    email_handler.search_new_messages(fake, "subject:x", email_handler.LABEL_PROCESSED)
+
+    (query,) = _list_queries(fake)
+    assert " after:" in query
+
+
+def test_incremental_sync_falls_back_to_full_search(monkeypatch):
+    monkeypatch.setattr(config, "GMAIL_INCREMENTAL_SYNC", True)
+    fake = FakeGmail({email_handler.LABEL_PROCESSED: "P"})
+    email_handler.search_new_messages(fake, "subject:x", email_handler.LABEL_PROCESSED)
+
+    fake.history_expired = True
+    fake.calls.clear()
+    email_handler.search_new_messages(fake, "subject:x", email_handler.LABEL_PROCESSED)
+    assert _list_queries(fake) == ["subject:x -label:KMERCHANT_PROCESSED"]
+
+    fake.history_expired = False
+    fake.history_records = [{"labelsRemoved": [{"message": {"id": "m1"}, "labelIds": ["P"]}]}]
+    fake.calls.clear()
+    email_handler.search_new_messages(fake, "subject:x", email_handler.LABEL_PROCESSED)
+    assert _list_queries(fake) == ["subject:x -label:KMERCHANT_PROCESSED"]
+
+
+def test_batch_get_groups_requests_and_retries_transient_failures(monkeypatch):
+    monkeypatch.setattr(rate_limiter, "RETRY_BASE_DELAY_SECONDS", 0)
+    fake = FakeGmail({})
+    fake.get_failures = {"m2": [429], "m4": [404]}
+
+    results = email_handler.batch_get_messages(fake, ["m1", "m2", "m3", "m4"], batch_size=3, format="full")
+
+    assert sorted(results) == ["m1", "m2", "m3"]
+    batches = [c[1] for c in fake.calls if c[0] == "batch"]
+    assert batches == [["m1", "m2", "m3"], ["m4"], ["m2"]]
+
+
+@pytest.mark.parametrize("payload", [b"", b"a", b"ab", b"abc", bytes(range(256)) * 5])
+def test_streaming_base64_decode_matches_one_shot(payload):
+    encoded = base64.urlsafe_b64encode(payload).decode("ascii")
+    for data in (encoded, encoded.rstrip("=")):
+        out = io.BytesIO()
+        size, sha256 = email_handler._write_base64url_to_file(data, out, chunk_chars=8)
+        assert out.getvalue() == payload
+        assert size == len(payload)
+        assert sha256 == hashlib.sha256(payload).hexdigest()
+
+
+def _message(message_id, subject, sender, filenames=(), label_ids=(), html=""):
+    parts = [{"partId": str(n), "filename": name, "mimeType": "application/octet-stream",
+              "body": {"attachmentId": f"att-{name}", "size": 3}} for n, name in enumerate(filenames, 1)]
+    parts.append({"partId": "0", "filename": "", "mimeType": "text/html",
+                  "body": {"size": len(html), "data": base64.urlsafe_b64encode(html.encode()).decode()}})
+    return {
+        "id": message_id,
+        "threadId": f"t-{message_id}",
+        "snippet": subject,
+        "sizeEstimate": 2048,
+        "labelIds": list(label_ids),
+        "payload": {"headers": [{"name": "Subject", "value": subject}, {"name": "From", "value": sender}],
+                    "parts": parts},
+    }
+
+
+def test_unified_fetch_routes_messages_locally(monkeypatch, tmp_path):
+    monkeypatch.setattr(config, "GMAIL_INCREMENTAL_SYNC", False)
+    monkeypatch.setattr(email_handler, "download_specific_attachments",
+                        lambda service, message_id, download_dir, desired_filename_extension, message: [
+                            {"filename": p["filename"], "path": f"{download_dir}/{p['filename']}", "sha256": "x"}
+                            for p in message["payload"]["parts"] if p["filename"]])
+    zip_config = {
+        "search_query": 'subject:("K-Merchant Reports as of") has:attachment',
+        "subject_phrase": "K-Merchant Reports as of",
+        "desired_filename_extension": ".zip",
+        "report_type": "KMERCHANT_ZIP",
+        "file_path_key": "zip_path",
+        "processed_label": email_handler.LABEL_PROCESSED,
+    }
+    csv_config = dict(zip_config, search_query='subject:("EWALLET REPORT")', subject_phrase="EWALLET REPORT",
+                      desired_filename_extension=".csv", report_type="EWALLET_CSV", file_path_key="csv_path",
+                      processed_label=email_handler.LABEL_EWALLET_CSV_PROCESSED)
+    shopeepay_config = {"search_query": "from:support_th@shopeepay.com", "from_phrase": "support_th@shopeepay.com",
+                        "processed_label": email_handler.LABEL_SHOPEEPAY_EMAIL_PROCESSED}
+    fake = FakeGmail({email_handler.LABEL_PROCESSED: "P", email_handler.LABEL_EWALLET_CSV_PROCESSED: "C",
+                      email_handler.LABEL_SHOPEEPAY_EMAIL_PROCESSED: "S"})
+    fake.messages_by_id = {
+        "z1": _message("z1", "K-Merchant Reports as of 08/05/2025", "kbank", ["401_Card_20250508.zip"]),
+        "c1": _message("c1", "EWALLET REPORT 08/05/25", "kbank", ["401_LENGOLF_20250508.csv"]),
+        "c2": _message("c2", "EWALLET REPORT 07/05/25", "kbank", ["401_LENGOLF_20250507.csv"], label_ids=["C"]),
+        "s1": _message("s1", "ShopeePay Payment [2026-05-15]", "ShopeePay <support_th@shopeepay.com>", html="<p>hi</p>"),
+    }
+    fake.search_results = {"(": ["z1", "c1", "c2", "s1"]}
+
+    attachment_reports, body_reports = email_handler.fetch_all_new_reports(
+        fake, str(tmp_path), [zip_config, csv_config], [shopeepay_config])
+
+    assert len(_list_queries(fake)) == 1
+    assert [(r["message_id"], r["report_type"]) for r in attachment_reports] == [
+        ("z1", "KMERCHANT_ZIP"), ("c1", "EWALLET_CSV")]
+    assert attachment_reports[0]["zip_path"].endswith("401_Card_20250508.zip")
+    assert [r["message_id"] for r in body_reports] == ["s1"]
+    assert body_reports[0]["body_kind"] == "html"
+
+
+def test_attachment_downloads_run_on_bounded_per_thread_clients(monkeypatch, tmp_path):
+    monkeypatch.setattr(config, "GMAIL_DOWNLOAD_WORKERS", 2)
+    fake = FakeGmail({})
+    fake.messages_by_id = {f"m{i}": _message(f"m{i}", "K-Merchant Reports", "kbank", [f"401_Card_{i}.zip"])
+                           for i in range(1, 6)}
+    fake.get_failures = {"m3": [403]}
+    clients = {}
+
+    def worker_service(service, api, version):
+        assert (service, api, version) == (fake, "gmail", "v1")
+        return clients.setdefault(threading.get_ident(), fake)
+    monkeypatch.setattr(email_handler.google_services, "service_credentials", lambda service: object())
+    monkeypatch.setattr(email_handler.google_services, "worker_service", worker_service)
+    zip_config = {"desired_filename_extension": ".zip", "report_type": "KMERCHANT_ZIP", "file_path_key": "zip_path",
+                  "processed_label": email_handler.LABEL_PROCESSED}
+
+    reports = email_handler._download_attachment_reports(
+        fake, ["m1", "m2", "m3", "m4", "m5"], str(tmp_path), zip_config)
+
+    # m3 failed on its own; the others are reported in message order.
+    assert [r["message_id"] for r in reports] == ["m1", "m2", "m4", "m5"]
+    assert fake.peak_active == 2
+    assert 1 <= len(clients) <= 2
+    with open(reports[2]["zip_path"], "rb") as f:
+        assert f.read() == b"m4/att-401_Card_4.zip"
+
+
+def _gmail_round_trip(service, fake, download_dir):
+    """Every Gmail read path, returning what callers derived from the responses."""
+    zip_config = {"search_query": "subject:(K-Merchant)", "subject_phrase": "K-Merchant",
+                  "desired_filename_extension": ".zip", "report_type": "KMERCHANT_ZIP", "file_path_key": "zip_path",
+                  "processed_label": email_handler.LABEL_PROCESSED}
+    shopeepay_config = {"search_query": "from:support_th@shopeepay.com", "from_phrase": "support_th@shopeepay.com",
+                        "processed_label": email_handler.LABEL_SHOPEEPAY_EMAIL_PROCESSED}
+
+    def strip_paths(reports):
+        return [dict(r, zip_path=r["zip_path"].rsplit("/", 1)[-1]) if "zip_path" in r else r for r in reports]
+
+    unified = email_handler.fetch_all_new_reports(service, download_dir, [zip_config], [shopeepay_config])
+    searched = email_handler.search_new_messages(service, "subject:x", email_handler.LABEL_PROCESSED)
+    # x1 was processed meanwhile and x3 arrived: x1/x2 are re-checked one by one.
+    fake.message_labels = {"x1": ["P"]}
+    fake.search_results["subject:x"] = ["x3"]
+    fake.history_records = [{"messagesAdded": [{"message": {"id": "x3", "threadId": "t-x3"}}]}]
+    searched_again = email_handler.search_new_messages(service, "subject:x", email_handler.LABEL_PROCESSED)
+    attachments = email_handler.fetch_new_reports(service, "subject:(K-Merchant)", download_dir, zip_config)
+    bodies = email_handler.fetch_new_body_only_reports(
+        service, "from:support_th@shopeepay.com", email_handler.LABEL_SHOPEEPAY_EMAIL_PROCESSED)
+    created_label = email_handler.get_label_id(service, email_handler.LABEL_FAILED)
+    labelled = email_handler.add_label_to_email(service, "z1", email_handler.LABEL_FAILED)
+    marked = email_handler.mark_email_as_read(service, "z1")
+    return (strip_paths(unified[0]), unified[1], [m["id"] for m in searched], [m["id"] for m in searched_again], strip_paths(attachments), bodies,
+            created_label, labelled, marked)
+
+
+def test_gmail_field_masks_keep_every_key_callers_read(monkeypatch, tmp_path):
+    monkeypatch.setattr(config, "GMAIL_INCREMENTAL_SYNC", True)
+
+    def run(masked):
+        monkeypatch.setattr(config, "LOCAL_STATE_DIR", str(tmp_path / f"state-{masked}"))
+        email_handler.invalidate_label_cache()
+        fake = FakeGmail({email_handler.LABEL_PROCESSED: "P", email_handler.LABEL_SHOPEEPAY_EMAIL_PROCESSED: "S"})
+        fake.messages_by_id = {
+            "z1": _message("z1", "K-Merchant Reports as of 08/05/2025", "kbank", ["401_Card_20250508.zip"]),
+            "s1": _message("s1", "ShopeePay Payment [2026-05-15]", "ShopeePay <support_th@shopeepay.com>",
+                           html="<p>net 10.00</p>"),
+        }
+        fake.search_results = {"(": ["z1", "s1"], "subject:x": ["x1", "x2"], "subject:(K-Merchant)": ["z1"],
+                               "from:support": ["s1"]}
+        service = Masked(fake) if masked else fake
+        return _gmail_round_trip(service, fake, str(tmp_path / f"downloads-{masked}")), getattr(service, "masks", [])
+
+    expected, _ = run(masked=False)
+    actual, masks = run(masked=True)
+
+    assert actual == expected
+    assert expected[0] and expected[1] and expected[4] and expected[5]
+    assert expected[3] == ["x3", "x2"]
+    assert set(masks) == set(email_handler.GMAIL_FIELDS.values())
@@ -0,0 +1,351 @@
+"""Unit tests for the Drive helpers in src.gdrive_handler that don't need a live Drive."""
+
+import hashlib
+import json
+import os
+import re
+from concurrent.futures import ThreadPoolExecutor
+
+import httplib2
+import pytest
+from googleapiclient.errors import HttpError
+
+from src import archive_index, config, gdrive_handler, google_services, rate_limiter
+from tests.field_masks import Masked
+
+
+class _Call:
+    def __init__(self, result):
+        self._result = result
+
+    def execute(self, *args, **kwargs):
+        return self._result() if callable(self._result) else self._result
+
+    def next_chunk(self, *args, **kwargs):
+        return None, self.execute()
+
+
+def _not_found():
+    raise HttpError(httplib2.Response({"status": 404}), b"not found")
+
+
+class FakeDrive:
+    """
+    Just enough of files() for the folder and upload helpers: folders live in
+    `self.folders`, uploaded files in `self.stored`. Responses carry full
+    resources, whatever `fields` asks for.
+    """
+
+    def __init__(self, folders=()):
+        self.folders = {f["id"]: dict(f) for f in folders}
+        self.stored = {}
+        self.calls = []
+        self.missing_files = set()
+        self.deleted_folders = set()  # folder IDs Drive answers 404 for
+        self.uploads = []            # resumable() of each update's media
+        self._next_id = 0
+
+    def files(self):
+        return self
+
+    @staticmethod
+    def _resource(entry, mime_type):
+        return dict({"kind": "drive#file", "mimeType": mime_type, "trashed": False,
+                     "modifiedTime": "2025-05-08T10:00:00.000Z", "webViewLink": f"https://drive/{entry['id']}"}, **entry)
+
+    def _entries(self):
+        yield from (self._resource(f, gdrive_handler.FOLDER_MIME_TYPE) for f in self.folders.values())
+        yield from (self._resource(f, f.get("mimeType", "application/octet-stream")) for f in self.stored.values())
+
+    def get(self, fileId, fields=None, **kwargs):
+        self.calls.append(("get", fileId))
+        if fileId not in self.folders or fileId in self.deleted_folders:
+            return _Call(_not_found)
+        return _Call(self._resource(self.folders[fileId], gdrive_handler.FOLDER_MIME_TYPE))
+
+    def list(self, q, fields=None, **kwargs):
+        self.calls.append(("list", q))
+        if q.startswith("mimeType="):
+            parents = set(re.findall(r"'([^']+)' in parents", q))
+            return _Call({"files": [self._resource(f, gdrive_handler.FOLDER_MIME_TYPE) for f in self.folders.values()
+                                    if not f.get("trashed") and parents.intersection(f["parents"])]})
+        parent = re.search(r"'([^']+)' in parents", q)
+        name = re.search(r"name ?= ?'([^']+)'", q)
+        contains = re.search(r"name contains '([^']+)'", q)
+        if parent and parent.group(1) in self.deleted_folders:
+            return _Call(_not_found)
+        matches = [f for f in self._entries()
+                   if (not parent or parent.group(1) in f["parents"])
+                   and (not name or f["name"] == name.group(1))
+                   and (not contains or contains.group(1) in f["name"])]
+        return _Call({"kind": "drive#fileList", "incompleteSearch": False, "files": matches})
+
+    def create(self, body, fields=None, media_body=None, **kwargs):
+        self.calls.append(("create", body["name"]))
+        if set(body["parents"]) & self.deleted_folders:
+            return _Call(_not_found)
+        self._next_id += 1
+        entry = {"id": f"new-{self._next_id}", "name": body["name"], "parents": body["parents"]}
+        if media_body is None:
+            self.folders[entry["id"]] = entry
+        else:
+            self.stored[entry["id"]] = dict(entry, **self._media_metadata(media_body))
+        return _Call(self._resource(entry, body.get("mimeType", "application/octet-stream")))
+
+    def update(self, fileId, media_body=None, fields=None, **kwargs):
+        self.calls.append(("update", fileId))
+        self.uploads.append(media_body.resumable())
+        if fileId in self.missing_files:
+            return _Call(_not_found)
+        if fileId in self.stored:
+            self.stored[fileId].update(self._media_metadata(media_body))
+        return _Call({"id": fileId, "kind": "drive#file"})
+
+    @staticmethod
+    def _media_metadata(media_body):
+        content = media_body.getbytes(0, media_body.size())
+        return {"mimeType": media_body.mimetype(), "md5Checksum": hashlib.md5(content).hexdigest(),
+                "size": str(len(content))}
+
+
+@pytest.fixture(autouse=True)
+def isolated_folder_cache(tmp_path, monkeypatch):
+    monkeypatch.setattr(config, "LOCAL_STATE_DIR", str(tmp_path))
+    gdrive_handler.invalidate_folder_cache()
+    gdrive_handler.reset_upload_stats()
+    rate_limiter.reset_limiters()
+    yield
+    gdrive_handler.invalidate_folder_cache()
+
+
+TREE = [
+    {"id": "y", "name": "2025", "parents": ["root"]},
+    {"id": "m", "name": "202505", "parents": ["y"]},
+    {"id": "d", "name": "2025-05-08", "parents": ["m"]},
+]
+
+
+def test_folder_lookups_are_targeted_and_cached():
+    drive = FakeDrive(TREE)
+    parent = "root"
+    for name in ("2025", "202505", "2025-05-08"):
+        parent = gdrive_handler.find_or_create_folder(drive, parent, name)
+    assert parent == "d"
+    # One targeted lookup per miss; never a listing of every folder.
+    assert [c[0] for c in drive.calls] == ["list", "list", "list"]
+    assert not any(q.startswith("mimeType=") for _, q in drive.calls)
+    assert gdrive_handler.find_or_create_folder(drive, "m", "2025-05-08") == "d"
+    assert len(drive.calls) == 3
+
+    # A new process starts from the persisted cache: one check per folder, then none.
+    _simulate_new_process()
+    fresh = FakeDrive(TREE)
+    assert gdrive_handler.find_or_create_folder(fresh, "m", "2025-05-08") == "d"
+    assert gdrive_handler.find_or_create_folder(fresh, "m", "2025-05-08") == "d"
+    assert fresh.calls == [("get", "d")]
+
+
+def _simulate_new_process():
+    gdrive_handler._folder_ids.clear()
+    gdrive_handler._verified_folder_ids.clear()
+    gdrive_handler._folder_cache_loaded = False
+
+
+def test_trashed_cached_folder_is_resolved_again():
+    drive = FakeDrive(TREE)
+    assert gdrive_handler.find_or_create_folder(drive, "m", "2025-05-08") == "d"
+
+    _simulate_new_process()
+    drive.folders["d"]["trashed"] = True
+    drive.folders["d"]["parents"] = ["trash"]
+    drive.calls.clear()
+    assert gdrive_handler.find_or_create_folder(drive, "m", "2025-05-08") == "new-1"
+    assert [c[0] for c in drive.calls] == ["get", "list", "create"]
+
+
+def test_upload_into_deleted_folder_is_retried_in_a_resolved_one():
+    drive = FakeDrive(TREE)
+    day = gdrive_handler.find_or_create_folder(drive, "m", "2025-05-08")
+    drive.deleted_folders.add(day)
+    del drive.folders[day]
+
+    file_ids = gdrive_handler.archive_files_to_folder(
+        drive, day, [(b"zip", "report.zip")],
+        resolve_folder=lambda: gdrive_handler.find_or_create_folder(drive, "m", "2025-05-08"))
+
+    assert file_ids == ["new-2"]
+    assert drive.stored["new-2"]["parents"] == ["new-1"]
+
+
+def test_missing_folder_is_created_once_and_persisted(tmp_path):
+    drive = FakeDrive(TREE)
+    first = gdrive_handler.find_or_create_folder(drive, "m", "2025-05-09")
+    second = gdrive_handler.find_or_create_folder(drive, "m", "2025-05-09")
+    assert first == second == "new-1"
+    assert [c[0] for c in drive.calls] == ["list", "create"]
+    with open(os.path.join(tmp_path, gdrive_handler.FOLDER_CACHE_FILENAME)) as f:
+        assert json.load(f)["folders"]["m/2025-05-09"] == "new-1"
+
+
+def test_concurrent_misses_on_one_folder_create_it_once():
+    drive = FakeDrive(TREE)
+    with ThreadPoolExecutor(max_workers=8) as pool:
+        ids = list(pool.map(lambda _: gdrive_handler.find_or_create_folder(drive, "m", "2025-05-09"), range(8)))
+    assert set(ids) == {"new-1"}
+    assert [c for c in drive.calls if c[0] == "create"] == [("create", "2025-05-09")]
+
+
+def test_forget_folder_evicts_its_whole_subtree():
+    drive = FakeDrive(TREE)
+    gdrive_handler.warm_folder_cache(drive, "root")
+    gdrive_handler.forget_folder("y")
+    assert gdrive_handler.cached_subfolders(drive, "root") == {}
+    assert gdrive_handler.known_folder_ids() == set()
+
+
+def test_warm_up_walks_only_the_archive_root_a_level_at_a_time(monkeypatch):
+    monkeypatch.setattr(gdrive_handler, "FOLDER_WARM_PARENTS_PER_QUERY", 1)
+    drive = FakeDrive(TREE + [
+        {"id": "d2", "name": "2025-05-09", "parents": ["m"]},
+        {"id": "m2", "name": "202506", "parents": ["y"]},
+        {"id": "other", "name": "Shared", "parents": ["elsewhere"]},
+    ])
+    assert gdrive_handler.cached_folder_paths(drive, "root") == {
+        "root": "", "y": "2025", "m": "2025/202505", "m2": "2025/202506",
+        "d": "2025/202505/2025-05-08", "d2": "2025/202505/2025-05-09"}
+    # root, y, then m and m2 one query each, then d and d2 one query each.
+    assert len(drive.calls) == 6
+    assert all("' in parents" in q for _, q in drive.calls)
+    assert "other" not in gdrive_handler.known_folder_ids()
+
+    gdrive_handler.cached_subfolders(drive, "root")
+    assert len(drive.calls) == 6
+
+
+def test_warm_up_drops_cached_ids_it_no_longer_finds():
+    drive = FakeDrive(TREE)
+    assert gdrive_handler.find_or_create_folder(drive, "m", "2025-05-09") == "new-1"
+    assert gdrive_handler.find_or_create_folder(drive, "new-1", "sub") == "new-2"
+    gdrive_handler._folder_ids["m/2025-05-08"] = "stale-d"
+
+    # The new Day folder is trashed; "d" is listed under its old name again.
+    drive.folders["new-1"]["trashed"] = True
+    gdrive_handler.warm_folder_cache(drive, "root")
+
+    assert gdrive_handler.cached_subfolders(drive, "m") == {"2025-05-08": "d"}
+    assert gdrive_handler.known_folder_ids() == {"y", "m", "d"}
+    with open(os.path.join(config.LOCAL_STATE_DIR, gdrive_handler.FOLDER_CACHE_FILENAME)) as f:
+        assert set(json.load(f)["folders"].values()) == {"y", "m", "d"}
+
+
+def test_upsert_updates_existing_file_in_place_and_creates_otherwise(tmp_path):
+    local = tmp_path / "report.csv"
+    local.write_text("a,b\n")
+    drive = FakeDrive()
+
+    assert gdrive_handler.upsert_file_to_gdrive(drive, str(local), "d", existing_file_id="f-1") == "f-1"
+    assert gdrive_handler.upsert_file_to_gdrive(drive, str(local), "d") == "new-1"
+    assert drive.calls == [("update", "f-1"), ("create", "report.csv")]
+
+
+def test_upsert_falls_back_to_create_when_existing_file_is_gone(tmp_path):
+    local = tmp_path / "report.csv"
+    local.write_text("a,b\n")
+    drive = FakeDrive()
+    drive.missing_files.add("f-1")
+
+    assert gdrive_handler.upsert_file_to_gdrive(drive, str(local), "d", existing_file_id="f-1") == "new-1"
+    assert drive.calls == [("update", "f-1"), ("create", "report.csv")]
+
+
+def test_upsert_skips_identical_content_and_counts_bytes(tmp_path):
+    local = tmp_path / "report.csv"
+    local.write_bytes(b"a,b\n")
+    same_md5 = hashlib.md5(b"a,b\n").hexdigest()
+    drive = FakeDrive()
+
+    assert gdrive_handler.upsert_file_to_gdrive(drive, str(local), "d", existing_file_id="f-1", existing_md5=same_md5) == "f-1"
+    assert gdrive_handler.upsert_file_to_gdrive(drive, str(local), "d", existing_file_id="f-2", existing_md5="0" * 32) == "f-2"
+    assert drive.calls == [("update", "f-2")]
+    assert gdrive_handler.get_upload_stats() == {
+        "uploaded_files": 1, "uploaded_bytes": 4, "skipped_files": 1, "skipped_bytes": 4}
+
+
+@pytest.mark.parametrize("threshold, resumable", [(1024, False), (4, True)])
+def test_upload_mode_depends_on_size_threshold(tmp_path, monkeypatch, threshold, resumable):
+    monkeypatch.setattr(config, "GDRIVE_RESUMABLE_THRESHOLD_BYTES", threshold)
+    local = tmp_path / "report.csv"
+    local.write_bytes(b"a,b\n")
+    drive = FakeDrive()
+
+    assert gdrive_handler.upsert_file_to_gdrive(drive, str(local), "d", existing_file_id="f-1") == "f-1"
+    assert drive.uploads == [resumable]
+
+
+def test_upsert_content_uploads_from_memory_and_skips_identical_bytes():
+    content = b"<p>settlement</p>"
+    drive = FakeDrive()
+
+    assert gdrive_handler.upsert_content_to_gdrive(drive, content, "d", "settlement.html") == "new-1"
+    assert gdrive_handler.upsert_content_to_gdrive(
+        drive, content, "d", "settlement.html",
+        existing_file_id="new-1", existing_md5=hashlib.md5(content).hexdigest()) == "new-1"
+    assert drive.calls == [("create", "settlement.html")]
+    assert gdrive_handler.get_upload_stats()["skipped_bytes"] == len(content)
+
+
+def test_archive_files_to_folder_uploads_in_parallel_and_reports_per_file(tmp_path, monkeypatch):
+    monkeypatch.setattr(config, "GDRIVE_UPLOAD_WORKERS", 3)
+    drive = FakeDrive()
+    monkeypatch.setattr(google_services, "service_credentials", lambda service: object())
+    monkeypatch.setattr(google_services, "worker_service", lambda service, api, version: drive)
+    uploads = [(b"zip", "report.zip"), (b"csv", "summary.csv"), (str(tmp_path / "missing.pdf"), "missing.pdf")]
+
+    file_ids = gdrive_handler.archive_files_to_folder(drive, "d", uploads)
+
+    assert file_ids[2] is None
+    assert all(file_ids[:2]) and file_ids[0] != file_ids[1]
+    assert sorted(name for call, name in drive.calls if call == "create") == ["report.zip", "summary.csv"]
+
+
+
+def _drive_round_trip(service, tmp_path):
+    """Every Drive read path, returning what callers derived from the responses."""
+    existing_day = gdrive_handler.find_or_create_folder(service, "m", "2025-05-08")
+    new_day = gdrive_handler.find_or_create_folder(service, "m", "2025-05-09")
+    local = tmp_path / "summary.csv"
+    local.write_bytes(b"a,b\n")
+    first = gdrive_handler.archive_files_to_folder(service, new_day, [(b"zip", "report.zip"), (str(local), "summary.csv")])
+    local.write_bytes(b"a,b,c\n")
+    second = gdrive_handler.archive_files_to_folder(service, new_day, [(b"zip", "report.zip"), (str(local), "summary.csv")])
+    found = gdrive_handler.find_file_id_by_name_in_folder(service, new_day, "report.zip")
+    _simulate_new_process()
+    rechecked = gdrive_handler.find_or_create_folder(service, "m", "2025-05-08")
+    gdrive_handler.warm_folder_cache(service, "root", force=True)
+    paths = gdrive_handler.cached_folder_paths(service, "root")
+    conn = archive_index.open_index()
+    archive_index.refresh(service, conn, "root", "report")
+    indexed = archive_index.find_files(conn, "report")
+    conn.close()
+    return (existing_day, new_day, first, second, gdrive_handler.get_upload_stats(), found, rechecked, paths, indexed)
+
+
+def test_drive_field_masks_keep_every_key_callers_read(monkeypatch, tmp_path):
+    def run(masked):
+        run_dir = tmp_path / f"run-{masked}"
+        run_dir.mkdir()
+        monkeypatch.setattr(config, "LOCAL_STATE_DIR", str(run_dir))
+        gdrive_handler.invalidate_folder_cache()
+        gdrive_handler.reset_upload_stats()
+        drive = FakeDrive(TREE)
+        service = Masked(drive) if masked else drive
+        return _drive_round_trip(service, run_dir), getattr(service, "masks", [])
+
+    expected, _ = run(masked=False)
+    actual, masks = run(masked=True)
+
+    assert actual == expected
+    assert expected[4] == {"uploaded_files": 3, "uploaded_bytes": 13, "skipped_files": 1, "skipped_bytes": 3}
+    assert expected[6] == expected[0] == "d"
+    assert [row["name"] for row in expected[8]] == ["report.zip"]
+    assert set(masks) == set(gdrive_handler.DRIVE_FIELDS.values())
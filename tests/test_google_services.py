@@ -0,0 +1,27 @@
+"""Unit tests for the per-thread Google API clients in src.google_services."""
+
+import threading
+from types import SimpleNamespace
+
+from google.auth.credentials import AnonymousCredentials
+
+from src import google_services
+
+
+def test_worker_service_is_built_once_per_thread_and_api():
+    service = SimpleNamespace(_http=SimpleNamespace(credentials=AnonymousCredentials()))
+
+    drive = google_services.worker_service(service, 'drive', 'v3')
+    assert google_services.worker_service(service, 'drive', 'v3') is drive
+    assert google_services.worker_service(service, 'gmail', 'v1') is not drive
+    assert drive._http.credentials is service._http.credentials
+
+    other_thread = []
+    thread = threading.Thread(target=lambda: other_thread.append(google_services.worker_service(service, 'drive', 'v3')))
+    thread.start()
+    thread.join()
+    assert other_thread[0] is not drive
+
+
+def test_worker_service_needs_recoverable_credentials():
+    assert google_services.worker_service(SimpleNamespace(), 'drive', 'v3') is None
@@ -0,0 +1,94 @@
+"""Unit tests for the shared Google API limiter in src.rate_limiter."""
+
+import json
+
+import httplib2
+import pytest
+from googleapiclient.errors import HttpError
+
+from src import config, rate_limiter
+
+
+def _http_error(status, reason=None):
+    content = b"error"
+    if reason:
+        content = json.dumps({"error": {"code": status, "errors": [{"reason": reason}]}}).encode()
+    return HttpError(httplib2.Response({"status": status}), content)
+
+
+class _FlakyRequest:
+    methodId = "gmail.users.messages.list"
+
+    def __init__(self, failures, result="ok"):
+        self.failures = list(failures)
+        self.result = result
+        self.calls = 0
+
+    def execute(self):
+        self.calls += 1
+        if self.failures:
+            raise self.failures.pop(0)
+        return self.result
+
+
+@pytest.fixture(autouse=True)
+def fresh_limiters(monkeypatch):
+    monkeypatch.setattr(config, "GOOGLE_API_MAX_ATTEMPTS", 4)
+    monkeypatch.setattr(config, "GOOGLE_API_MAX_CONCURRENCY", 8)
+    monkeypatch.setattr(rate_limiter.time, "sleep", lambda seconds: None)
+    rate_limiter.reset_limiters()
+    yield
+    rate_limiter.reset_limiters()
+
+
+def test_throttled_call_is_retried_and_halves_concurrency():
+    request = _FlakyRequest([_http_error(429), _http_error(503)])
+
+    assert rate_limiter.gmail(request, "messages.list") == "ok"
+    assert request.calls == 3
+    limiter = rate_limiter.get_limiter("gmail")
+    assert limiter.concurrency == 4
+    assert limiter._in_flight == 0
+
+
+def test_403_rate_limit_reason_is_retried_but_plain_403_is_not():
+    request = _FlakyRequest([_http_error(403, "userRateLimitExceeded")])
+    assert rate_limiter.drive(request) == "ok"
+    assert request.calls == 2
+
+    forbidden = _FlakyRequest([_http_error(403, "insufficientPermissions")])
+    with pytest.raises(HttpError):
+        rate_limiter.drive(forbidden)
+    assert forbidden.calls == 1
+
+
+def test_non_idempotent_call_is_only_retried_when_throttled():
+    throttled = _FlakyRequest([_http_error(429)])
+    assert rate_limiter.drive(throttled, idempotent=False) == "ok"
+    assert throttled.calls == 2
+
+    for failure in (_http_error(503), ConnectionError("reset"), TimeoutError("timed out")):
+        request = _FlakyRequest([failure])
+        with pytest.raises(type(failure)):
+            rate_limiter.drive(request, idempotent=False)
+        assert request.calls == 1
+    assert rate_limiter.get_limiter("drive")._in_flight == 0
+
+
+def test_gives_up_after_max_attempts_and_reraises():
+    request = _FlakyRequest([_http_error(500)] * 10)
+    with pytest.raises(HttpError):
+        rate_limiter.gmail(request, "messages.get")
+    assert request.calls == 4
+    assert rate_limiter.get_limiter("gmail")._in_flight == 0
+
+
+def test_concurrency_recovers_after_sustained_success():
+    limiter = rate_limiter.AdaptiveLimiter("test", rate=100, max_concurrency=8)
+    limiter.on_throttle()
+    limiter.on_throttle()
+    assert limiter.concurrency == 2
+    for _ in range(rate_limiter.RECOVERY_SUCCESSES):
+        limiter.on_success()
+    assert limiter.concurrency == 3
+    assert limiter.bucket.rate > 25